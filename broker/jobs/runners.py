@@ -76,6 +76,19 @@ def all_broker():
     tests.broker.t22()
     tests.broker.t23()
     tests.broker.t24()
+    tests.broker.t25()
+    tests.broker.t26()
+    tests.broker.t27()
+    tests.broker.t28()
+    tests.broker.t29()
+    tests.broker.t30()
+    tests.broker.t31()
+    tests.broker.t32()
+    tests.broker.t33()
+    tests.broker.t34()
+    tests.broker.t35()
+    tests.broker.t36()
+    tests.broker.t37()
 
 @trace
 def all_session():
@@ -113,6 +126,9 @@ def all_stacks():
     tests.stacks.t14()
     tests.stacks.t15()
     tests.stacks.t16()
+    tests.stacks.t17()
+    tests.stacks.t18()
+    tests.stacks.t19()
 
 @trace
 def all_remote_forward():
@@ -155,6 +171,9 @@ def all_remote_share_basic():
     tests.remote_share_basic.t20()
     tests.remote_share_basic.t21()
     tests.remote_share_basic.t22()
+    tests.remote_share_basic.t23()
+    tests.remote_share_basic.t24()
+    tests.remote_share_basic.t25()
 
 @trace
 def all_remote_share_workspace():
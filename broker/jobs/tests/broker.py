@@ -7,16 +7,24 @@ import json
 import signal
 import psutil
 import socket
+import threading
 import traceback
 
-from ave.broker._broker     import Broker, RemoteBroker
+from ave.broker._broker     import Broker, RemoteBroker, AsyncRemoteBroker, Waiter
 from ave.broker.resource    import RemoteHandset
 from ave.broker.session     import RemoteSession
+from ave.broker.allocator   import Allocator
 from ave.broker.profile     import *
+from ave.broker.exceptions  import Busy
+from ave.broker.recorder    import load_trace
+from ave.broker.journal     import load_journal
+from ave.broker.tools       import replay
 from ave.handset.profile    import HandsetProfile
 from ave.network.process    import Process
 from ave.network.pipe       import Pipe
 from ave.network.connection import Connection, find_free_port
+from ave.network.exceptions import ConnectionTimeout
+from ave.network.reactor    import Reactor
 from ave.workspace          import Workspace
 
 import setup
@@ -664,8 +672,9 @@ def t18(HOME, r):
             print('FAIL %s: wrong local serial: %s' % (pretty, p1))
             return False
 
+        # master-2 is a member of two stacks and is kept for stack requests
         p2 = h2.get_profile()
-        if p2['serial'] != 'master-2':
+        if p2['serial'] != 'master-3':
             print('FAIL %s: wrong local serial: %s' % (pretty, p2))
             return False
     except Exception, e:
@@ -886,4 +895,668 @@ def t24(HOME, r):
             print('FAIL %s: unexpected exception: %s' % (pretty, str(e)))
             return False
 
-    return True
\ No newline at end of file
+    return True
+
+# check that resources can be allocated and used with an AsyncRemoteBroker and
+# that the broker reclaims them when the connection is closed
+@setup.brokers([], 'master', [], True, False)
+def t25(HOME, r):
+    pretty = '%s t25' % __file__
+    print(pretty)
+
+    reactor = Reactor()
+    a = AsyncRemoteBroker(r.address, 5, r.authkey, HOME.path, reactor)
+    try:
+        h, w = reactor.run(
+            a.get_resources({'type':'handset'}, {'type':'workspace'}), 5
+        )
+    except Exception, e:
+        print('FAIL %s: allocation failed: %s' % (pretty, e))
+        return False
+    if h.profile['type'] != 'handset' or w.profile['type'] != 'workspace':
+        print('FAIL %s: wrong resources: %s %s' % (pretty,h.profile,w.profile))
+        return False
+    try:
+        profile = reactor.run(h.get_profile(), 5)
+    except Exception, e:
+        print('FAIL %s: could not call handset: %s' % (pretty, e))
+        return False
+    if profile['serial'] != h.profile['serial']:
+        print('FAIL %s: wrong handset profile: %s' % (pretty, profile))
+        return False
+
+    # another client must not be able to allocate the same handset
+    b = AsyncRemoteBroker(r.address, 5, r.authkey, HOME.path, reactor)
+    try:
+        reactor.run(b.get_resources(h.profile), 5)
+        print('FAIL %s: handset allocated twice' % pretty)
+        return False
+    except Busy:
+        pass
+    except Exception, e:
+        print('FAIL %s: wrong exception: %s' % (pretty, e))
+        return False
+
+    a.close()
+    for i in range(10):
+        available = r.list_available({'type':'handset'})
+        if h.profile['serial'] in [p['serial'] for p in available]:
+            break
+        time.sleep(0.3)
+    else:
+        print('FAIL %s: handset not reclaimed' % pretty)
+        return False
+
+    return True
+
+# check that the equipment index finds the same equipment, in the same order,
+# as matching every listed profile would, also after equipment was modified
+def t26():
+    pretty = '%s t26' % __file__
+    print(pretty)
+
+    allocator = Allocator()
+    for profile in setup.make_handsets('t26') + setup.make_relays('t26'):
+        allocator.append_equipment(profile)
+
+    def check(step):
+        for profile in [
+            {'type':'handset'},
+            {'type':'handset', 'pretty':'jane'},
+            {'type':'handset', 'power_state':'offline'},
+            {'type':'handset', 'product.model':'d1123', 'vendor':'foo'},
+            {'type':'handset', 'no_such_key':'x'},
+            {'type':'relay'},
+            {'type':'relay', 'uid':'t26-a', 'unknown':'ignored by relays'},
+            {'type':'relay', 'circuits':['usb.pc.vcc']},
+            {'type':'handset', 'pretty':'gustav'}
+        ]:
+            expected = [e for e in allocator.equipment if e.match(profile)]
+            actual   = allocator.list_equipment(profile)
+            if [id(e) for e in actual] != [id(e) for e in expected]:
+                print(
+                    'FAIL %s: wrong result for %s in step %s: %s != %s'
+                    % (pretty, profile, step, actual, expected)
+                )
+                return False
+        return True
+
+    if not check(1):
+        return False
+    handset = allocator.equipment[1]
+    handset['power_state'] = 'offline'
+    allocator.reindex_equipment(handset)
+    if not check(2):
+        return False
+    allocator.remove_equipment(HandsetProfile({'serial':'t26-1'}))
+    if not check(3):
+        return False
+
+    return True
+
+# check that an allocation request may wait for busy equipment to be released
+# and that it fails with Busy if it is not released in time
+@setup.brokers([], 'master', [], True, False)
+def t27(HOME, r):
+    pretty = '%s t27' % __file__
+    print(pretty)
+
+    wanted = {'type':'handset', 'pretty':'mary'}
+    holder = RemoteBroker(r.address, 5, None, HOME.path)
+    handset = holder.get(wanted)
+
+    # send the request without blocking on the response
+    waiter  = RemoteBroker(r.address, 5, None, HOME.path)
+    pending = waiter.submit('get', wanted, wait=10)
+    time.sleep(0.5)
+
+    # the broker keeps serving other clients in the meantime
+    other = RemoteBroker(r.address, 5, None, HOME.path)
+    try:
+        other.get(wanted)
+        print('FAIL %s: handset allocated twice' % pretty)
+        return False
+    except Busy:
+        pass
+
+    holder.yield_resources(handset)
+    try:
+        response = pending.result(5)
+    except Exception, e:
+        print('FAIL %s: waiting allocation failed: %s' % (pretty, e))
+        return False
+    if response['resources'][0]['serial'] != handset.profile['serial']:
+        print('FAIL %s: wrong handset allocated: %s' % (pretty, response))
+        return False
+
+    # the handset is now held by the waiter. time out while waiting for it
+    other = RemoteBroker(r.address, 5, None, HOME.path)
+    start = time.time()
+    try:
+        other.get(wanted, wait=1)
+        print('FAIL %s: handset allocated twice' % pretty)
+        return False
+    except Busy:
+        pass
+    except Exception, e:
+        print('FAIL %s: wrong exception: %s' % (pretty, e))
+        return False
+    if not 1 <= time.time() - start < 4:
+        print('FAIL %s: wrong wait: %s' % (pretty, time.time() - start))
+        return False
+
+    return True
+
+# check that waiting requests are served in priority order and that waiting
+# long enough lets a low priority request overtake a high priority one
+@setup.brokers([], 'master', [], True, False)
+def t28(HOME, r):
+    pretty = '%s t28' % __file__
+    print(pretty)
+
+    wanted = {'type':'handset', 'pretty':'mary'}
+    holder = RemoteBroker(r.address, 5, None, HOME.path)
+    handset = holder.get(wanted)
+
+    try:
+        RemoteBroker(r.address, 5, None, HOME.path).get(
+            wanted, wait=1, priority='urgent'
+        )
+        print('FAIL %s: unknown priority class accepted' % pretty)
+        return False
+    except Exception, e:
+        if 'priority must be' not in str(e):
+            print('FAIL %s: wrong exception: %s' % (pretty, e))
+            return False
+
+    # the low priority request arrives first but the gating one is served
+    nightly = RemoteBroker(r.address, 5, None, HOME.path)
+    low     = nightly.submit('get', wanted, wait=10, priority='nightly')
+    time.sleep(0.2)
+    gating  = RemoteBroker(r.address, 5, None, HOME.path)
+    high    = gating.submit('get', wanted, wait=10, priority='gating')
+    time.sleep(0.5)
+
+    holder.yield_resources(handset)
+    try:
+        high.result(5)
+    except Exception, e:
+        print('FAIL %s: gating allocation failed: %s' % (pretty, e))
+        return False
+    try:
+        low.result(0.5)
+        print('FAIL %s: nightly request was served' % pretty)
+        return False
+    except ConnectionTimeout:
+        pass
+
+    # the gating client goes away. the nightly request gets the handset. the
+    # connection was used to request resources, so it is not pooled and the
+    # broker sees the disconnect
+    del high, gating
+    try:
+        low.result(5)
+    except Exception, e:
+        print('FAIL %s: nightly allocation failed: %s' % (pretty, e))
+        return False
+
+    # aging raises the priority of requests that have waited for long
+    old = Waiter(None, [], None, None, 100, 0)
+    new = Waiter(None, [], None, None, 100, 2)
+    old.arrival -= 30
+    if not old.rank(time.time(), 10) > new.rank(time.time(), 10):
+        print('FAIL %s: no aging: %s' % (pretty, old.rank(time.time(), 10)))
+        return False
+    if old.rank(time.time(), 0) != 0:
+        print('FAIL %s: aging not disabled' % pretty)
+        return False
+
+    return True
+
+# check that overlapping profiles get the stacked handsets they asked for, in
+# the order they were requested
+@setup.brokers([], 'master', [], False, False, stacking='multi-messy')
+def t29(HOME, r):
+    pretty = '%s t29' % __file__
+    print(pretty)
+
+    try:
+        h1, h2 = r.get({'type':'handset'}, {'type':'handset', 'pretty':'mary'})
+    except Exception, e:
+        print('FAIL %s: could not allocate: %s' % (pretty, e))
+        return False
+    p1 = h1.get_profile()
+    p2 = h2.get_profile()
+    if p2['pretty'] != 'mary' or p1['serial'] == p2['serial']:
+        print('FAIL %s: wrong handsets: %s %s' % (pretty, p1, p2))
+        return False
+
+    return True
+
+# check that allocation traffic can be recorded and replayed without a broker
+@setup.brokers([], 'master', [], False, False)
+def t30(HOME, r):
+    pretty = '%s t30' % __file__
+    print(pretty)
+
+    path = os.path.join(HOME.path, 'trace')
+    r.start_recording(path)
+    c1 = RemoteBroker(r.address, 5, None, HOME.path)
+    h1 = c1.get({'type':'handset', 'pretty':'mary'})
+    try:
+        RemoteBroker(r.address, 5, None, HOME.path).get(
+            {'type':'handset', 'pretty':'mary'}
+        )
+        print('FAIL %s: could allocate busy handset' % pretty)
+        return False
+    except Busy:
+        pass
+    c1.yield_resources(h1)
+    c2 = RemoteBroker(r.address, 5, None, HOME.path)
+    c2.get({'type':'handset'}, {'type':'relay'})
+    del c1, c2
+    time.sleep(0.5) # let the broker see the disconnects
+    r.stop_recording()
+
+    events = [e[0] for e in load_trace(path)]
+    expected = [
+        'stacks', 'equipment', 'get', 'get', 'close', 'yield', 'get', 'close',
+        'close'
+    ]
+    if events != expected:
+        print('FAIL %s: wrong events: %s' % (pretty, events))
+        return False
+
+    for kind in ['local', 'share']:
+        report = replay.replay(path, kind, HOME.path)
+        if (report['gets'], report['allocated'], report['busy']) != (3, 2, 1):
+            print('FAIL %s: wrong %s report: %s' % (pretty, kind, report))
+            return False
+        if not 0 < report['utilisation'] < 1:
+            print('FAIL %s: wrong utilisation: %s' % (pretty, report))
+            return False
+        if report['p99'] < report['p50']:
+            print('FAIL %s: wrong latencies: %s' % (pretty, report))
+            return False
+
+    return True
+
+# check that clients are given sessions that were started ahead of time and
+# that the pool of such sessions is refilled
+@setup.factory()
+def t31(factory):
+    pretty = '%s t31' % __file__
+    print(pretty)
+
+    factory.write_config('broker.json', json.dumps(
+        {'logging':False, 'pool_min':1, 'pool_max':2}
+    ))
+    r = factory.make_master('master')
+
+    def wait_spares(exclude):
+        limit = time.time() + 5
+        while time.time() < limit:
+            spares = [pid for pid in r.list_spares() if pid not in exclude]
+            if spares:
+                return spares
+            time.sleep(0.1)
+        return []
+
+    spares = wait_spares([])
+    if len(spares) != 1:
+        print('FAIL %s: pool not filled: %s' % (pretty, spares))
+        return False
+
+    # the client can talk to the spare session with its own key
+    c1 = RemoteBroker(r.address, 5, None, factory.HOME.path)
+    h1 = c1.get({'type':'handset'})
+    try:
+        h1.get_profile()
+    except Exception, e:
+        print('FAIL %s: could not use bound session: %s' % (pretty, e))
+        return False
+    if spares[0] in r.list_spares() or not psutil.pid_exists(spares[0]):
+        print('FAIL %s: spare not given to client: %s' % (pretty, spares))
+        return False
+    if not wait_spares(spares):
+        print('FAIL %s: pool not refilled' % pretty)
+        return False
+
+    # the session goes away with the client, like any other session
+    del h1, c1
+    limit = time.time() + 5
+    while psutil.pid_exists(spares[0]):
+        if time.time() > limit:
+            print('FAIL %s: bound session not terminated' % pretty)
+            return False
+        time.sleep(0.1)
+
+    return True
+
+# check that sessions can be served by a shared host process and that they are
+# closed independently of each other
+@setup.factory()
+def t32(factory):
+    pretty = '%s t32' % __file__
+    print(pretty)
+
+    factory.write_config('broker.json', json.dumps(
+        {'logging':False, 'session_hosts':1}
+    ))
+    r = factory.make_master('master')
+
+    c1 = RemoteBroker(r.address, 5, None, factory.HOME.path)
+    c2 = RemoteBroker(r.address, 5, None, factory.HOME.path)
+    h1 = c1.get({'type':'handset'})
+    h2, w2 = c2.get({'type':'handset'}, {'type':'workspace'})
+    if h1.address != h2.address:
+        print('FAIL %s: not hosted together: %s' % (pretty, h2.address))
+        return False
+    try:
+        h1.get_profile()
+        w2.get_profile()
+    except Exception, e:
+        print('FAIL %s: could not use hosted session: %s' % (pretty, e))
+        return False
+
+    # a client cannot reach the resources of another session in the host
+    try:
+        RemoteHandset(h1.address, c2.session.authkey, h1.profile).get_profile()
+        print('FAIL %s: reached resource of other session' % pretty)
+        return False
+    except Exception, e:
+        if 'no such resource' not in str(e):
+            print('FAIL %s: wrong exception: %s' % (pretty, e))
+            return False
+
+    # closing one session leaves the other one working
+    c1.yield_resources(h1)
+    del c1
+    time.sleep(0.5)
+    try:
+        h1.get_profile()
+        print('FAIL %s: closed session still usable' % pretty)
+        return False
+    except Exception:
+        pass
+    try:
+        h2.get_profile()
+    except Exception, e:
+        print('FAIL %s: remaining session broken: %s' % (pretty, e))
+        return False
+    allocations = r.list_allocations_all()
+    if len(allocations) != 2:
+        print('FAIL %s: wrong allocations: %s' % (pretty, allocations))
+        return False
+
+    return True
+
+# check that a broker that is restarted after a crash takes over the sessions
+# and allocations listed in the journal of the crashed broker
+@setup.factory()
+def t33(factory):
+    pretty = '%s t33' % __file__
+    print(pretty)
+
+    path = os.path.join(factory.HOME.path, 'journal')
+    factory.write_config('broker.json', json.dumps(
+        {'logging':False, 'journal':path}
+    ))
+    r1 = factory.make_master('master')
+    c1 = RemoteBroker(r1.address, 5, None, factory.HOME.path)
+    h1 = c1.get({'type':'handset'})
+    h1.get_profile() # connect to the session before the crash
+
+    if c1.session.authkey not in load_journal(path):
+        print('FAIL %s: allocation not journaled: %s' % (pretty, path))
+        return False
+
+    # crash the broker and start a new one on the same listening socket
+    os.kill(r1.get_pid(), signal.SIGKILL)
+    config = {'host':'', 'port':r1.address[1], 'remote':None}
+    r2 = factory.make_takeover('master', None, config, None)
+    limit = time.time() + 5
+    while True:
+        try:
+            allocations = r2.list_allocations_all()
+            break
+        except Exception, e:
+            if time.time() > limit:
+                print('FAIL %s: could not restart broker: %s' % (pretty, e))
+                return False
+            time.sleep(0.2)
+
+    try:
+        h1.get_profile()
+    except Exception, e:
+        print('FAIL %s: session did not survive the crash: %s' % (pretty, e))
+        return False
+    if allocations != [h1.profile]:
+        print('FAIL %s: allocation not recovered: %s' % (pretty, allocations))
+        return False
+    try:
+        RemoteBroker(r2.address, 5, None, factory.HOME.path).get(
+            {'type':'handset', 'serial':h1.profile['serial']}
+        )
+        print('FAIL %s: could allocate recovered handset' % pretty)
+        return False
+    except Busy:
+        pass
+
+    # the session ends when its client stops using it
+    del h1, c1
+    RemoteSession.pool.clear() # as if the client process had exited
+    limit = time.time() + 5
+    while r2.list_allocations_all():
+        if time.time() > limit:
+            print('FAIL %s: recovered allocation not released' % pretty)
+            return False
+        time.sleep(0.2)
+    if load_journal(path):
+        print('FAIL %s: journal not updated: %s' % (pretty,load_journal(path)))
+        return False
+
+    return True
+
+# check that a connection that was used to request resources is never given
+# back to the connection pool, even if the request bypassed RemoteBroker.get(),
+# while connections that only listed equipment are reused
+@setup.factory()
+def t34(factory):
+    pretty = '%s t34' % __file__
+    print(pretty)
+
+    r   = factory.make_master('master')
+    key = (tuple(r.address), None)
+
+    def count_pooled():
+        return len(RemoteBroker.pool.conns.get(key, []))
+
+    def count_available():
+        return len(r.list_available({'type':'handset'}))
+
+    c1 = RemoteBroker(r.address, 5, None, factory.HOME.path)
+    c1.list_handsets()
+    del c1
+    pooled = count_pooled()
+    if pooled < 1:
+        print('FAIL %s: listing connection not pooled' % pretty)
+        return False
+
+    available = count_available()
+    c2 = RemoteBroker(r.address, 5, None, factory.HOME.path)
+    try:
+        c2.pipeline().get({'type':'handset'}).result(5)
+    except Exception, e:
+        print('FAIL %s: pipelined allocation failed: %s' % (pretty, e))
+        return False
+    if count_available() != available - 1:
+        print('FAIL %s: handset not allocated' % pretty)
+        return False
+
+    del c2
+    if count_pooled() != pooled - 1:
+        print('FAIL %s: allocating connection pooled' % pretty)
+        return False
+    limit = time.time() + 5
+    while count_available() != available:
+        if time.time() > limit:
+            print('FAIL %s: allocation not freed' % pretty)
+            return False
+        time.sleep(0.1)
+
+    return True
+
+# check that the broker backs off after a spare session failed to start instead
+# of trying again on every iteration of its main loop
+@setup.factory()
+def t35(factory):
+    pretty = '%s t35' % __file__
+    print(pretty)
+
+    factory.write_config('broker.json', json.dumps(
+        {'logging':False, 'pool_min':1, 'pool_max':1}
+    ))
+
+    class FailingBroker(Broker):
+
+        def __init__(self, pipe, *vargs, **kwargs):
+            Broker.__init__(self, *vargs, **kwargs)
+            self.pipe = pipe
+
+        def close_fds(self, exclude):
+            exclude.append(self.pipe.w)
+            Broker.close_fds(self, exclude)
+
+        def start_session(self, authkey):
+            self.pipe.put('start')
+            return None # as if the session did not answer in time
+
+    pipe = Pipe()
+    sock, port = find_free_port()
+    broker = FailingBroker(
+        pipe, ('',port), sock, remote={}, authkeys={'admin':None},
+        hsl_paths=[], home=factory.HOME.path
+    )
+    broker.start()
+
+    attempts = 0
+    limit    = time.time() + 3
+    while time.time() < limit:
+        try:
+            pipe.get(timeout=max(0, limit - time.time()))
+            attempts += 1
+        except ConnectionTimeout:
+            break
+    broker.terminate()
+    broker.join()
+
+    if attempts != 1:
+        print('FAIL %s: wrong number of attempts: %d' % (pretty, attempts))
+        return False
+
+    return True
+
+# check that a waiting request for stacked equipment is not starved by lower
+# priority requests that take the pieces one at a time as they are released
+@setup.brokers([], 'master', [], True, False)
+def t36(HOME, r):
+    pretty = '%s t36' % __file__
+    print(pretty)
+
+    # handset 2 makes relay a collateral, so the stack of relay a and handset 1
+    # stays busy when handset 1 is released
+    holder1 = RemoteBroker(r.address, 5, None, HOME.path)
+    handset = holder1.get({'type':'handset', 'serial':'master-1'})
+    holder2 = RemoteBroker(r.address, 5, None, HOME.path)
+    blocker = holder2.get({'type':'handset', 'serial':'master-2'})
+
+    gating = RemoteBroker(r.address, 5, None, HOME.path)
+    high   = gating.submit(
+        'get', {'type':'relay', 'uid':'master-a'},
+        {'type':'handset', 'serial':'master-1'}, wait=10, priority='gating'
+    )
+    nightly = RemoteBroker(r.address, 5, None, HOME.path)
+    low     = nightly.submit(
+        'get', {'type':'handset', 'serial':'master-1'}, wait=10,
+        priority='nightly'
+    )
+    time.sleep(0.5)
+
+    # neither the waiting nightly request nor a fresh one gets handset 1
+    holder1.yield_resources(handset)
+    try:
+        low.result(0.5)
+        print('FAIL %s: waiting nightly request was served' % pretty)
+        return False
+    except ConnectionTimeout:
+        pass
+    try:
+        RemoteBroker(r.address, 5, None, HOME.path).get(
+            {'type':'handset', 'serial':'master-1'}
+        )
+        print('FAIL %s: fresh request got reserved handset' % pretty)
+        return False
+    except Busy:
+        pass
+
+    # equipment that the gating request does not need is still handed out
+    try:
+        other = RemoteBroker(r.address, 5, None, HOME.path)
+        other.get({'type':'handset', 'serial':'master-3'})
+    except Exception, e:
+        print('FAIL %s: unrelated request refused: %s' % (pretty, e))
+        return False
+
+    holder2.yield_resources(blocker)
+    try:
+        high.result(5)
+    except Exception, e:
+        print('FAIL %s: gating allocation failed: %s' % (pretty, e))
+        return False
+
+    return True
+
+# check that a slow call to a resource of a hosted session does not hold up the
+# other sessions in the same host
+@setup.factory()
+def t37(factory):
+    pretty = '%s t37' % __file__
+    print(pretty)
+
+    factory.write_config('broker.json', json.dumps(
+        {'logging':False, 'session_hosts':1}
+    ))
+    r = factory.make_master('master')
+
+    c1 = RemoteBroker(r.address, 5, None, factory.HOME.path)
+    c2 = RemoteBroker(r.address, 5, None, factory.HOME.path)
+    w1 = c1.get({'type':'workspace'})
+    w2 = c2.get({'type':'workspace'})
+    if w1.address != w2.address:
+        print('FAIL %s: not hosted together: %s' % (pretty, w2.address))
+        return False
+
+    # run a slow command in each session at the same time
+    errors = []
+    def run(w):
+        try:
+            w.run('sleep 2')
+        except Exception, e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(w,)) for w in [w1, w2]]
+    begin = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = time.time() - begin
+
+    if errors:
+        print('FAIL %s: slow call failed: %s' % (pretty, errors[0]))
+        return False
+    if duration > 3.5:
+        print('FAIL %s: calls were not concurrent: %f' % (pretty, duration))
+        return False
+
+    return True
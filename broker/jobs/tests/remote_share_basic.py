@@ -7,14 +7,16 @@ import json
 import traceback
 
 from ave.exceptions import AveException
+from ave.profile    import FrozenProfile
 
 from ave.network.connection import find_free_port
 from ave.network.control    import Control
 from ave.network.exceptions import ConnectionTimeout, ConnectionRefused
 from ave.broker._broker     import Broker, RemoteBroker
-from ave.broker.allocator   import LocalAllocator
+from ave.broker.allocator   import LocalAllocator, ShareAllocator
 from ave.broker.profile     import HandsetProfile
 from ave.broker.notifier    import RemoteNotifier
+from ave.broker.snapshot    import Snapshot, is_empty
 
 import setup
 # Convenience methods
@@ -1188,6 +1190,113 @@ def t22(factory):
 
     return True
 
+# check that equipment deltas turn one snapshot into another and that a share
+# allocator only applies deltas that follow the last status it received
+def t23():
+    pretty = '%s t23' % __file__
+    print(pretty)
+
+    handsets = setup.make_handsets('t23')
+    relays   = setup.make_relays('t23')
+    old = Snapshot(handsets[:2] + relays, {})
+    handsets[1]['power_state'] = 'offline'
+    new = Snapshot(handsets[1:], {0: [
+        {'profile': handsets[2], 'collateral': [relays[0]]}
+    ]})
+    delta = old.diff(new)
+    if (len(delta['added']) != 1 or len(delta['changed']) != 1
+    or  len(delta['removed']) != 3 or len(delta['allocated']) != 1):
+        print('FAIL %s: wrong delta: %s' % (pretty, delta))
+        return False
+    patched = old.copy()
+    patched.patch(json.loads(json.dumps(delta)))
+    if not is_empty(patched.diff(new)) or is_empty(old.diff(patched)):
+        print('FAIL %s: wrong patch: %s' % (pretty, patched.diff(new)))
+        return False
+
+    allocator = ShareAllocator(('t23', 1))
+    if allocator.apply_delta(0, 1, delta):
+        print('FAIL %s: delta applied without full status' % pretty)
+        return False
+    allocator.set_equipment(old.list_equipment(), {}, 1)
+    if allocator.apply_delta(2, 3, delta):
+        print('FAIL %s: delta applied after a gap' % pretty)
+        return False
+    if not allocator.apply_delta(1, 2, json.loads(json.dumps(delta))):
+        print('FAIL %s: delta not applied' % pretty)
+        return False
+    equipment = allocator.list_equipment({'type':'handset'})
+    if (sorted([e['serial'] for e in equipment]) != ['t23-2', 't23-3']
+    or  allocator.list_equipment({'power_state':'offline'}) != [handsets[1]]
+    or  allocator.list_allocations(None) != [handsets[2]]
+    or  allocator.collateral != {relays[0]: [0]}):
+        print('FAIL %s: wrong status: %s' % (pretty, equipment))
+        return False
+
+    # the share releases the handset. it is listed again by the master
+    allocator.allocate(handsets[1], 'session', [])
+    allocator.yield_resource('session', handsets[1])
+    if allocator.list_equipment({'serial':'t23-2'}):
+        print('FAIL %s: yielded handset listed' % pretty)
+        return False
+    allocator.apply_delta(2, 3, new.diff(Snapshot(handsets[1:], {})))
+    if (allocator.list_equipment({'serial':'t23-2'}) != [handsets[1]]
+    or  allocator.list_allocations(None) != []
+    or  allocator.collateral != {relays[0]: []}):
+        print('FAIL %s: wrong status after release' % pretty)
+        return False
+
+    return True
+
+# check that a burst of changes results in a single notification and that
+# notifications are not given more often than the configured rate allows
+@setup.factory()
+def t24(factory):
+    pretty = '%s t24' % __file__
+    print(pretty)
+
+    factory.write_config('broker.json', json.dumps(
+        {'logging':False, 'share_delay':0.3, 'share_rate':1}
+    ))
+    class Recorder(object): # stands in for the notifier process
+        def __init__(self):
+            self.calls = []
+        def set_equipment(self, *vargs, **kwargs):
+            self.calls.append('set_equipment')
+        def update_equipment(self, *vargs, **kwargs):
+            self.calls.append('update_equipment')
+
+    sock, port = find_free_port()
+    broker = Broker(('',port), sock, home=factory.HOME.path)
+    broker.make_allocators()
+    recorder = Recorder()
+    broker.notifier = (None, recorder)
+
+    handsets = setup.make_handsets('t24')
+    for h in handsets:
+        broker.allocators['local'].add_equipment([h])
+        broker.update_sharing()
+    if recorder.calls:
+        print('FAIL %s: notified during burst: %s' % (pretty, recorder.calls))
+        return False
+    time.sleep(0.4)
+    broker.update_sharing()
+    if recorder.calls != ['set_equipment']:
+        print('FAIL %s: wrong notification: %s' % (pretty, recorder.calls))
+        return False
+
+    broker.allocators['local'].remove_equipment(handsets[0])
+    broker.update_sharing()
+    if not 0.9 < broker.share_due - broker.shared_at < 1.1:
+        print('FAIL %s: rate not limited: %s' % (pretty, broker.share_due))
+        return False
+    broker.flush_sharing()
+    if recorder.calls != ['set_equipment', 'update_equipment']:
+        print('FAIL %s: wrong notification: %s' % (pretty, recorder.calls))
+        return False
+
+    return True
+
 # does the notifier keep track of its internal delta correctly if a sharing
 # broker adds/removes equipment and workspaces before it can report everything
 # to a remote master?
@@ -1203,3 +1312,54 @@ def t22(factory):
 
 # should there be a whole sub-suite about yielding? low priority for now as
 # test jobs are not supposed to yield explicitly anyway
+
+# check that frozen profiles are shared between equal contents, cannot be
+# modified and that snapshots of unchanged equipment share them
+def t25():
+    pretty = '%s t25' % __file__
+    print(pretty)
+
+    handset = setup.make_handsets('t25')[0]
+    handset['tags'] = ['a', 'b']
+    frozen  = FrozenProfile(handset)
+    if FrozenProfile(json.loads(json.dumps(handset))) is not frozen:
+        print('FAIL %s: equal profiles not shared' % pretty)
+        return False
+    # values that compare equal but have different types are kept apart, also
+    # when nested, as snapshots compare frozen profiles by identity
+    pairs = [(1, True), (0, False), (1, 1.0), ([1], [True]), ({'a':0}, {'a':0L})]
+    for a, b in pairs:
+        if FrozenProfile({'x':a}) is FrozenProfile({'x':b}):
+            print('FAIL %s: %r and %r share a profile' % (pretty, a, b))
+            return False
+        if type(FrozenProfile({'x':b})['x']) != type(b):
+            print('FAIL %s: wrong type of %r' % (pretty, b))
+            return False
+    if frozen != handset or not (handset == frozen) or frozen != dict(frozen):
+        print('FAIL %s: wrong equality: %s' % (pretty, frozen))
+        return False
+    try:
+        frozen['power_state'] = 'offline'
+        print('FAIL %s: frozen profile was modified' % pretty)
+        return False
+    except TypeError:
+        pass
+    frozen['tags'].append('c') # only modifies a copy
+    if frozen['tags'] != ['a', 'b'] or frozen.thaw() != handset:
+        print('FAIL %s: frozen value was modified' % pretty)
+        return False
+    if not frozen.match({'tags':['a', 'b']}) or frozen.match({'serial':'x'}):
+        print('FAIL %s: wrong match' % pretty)
+        return False
+
+    old = Snapshot([handset], {})
+    new = Snapshot([handset], {})
+    if new.equipment.values()[0] is not old.equipment.values()[0]:
+        print('FAIL %s: snapshots do not share profiles' % pretty)
+        return False
+    handset['power_state'] = 'offline'
+    if len(old.diff(Snapshot([handset], {}))['changed']) != 1:
+        print('FAIL %s: change not seen' % pretty)
+        return False
+
+    return True
@@ -150,8 +150,8 @@ class MockLocalAllocator(LocalAllocator):
         LocalAllocator.__init__(self, home, ws_cfg)
         self._handsets = handsets
         self._relays = relays
-        self.equipment.extend(handsets)
-        self.equipment.extend(relays)
+        for profile in handsets + relays:
+            self.append_equipment(profile)
 
     def deallocate_relay(self, resource):
         pass # superclass tries to tell a relay server to close the relay on
@@ -197,6 +197,7 @@ class MockBroker(Broker):
                 if e['serial'] == serial:
                     serial_found = True
                     e['power_state'] = power_state
+                    self.allocators['local'].reindex_equipment(e)
                     self.update_sharing()
                     break
         return serial_found
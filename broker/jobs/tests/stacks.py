@@ -10,6 +10,8 @@ from ave.broker.profile     import *
 from ave.workspace          import Workspace
 from ave.broker._broker     import RemoteBroker
 from ave.broker.session     import RemoteSession
+from ave.broker.allocator   import Allocator, match_profiles
+from ave.broker.exceptions  import Busy
 from ave.network.connection import find_free_port
 
 import setup
@@ -490,3 +492,135 @@ def t16(HOME, b):
         return False
 
     return True
+
+# check that collateral is found through the stack membership map and that
+# stacks with allocated members are not considered for complex allocations
+def t17():
+    pretty = '%s t17' % __file__
+    print(pretty)
+
+    allocator = Allocator()
+    for profile in setup.make_handsets('t17') + setup.make_relays('t17'):
+        allocator.append_equipment(profile)
+    allocator.set_stacks(setup.make_stacks('t17', 'clean'))
+
+    h1 = HandsetProfile({'type':'handset', 'serial':'t17-1'})
+    ra = RelayProfile({'type':'relay', 'uid':'t17-a'})
+    rb = RelayProfile({'type':'relay', 'uid':'t17-b'})
+    collateral = allocator.find_collateral([h1])
+    if collateral != [ra]:
+        print('FAIL %s: wrong collateral: %s' % (pretty, collateral))
+        return False
+
+    wanted = [{'type':'handset'}, {'type':'relay'}]
+    wanted = [profile_factory(p) for p in wanted]
+    intended, collateral = allocator.complex_allocation(wanted, None)
+    if rb in intended or ra not in intended:
+        print('FAIL %s: wrong first allocation: %s' % (pretty, intended))
+        return False
+    for resource in intended:
+        allocator.allocate(resource, 'session', collateral)
+    if allocator.stack_busy != [2, 0]:
+        print('FAIL %s: wrong counters: %s' % (pretty, allocator.stack_busy))
+        return False
+
+    intended, collateral = allocator.complex_allocation(wanted, None)
+    if rb not in intended:
+        print('FAIL %s: wrong second allocation: %s' % (pretty, intended))
+        return False
+    for resource in intended:
+        allocator.allocate(resource, 'session', collateral)
+    try:
+        allocator.complex_allocation(wanted, None)
+        print('FAIL %s: third allocation did not fail' % pretty)
+        return False
+    except Busy:
+        pass
+
+    allocator.deallocate(ra)
+    if allocator.stack_busy != [1, 2]:
+        print('FAIL %s: wrong counters: %s' % (pretty, allocator.stack_busy))
+        return False
+
+    return True
+
+# check that the allocations of each session are tracked through allocation,
+# deallocation and closing of sessions
+def t18():
+    pretty = '%s t18' % __file__
+    print(pretty)
+
+    allocator = Allocator()
+    handsets  = setup.make_handsets('t18')
+    relays    = setup.make_relays('t18')
+    for profile in handsets + relays:
+        allocator.append_equipment(profile)
+    allocator.set_stacks(setup.make_stacks('t18', 'clean'))
+
+    allocator.allocate(handsets[0], 'a', [relays[0]])
+    allocator.allocate(handsets[2], 'a', [])
+    allocator.allocate(handsets[1], 'b', [relays[1]])
+
+    if allocator.list_allocations('a') != [handsets[0], handsets[2]]:
+        print('FAIL %s: wrong allocations: %s' % (pretty, allocator.owned))
+        return False
+    if allocator.list_collateral('b') != [relays[1]]:
+        print('FAIL %s: wrong collateral: %s' % (pretty, allocator.owned))
+        return False
+    if len(allocator.list_allocations(None)) != 3:
+        print('FAIL %s: wrong total: %s' % (pretty, allocator.allocations))
+        return False
+
+    allocator.deallocate(handsets[2])
+    release, collateral = allocator.close_session((None, 'a'))
+    if release != [handsets[0]] or collateral != [relays[0]]:
+        print('FAIL %s: wrong release: %s %s' % (pretty, release, collateral))
+        return False
+    if allocator.owned != {'b': [handsets[1]]}:
+        print('FAIL %s: wrong index: %s' % (pretty, allocator.owned))
+        return False
+    if allocator.close_session((None, 'c')) != ([], []):
+        print('FAIL %s: released resources of other sessions' % pretty)
+        return False
+
+    return True
+
+# check that overlapping profiles are paired with stacked equipment even when
+# a greedy choice would block the pairing, and that simple allocations prefer
+# equipment that is not stacked
+def t19():
+    pretty = '%s t19' % __file__
+    print(pretty)
+
+    allocator = Allocator()
+    handsets  = setup.make_handsets('t19')
+    for profile in handsets + setup.make_relays('t19'):
+        allocator.append_equipment(profile)
+    allocator.set_stacks(setup.make_stacks('t19', 'multi-messy'))
+
+    # the generic profile also matches the handset wanted by the specific one
+    wanted = [{'type':'handset'}, {'type':'handset', 'pretty':'mary'}]
+    wanted = [profile_factory(p) for p in wanted]
+    if match_profiles(wanted, handsets[:2]) != [1, 0]:
+        print('FAIL %s: wrong pairing' % pretty)
+        return False
+    if match_profiles(wanted + wanted[:1], handsets[:2]) != None:
+        print('FAIL %s: impossible pairing found' % pretty)
+        return False
+    try:
+        intended, collateral = allocator.complex_allocation(wanted, None)
+    except Busy, e:
+        print('FAIL %s: complex allocation failed: %s' % (pretty, e))
+        return False
+    chosen = allocator.assign_profiles(wanted, intended)
+    if [intended[i]['pretty'] for i in chosen] != ['jane', 'mary']:
+        print('FAIL %s: wrong assignment: %s' % (pretty, intended))
+        return False
+
+    # handset 3 is the only one that is not stacked
+    intended, collateral = allocator.simple_allocation(wanted[:1])
+    if intended != [handsets[2]] or collateral != []:
+        print('FAIL %s: stacked handset used: %s' % (pretty, intended))
+        return False
+
+    return True
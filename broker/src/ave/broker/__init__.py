@@ -3,3 +3,4 @@
 
 from ave.broker._broker import RemoteBroker as Broker
 
+from ave.broker._broker import AsyncRemoteBroker as AsyncBroker
@@ -18,12 +18,15 @@ import ave.config
 import ave.broker.profile
 
 from ave.broker.session       import Session, RemoteSession, AdoptedSession
+from ave.broker.session       import SessionHost, HostedSession
+from ave.broker.session       import AsyncRemoteSession
 from ave.broker.resource      import *
 from ave.broker.profile       import *
 from ave.handset.lister       import HandsetLister
 from ave.network.exceptions   import *
 from ave.network.connection   import find_free_port
 from ave.network.control      import Control, RemoteControl
+from ave.network.reactor      import AsyncRemoteControl, Future
 from ave.network.fdtx         import FdTx, Errno
 from ave.workspace            import Workspace
 
@@ -32,8 +35,14 @@ from constants         import *
 from exceptions        import *
 from allocator         import LocalAllocator, ShareAllocator
 from notifier          import Notifier, RemoteNotifier
+from snapshot          import Snapshot
+from recorder          import Recorder
+from journal           import Journal, load_journal
 
 AUTHKEY_LENGTH = 16
+POOL_DECAY     = 60 # seconds without a pool miss before the pool shrinks
+POOL_RETRY     = 5  # seconds to wait after a spare session failed to start
+ORPHAN_GRACE   = 60 # seconds a session waits for adoption after a crash
 
 def rand_authkey():
     result = []
@@ -78,11 +87,48 @@ def validate_configuration(config):
         config['stacks'] = []
     if not 'remote' in config:
         config['remote'] = None # TODO: default to broker.sonyericsson.net
+    if not 'aging' in config:
+        config['aging'] = 300
+    if not 'share_delay' in config:
+        config['share_delay'] = 0
+    if not 'share_rate' in config:
+        config['share_rate'] = 0 # no limit
+    if not 'record' in config:
+        config['record'] = None
+    if not 'pool_min' in config:
+        config['pool_min'] = 0
+    if not 'pool_max' in config:
+        config['pool_max'] = config['pool_min']
+    if not 'session_hosts' in config:
+        config['session_hosts'] = 0 # one process per session
+    if not 'journal' in config:
+        config['journal'] = None
 
     if not type(config['host']) in [str, unicode]:
         complain_format('host', '{"host":<string>}', config['host'])
     if not type(config['port']) == int:
         complain_format('port', '{"port":<integer>}', config['port'])
+    if type(config['aging']) not in [int, float] or config['aging'] < 0:
+        complain_format('aging', '{"aging":<seconds>}', config['aging'])
+    for attribute, format in [
+        ('share_delay', '{"share_delay":<seconds>}'),
+        ('share_rate',  '{"share_rate":<notifications per second>}')
+    ]:
+        value = config[attribute]
+        if type(value) not in [int, float] or value < 0:
+            complain_format(attribute, format, value)
+    if config['record'] and type(config['record']) not in [str, unicode]:
+        complain_format('record', '{"record":<path>}', config['record'])
+    if config['journal'] and type(config['journal']) not in [str, unicode]:
+        complain_format('journal', '{"journal":<path>}', config['journal'])
+    for attribute in ['pool_min', 'pool_max', 'session_hosts']:
+        value = config[attribute]
+        if type(value) != int or value < 0:
+            complain_format(attribute, '{"%s":<integer>}' % attribute, value)
+    if config['pool_max'] < config['pool_min']:
+        raise Exception(
+            'broker configuration: pool_max must not be less than pool_min'
+        )
 
     stack_complaint = (
         '{"stacks":[<stack>, ...]}, where <stack> is a list that contains '
@@ -158,7 +204,8 @@ def validate_serialized(serialized):
             'allocations': [
                 { 'profile': <profile>, 'collateral': [<profile>, ...] },
                 ...
-            ]
+            ],
+            'hosted': <boolean> # optional. True if served by a SessionHost
         }
     }
     '''
@@ -209,14 +256,68 @@ def validate_serialized(serialized):
                 'collateral': checked
             }
 
+        hosted = details.get('hosted', False)
+        if type(hosted) != bool:
+            raise Exception('"hosted" detail is not a boolean: %s' % details)
+
         validated[authkey] = {
             'pid': pid,
             'address': address,
-            'allocations': allocations
+            'allocations': allocations,
+            'hosted': hosted
         }
 
     return validated
 
+# named priority classes of allocation requests. plain integers may be used too
+PRIORITIES = {
+    'nightly': 0,
+    'normal' : 1,
+    'gating' : 2
+}
+
+def validate_priority(priority):
+    if type(priority) in [str, unicode] and priority in PRIORITIES:
+        return PRIORITIES[priority]
+    if type(priority) == int:
+        return priority
+    raise Exception(
+        'priority must be an integer or one of %s' % sorted(PRIORITIES.keys())
+    )
+
+class Waiter(object):
+    # an allocation request that waits for busy equipment to be released
+    def __init__(self, session, profiles, reply, error, wait, priority=1):
+        self.session  = session  # RemoteSession
+        self.profiles = profiles
+        self.reply    = reply    # ave.network.control.Reply
+        self.error    = error    # raised to the client if the wait times out
+        self.priority = priority
+        self.arrival  = time.time()
+        self.deadline = self.arrival + wait
+
+    def rank(self, now, aging):
+        # the priority grows by one for every 'aging' seconds spent waiting so
+        # that a flood of high priority requests cannot starve the others
+        if not aging:
+            return self.priority
+        return self.priority + (now - self.arrival) / float(aging)
+
+    def overlaps(self, profiles):
+        # true if some equipment could match both one of the profiles and one
+        # of the profiles of this request. that is the case unless they differ
+        # in type or disagree on a property that both name. workspaces are made
+        # on demand and are never in short supply
+        for p in profiles:
+            if p['type'] == 'workspace':
+                continue
+            for q in self.profiles:
+                if p['type'] != q['type']:
+                    continue
+                if not [k for k in p if k in q and p[k] != q[k]]:
+                    return True
+        return False
+
 class Broker(Control):
 
     def __init__(
@@ -254,7 +355,17 @@ class Broker(Control):
             proc_name='ave-broker', logging=config['logging']
         )
         self.config     = config
+        self.period     = self.interval # milliseconds between idle calls
         self.sessions   = {} # authkey -> (Session, RemoteSession)
+        self.spares     = [] # (Session, RemoteSession) not yet given to clients
+        self.pool_size  = config['pool_min'] # number of spares to keep
+        if config['session_hosts']:
+            self.pool_size = 0 # hosted sessions are cheap to open anyway
+        self.pool_miss  = 0  # when a client last had to wait for a new session
+        self.pool_retry = 0  # no spares are started before this time
+        self.hosts      = [] # (SessionHost, RemoteControl) serving sessions
+        self.waiting    = [] # Waiter objects in order of arrival
+        self.aging      = config['aging'] # seconds per priority level gained
         # support mockable workspace configurations:
         if not ws_cfg:
             ws_cfg_path = Workspace.default_cfg_path(home)
@@ -262,6 +373,11 @@ class Broker(Control):
         self.ws_cfg     = ws_cfg
         self.shares     = {} # Connection -> address
         self.notifier   = None
+        self.shared     = None # Snapshot last given to the notifier
+        self.shared_at  = 0    # when self.shared was given to the notifier
+        self.share_due  = None # when to give pending changes to the notifier
+        self.recorder   = None # Recorder of allocation traffic
+        self.journal    = None # Journal of sessions with allocations
         self.hsl        = None
         self.brl        = None # Beryllium Rig Lister
         self.wlan_lister= None
@@ -396,29 +512,64 @@ class Broker(Control):
             address = tuple(self.adoption[authkey]['address'])
             # represent the adopted session by an AdoptedSession instance that
             # only implements .pid and .terminate()
-            local   = AdoptedSession(pid)
             sock    = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
             remote  = RemoteSession(address, authkey, timeout=1, sock=sock)
-            self.add_connection(remote._connection, authkey)
-            self.sessions[authkey] = (local, remote)
-
-            # recreate the allocation records
+            if self.adoption[authkey]['hosted']:
+                local = HostedSession(pid, remote) # don't kill the host
+            else:
+                local = AdoptedSession(pid)
             alloc   = self.adoption[authkey]['allocations']
-            for a in alloc:
-                resource   = a['profile']
-                collateral = a['collateral']
-                self.allocators['local'].allocate(resource, remote, collateral)
+            self.adopt_session(authkey, local, remote, alloc)
+
+    def adopt_session(self, authkey, local, remote, allocations):
+        self.add_connection(remote._connection, authkey)
+        self.sessions[authkey] = (local, remote)
+        # recreate the allocation records
+        for a in allocations:
+            resource   = a['profile']
+            collateral = a['collateral']
+            self.allocators['local'].allocate(resource, remote, collateral)
+
+    def recover_sessions(self):
+        # sessions that outlived a crashed broker are listed in its journal.
+        # reconnect to those that are still running and take them over
+        try:
+            state = validate_serialized(load_journal(self.config['journal']))
+        except Exception, e:
+            self.log('WARNING: could not load journal: %s' % e)
+            return
+        for authkey in state:
+            details = state[authkey]
+            if details['hosted']:
+                continue # session hosts do not outlive the broker
+            remote = RemoteSession(details['address'], authkey, timeout=1)
+            try:
+                remote.connect(1)
+                remote.set_broker()
+            except Exception, e:
+                continue # the session ended while there was no broker
+            local  = AdoptedSession(details['pid'])
+            self.adopt_session(authkey, local, remote, details['allocations'])
 
     def initialize(self):
         Control.initialize(self)
+        # a broker that was forked from the same parent as a crashed broker
+        # must not hand out the same authkeys as those in its journal
+        random.seed()
         self.make_handset_lister()
         self.make_beryllium_lister()
         self.make_wlan_lister()
         self.make_pm_lister()
         self.make_allocators()
         self.adopt_sessions()
+        if self.config['journal']:
+            if not self.adoption:
+                self.recover_sessions()
+            self.start_journal()
         if self.is_sharing():
             self.start_sharing()
+        if self.config['record']:
+            self.start_recording(self.config['record'])
 
     def stop_listers(self):
         if self.hsl:
@@ -457,7 +608,11 @@ class Broker(Control):
         if self.pm_lister:
             self.pm_lister.terminate()
         self.stop_sharing()
-        for session in self.sessions.values():
+        self.stop_recording()
+        if self.journal:
+            self.journal.compact({}) # all sessions are terminated below
+            self.stop_journal()
+        for session in self.sessions.values() + self.spares + self.hosts:
             try:
                 # send SIGTERM, not SIGKILL, so that Session.shutdown() runs
                 session[LOCAL].terminate()
@@ -472,25 +627,143 @@ class Broker(Control):
             raise Exception('session closed')
         return self.sessions[authkey][REMOTE]
 
-    def new_session(self, authkey):
-        if authkey in self.sessions:
-            raise Exception('INTERNAL ERROR: session already added for authkey')
+    def start_session(self, authkey):
         sock, port = find_free_port()
+        grace      = ORPHAN_GRACE if self.config['journal'] else 0
         session    = Session(
             port, authkey, self.address, sock, self.ws_cfg, self.home,
-            self.config['logging']
+            self.config['logging'], grace
         )
         session.start() # new process!
         self.join_later(session)
         remote     = RemoteSession((self.address[0], port), authkey)
-        # connect to the new session and add the connection to event tracking
+        # connect to the new session. the caller adds the connection to event
+        # tracking
         try:
-            self.add_connection(remote.connect(5), authkey)
+            remote.connect(5)
+            if grace:
+                remote.set_broker() # lets the session notice a broker crash
         except Exception, e:
             print('ERROR: could not connect to new session: %s' % str(e))
             session.kill(signal.SIGKILL) # not much else to do
+            return None
+        return (session, remote)
+
+    def new_session(self, authkey):
+        if authkey in self.sessions:
+            raise Exception('INTERNAL ERROR: session already added for authkey')
+        if self.config['session_hosts']:
+            session = self.host_session(authkey)
+        else:
+            session = self.take_spare(authkey)
+            if session:
+                self.sessions[authkey] = session
+                return
+            session = self.start_session(authkey)
+        if not session:
             return
-        self.sessions[authkey] = (session, remote)
+        self.add_connection(session[REMOTE]._connection, authkey)
+        self.sessions[authkey] = session
+
+    ### SESSION HOSTS ##########################################################
+
+    def start_host(self):
+        sock, port = find_free_port()
+        authkey    = rand_authkey()
+        host       = SessionHost(
+            port, authkey, self.address, sock, self.ws_cfg, self.home,
+            self.config['logging']
+        )
+        host.start() # new process!
+        self.join_later(host)
+        remote     = RemoteControl((self.address[0], port), authkey, 5, False)
+        try:
+            remote.connect(5)
+        except Exception, e:
+            print('ERROR: could not connect to new session host: %s' % str(e))
+            host.kill(signal.SIGKILL) # not much else to do
+            return None
+        return (host, remote)
+
+    def pick_host(self):
+        # start hosts on demand, up to the configured number. then use the one
+        # that serves the fewest sessions
+        if len(self.hosts) < self.config['session_hosts']:
+            host = self.start_host()
+            if host:
+                self.hosts.append(host)
+        if not self.hosts:
+            return None
+        load = dict([(h[LOCAL].pid, 0) for h in self.hosts])
+        for session in self.sessions.values():
+            if session[LOCAL].pid in load:
+                load[session[LOCAL].pid] += 1
+        return min(self.hosts, key=lambda h: load[h[LOCAL].pid])
+
+    def host_session(self, authkey):
+        host = self.pick_host()
+        if not host:
+            return None
+        remote = RemoteSession((self.address[0], host[REMOTE].port), authkey)
+        try:
+            host[REMOTE].open_session(authkey)
+            remote.connect(5)
+        except Exception, e:
+            print('ERROR: could not open hosted session: %s' % str(e))
+            return None
+        return (HostedSession(host[LOCAL].pid, remote), remote)
+
+    ### SESSION POOL ###########################################################
+
+    def take_spare(self, authkey):
+        while self.spares:
+            session = self.spares.pop(0)
+            try:
+                session[REMOTE].set_authkey(authkey)
+            except Exception, e:
+                self.log('WARNING: could not bind spare session: %s' % e)
+                self.drop_spare(session)
+                continue
+            session[REMOTE].authkey = authkey
+            self.set_connection_authkey(session[REMOTE]._connection, authkey)
+            return session
+        if self.config['pool_max']:
+            # keep more spares around for as long as clients keep coming
+            self.pool_size = min(self.pool_size + 1, self.config['pool_max'])
+            self.pool_miss = time.time()
+        return None
+
+    def drop_spare(self, session):
+        self.remove_connection(session[REMOTE]._connection)
+        try:
+            session[LOCAL].terminate()
+        except OSError, e:
+            if e.errno not in [errno.ECHILD, errno.ESRCH]:
+                raise Exception('unhandled errno: %d' % e.errno)
+
+    def fill_pool(self):
+        if (self.pool_size > self.config['pool_min']
+        and time.time() - self.pool_miss > POOL_DECAY):
+            self.pool_size -= 1
+            self.pool_miss  = time.time()
+        while len(self.spares) > self.pool_size:
+            self.drop_spare(self.spares.pop())
+        # start one session at a time so that clients are served in between
+        if self.spare_due():
+            # the spare is bound to a client key later. until then it accepts
+            # a random key that is only known by the broker
+            session = self.start_session(rand_authkey())
+            if session:
+                self.add_connection(session[REMOTE]._connection, None)
+                self.spares.append(session)
+            else:
+                # back off instead of forking again on every iteration of the
+                # main loop while whatever broke the last attempt persists
+                self.pool_retry = time.time() + POOL_RETRY
+
+    def spare_due(self):
+        return (len(self.spares) < self.pool_size and self.allocating
+            and time.time() >= self.pool_retry)
 
     # override callback defined by Control class
     def new_connection(self, connection, authkey):
@@ -507,6 +780,10 @@ class Broker(Control):
             del self.allocators[self.shares[connection]]
             del self.shares[connection]
             return
+        for session in self.spares:
+            if session[REMOTE]._connection == connection:
+                self.spares.remove(session)
+                return
 
         # if the connection's .authkey is found in the session list, then kill
         # off the entire session and reclaim all associated resources.
@@ -516,6 +793,8 @@ class Broker(Control):
             self.close_session(authkey)
 
     def joined_process(self, pid, exit):
+        # the sessions of a dead host are closed as their connections are lost
+        self.hosts = [h for h in self.hosts if h[LOCAL].pid != pid]
         if self.notifier and pid == self.notifier[LOCAL].pid:
             # notifier died, possibly because the remote master dropped all
             # shares. what to do? just start a new one and hope the master
@@ -559,6 +838,7 @@ class Broker(Control):
         self.join_later(notifier)
         remote = RemoteNotifier(('',port))
         self.notifier = (notifier, remote)
+        self.shared   = None # the new notifier needs the full status
         try:
             remote.connect(1)
         except Exception, e:
@@ -584,7 +864,7 @@ class Broker(Control):
                 self.log(e.format_trace())
             self.restart_sharing()
             return None
-        self.update_sharing()
+        self.flush_sharing()
         return ('', port) # mostly useful to have in test cases
 
     @Control.rpc
@@ -644,6 +924,51 @@ class Broker(Control):
         proc[LOCAL].kill(signal.SIGKILL) # make sure it's really dead ...
         del proc
 
+    @Control.rpc
+    @Control.preauth('admin')
+    def start_recording(self, path):
+        if self.recorder:
+            self.stop_recording()
+        self.log('start recording: %s' % path)
+        self.recorder = Recorder(path)
+        self.record('stacks', self.list_stacks())
+        self.record('equipment', self.list_equipment())
+
+    @Control.rpc
+    @Control.preauth('admin')
+    def stop_recording(self):
+        if not self.recorder:
+            return
+        self.log('stop recording')
+        self.recorder.close()
+        self.recorder = None
+
+    def record(self, event, *fields):
+        if self.recorder:
+            self.recorder.record(event, *fields)
+
+    ### JOURNAL ################################################################
+
+    def start_journal(self):
+        try:
+            self.journal = Journal(self.config['journal'], self.serialize())
+        except Exception, e:
+            self.log('WARNING: could not start journal: %s' % e)
+
+    def stop_journal(self):
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+    def journal_session(self, event, session):
+        if not self.journal or session.authkey not in self.sessions:
+            return
+        allocations = self.allocators['local'].serialize_session(session)
+        details     = self.describe_session(session.authkey, allocations)
+        self.journal.update(event, session.authkey, details)
+        if self.journal.is_due():
+            self.journal.compact(self.serialize())
+
     @Control.rpc
     @Control.preauth('share')
     @share_handler
@@ -675,6 +1000,7 @@ class Broker(Control):
             % (str(address), json.dumps(stacks, indent=4))
         )
         self.allocators[address].set_stacks(stacks)
+        self.record('stacks', self.list_stacks())
 
     @Control.rpc
     @Control.preauth('share')
@@ -689,24 +1015,65 @@ class Broker(Control):
             )
         self.log('lister added:\n%s' % json.dumps(profiles, indent=4))
         self.allocators[address].add_equipment(profiles)
+        self.record('add_equipment', profiles)
         # if sharing - update master as well
         if self.is_sharing():
             self.update_sharing()
+        self.retry_waiting()
 
     @Control.rpc
     @Control.preauth('share')
     @share_handler
-    def set_equipment(self, address, equipment, allocations):
+    def set_equipment(self, address, equipment, allocations, version=None):
         self.log(
             'got equipment from %s:\n%s'
             % (str(address), json.dumps(equipment, indent=4))
         )
-        self.allocators[address].set_equipment(equipment, allocations)
+        self.allocators[address].set_equipment(equipment, allocations, version)
+        self.record('add_equipment', equipment)
         # if sharing - update master as well
         if self.is_sharing():
             self.update_sharing()
+        self.retry_waiting()
+
+    @Control.rpc
+    @Control.preauth('share')
+    @share_handler
+    def update_equipment(self, address, base, version, delta):
+        # returns False if the share has to send its full status instead. e.g.
+        # because an update was lost or this broker restarted
+        if not self.allocators[address].apply_delta(base, version, delta):
+            return False
+        self.log(
+            'got equipment delta from %s:\n%s'
+            % (str(address), json.dumps(delta, indent=4))
+        )
+        if delta['added'] or delta['changed']:
+            self.record('add_equipment', delta['added'] + delta['changed'])
+        if delta['removed']:
+            self.record('remove_equipment', delta['removed'])
+        if self.is_sharing():
+            self.update_sharing()
+        self.retry_waiting()
+        return True
 
     def update_sharing(self):
+        if self.notifier == None:
+            return
+        # collect changes for a while before notifying, so that a burst of
+        # changes results in a single notification. also limit the rate
+        if self.share_due == None:
+            self.share_due = time.time() + self.config['share_delay']
+            if self.config['share_rate']:
+                self.share_due = max(
+                    self.share_due,
+                    self.shared_at + 1.0 / self.config['share_rate']
+                )
+        if self.share_due <= time.time():
+            self.flush_sharing()
+
+    def flush_sharing(self):
+        self.share_due = None
         if self.notifier == None:
             return
         total_equipment = []
@@ -719,12 +1086,23 @@ class Broker(Control):
             for al in allocations:
                 total_allocations[allocator_index] = allocations[al]
                 allocator_index += 1
+        # only pass on what changed since the last update, unless the notifier
+        # is new and has nothing to compare with
+        shared = Snapshot(total_equipment, total_allocations)
         try:
-            self.notifier[REMOTE].set_equipment(
-                total_equipment,
-                total_allocations,
-                __async__=True
-            )
+            if self.shared == None:
+                self.notifier[REMOTE].set_equipment(
+                    total_equipment,
+                    total_allocations,
+                    __async__=True
+                )
+            else:
+                # pass on empty deltas too. the master lists equipment that it
+                # withheld after a yield again when it hears from the share
+                delta = self.shared.diff(shared)
+                self.notifier[REMOTE].update_equipment(delta, __async__=True)
+            self.shared    = shared
+            self.shared_at = time.time()
         except Exception, e:
             self.log('ERROR: could not interact with notifier: %s' % e)
             self.log(''.join(traceback.format_stack()))
@@ -827,7 +1205,9 @@ class Broker(Control):
                     responses_map[key] = result
                     profiles_map.pop(key)
 
+        self.journal_session('allocate', session)
         if len(profiles_map.keys()) == 0:
+            self.record('get_multi', session, profiles, 'allocated')
             for key in sorted(responses_map.keys()):
                 responses.append(responses_map[key])
             return responses
@@ -839,6 +1219,10 @@ class Broker(Control):
                 responses_map[key]= result
                 profiles_map.pop(key)
         elif len(profiles_map.keys()) != 0:
+            if type(best_error) == Busy:
+                self.record('get_multi', session, profiles, 'busy')
+            else:
+                self.record('get_multi', session, profiles, 'nosuch')
             self.close_session(session.authkey)
             raise best_error
 
@@ -851,9 +1235,15 @@ class Broker(Control):
     @Control.auth
     #@trace
     #@prof(immediate=True, entries=20)
-    def get(self, *profiles):
+    def get(self, *profiles, **kwargs):
         if not self.allocating:
             raise Restarting('broker is restarting')
+        wait     = kwargs.pop('wait', None)
+        priority = validate_priority(kwargs.pop('priority', 'normal'))
+        if kwargs:
+            raise Exception('unknown arguments: %s' % kwargs.keys())
+        if wait != None and (type(wait) not in [int, float] or wait <= 0):
+            raise Exception('wait must be a positive number of seconds')
         session = self.get_current_session()
         # do some sanity checks first: all profiles must have the "type" field
         # and there must not be more than one profile of a particular type in
@@ -879,6 +1269,30 @@ class Broker(Control):
             tmp.append(ave.broker.profile.factory(p))
         profiles = tmp
 
+        try:
+            self.check_reserved(profiles, priority)
+            result = self.allocate(session, profiles)
+        except Busy, e:
+            if not wait:
+                self.record('get', session, profiles, 'busy')
+                self.close_session(session.authkey)
+                raise
+            # park the request until matching equipment is released. the
+            # response is sent by retry_waiting() or expire_waiting()
+            self.record('get', session, profiles, 'waiting')
+            reply = self.defer_response()
+            self.waiting.append(
+                Waiter(session, profiles, reply, e, wait, priority)
+            )
+            return
+        except NoSuch:
+            self.record('get', session, profiles, 'nosuch')
+            self.close_session(session.authkey)
+            raise
+        self.record('get', session, profiles, 'allocated')
+        return result
+
+    def allocate(self, session, profiles):
         # make a distinction between simple and complex allocations. simple ones
         # include at most one piece of physical equipment.
         best_error = None
@@ -888,6 +1302,8 @@ class Broker(Control):
                 resources = allocator.get_resources(profiles, session)
                 if self.is_sharing():
                     self.update_sharing()
+                if a == 'local':
+                    self.journal_session('allocate', session)
                 return resources # success and early return
             except Busy, e:
                 best_error = e
@@ -905,9 +1321,85 @@ class Broker(Control):
             # like with sharing remote broker, but the forwarding case
             address = list(self.remote_address)
             return self.defer_allocation(session, address, *profiles)
-        else:
-            self.close_session(session.authkey)
-            raise best_error
+        raise best_error
+
+    def check_reserved(self, profiles, priority):
+        # a waiting request that needs several pieces of equipment could be
+        # starved by requests that keep taking the pieces one at a time as
+        # they are released. equipment that may be needed by a busy request
+        # is reserved for it unless the new request ranks higher. an equal
+        # rank does not count, as the waiting request arrived first
+        now = time.time()
+        for waiter in self.waiting:
+            if (isinstance(waiter.error, Busy)
+            and waiter.rank(now, self.aging) >= priority
+            and waiter.overlaps(profiles)):
+                raise Busy('equipment reserved for a waiting request')
+
+    def retry_waiting(self):
+        # called when equipment may have been released or added. the request
+        # with the highest priority gets the first chance to allocate it. ties
+        # are broken by the order of arrival (sorting is stable). requests
+        # that overlap a higher ranked one that is still busy are not served,
+        # for the same reason as in check_reserved()
+        now = time.time()
+        ranked = sorted(self.waiting, key=lambda w: -w.rank(now, self.aging))
+        busy   = [] # higher ranked requests that could not be served
+        for waiter in ranked:
+            if waiter not in self.waiting:
+                continue # dropped while another request was handled
+            if [b for b in busy if b.overlaps(waiter.profiles)]:
+                continue
+            try:
+                result = self.allocate(waiter.session, waiter.profiles)
+            except Busy, e:
+                waiter.error = e
+                busy.append(waiter)
+                continue
+            except NoSuch, e:
+                waiter.error = e # equipment that is gone may come back
+                continue
+            except Exception, e:
+                self.waiting.remove(waiter)
+                waiter.reply.fail(e)
+                continue
+            self.waiting.remove(waiter)
+            self.record('get', waiter.session, waiter.profiles, 'allocated')
+            waiter.reply.send(result)
+
+    def expire_waiting(self):
+        now = time.time()
+        for waiter in [w for w in self.waiting if w.deadline <= now]:
+            if waiter not in self.waiting:
+                continue # satisfied by equipment released by an earlier one
+            self.waiting.remove(waiter)
+            waiter.reply.fail(waiter.error)
+            if waiter.session.authkey in self.sessions:
+                self.close_session(waiter.session.authkey)
+
+    def drop_waiting(self, session=None, exception=None):
+        # fail the requests of a session, or of all sessions
+        for waiter in list(self.waiting):
+            if session in [None, waiter.session] and waiter in self.waiting:
+                self.waiting.remove(waiter)
+                if exception:
+                    waiter.reply.fail(exception)
+
+    def step_main(self):
+        # wake up in time to give pending changes to the notifier
+        self.interval = self.period
+        if self.share_due != None:
+            wait = int((self.share_due - time.time()) * 1000) + 1
+            self.interval = max(0, min(self.period, wait))
+        if self.spare_due():
+            self.interval = 0 # start spare sessions between client requests
+        Control.step_main(self)
+        if self.share_due != None and self.share_due <= time.time():
+            self.flush_sharing()
+        if self.waiting:
+            self.expire_waiting()
+        if self.config['pool_max'] and not self.config['session_hosts']:
+            self.fill_pool()
 
     def defer_allocation(self, session, remote_address, *profiles):
         session.async_add_resources(remote_address, *profiles)
@@ -937,6 +1429,7 @@ class Broker(Control):
         session = self.get_current_session()
         if not session:
             raise Exception('no resources to yield')
+        self.record('yield', session, resources)
 
         # three cases to consider:
         # 1 - resources are allocated locally
@@ -957,12 +1450,25 @@ class Broker(Control):
             # the client allocated one of its resources. then the resources
             # cannot be found in any allocator.
             deferred.append(r)
+        self.journal_session('yield', session)
         if released:
             self.update_sharing()
+            self.retry_waiting()
         return deferred # let client talk directly to the involved sessions
 
     ### HANDOVER TO REPLACEMENT BROKER #########################################
 
+    def describe_session(self, authkey, allocations):
+        session = self.sessions[authkey]
+        result  = {
+            'pid'        : session[LOCAL].pid,
+            'address'    : list(session[REMOTE].address)
+        }
+        if isinstance(session[LOCAL], HostedSession):
+            result['hosted'] = True
+        result['allocations'] = allocations
+        return result
+
     @Control.rpc
     def serialize(self):
         allocations = self.allocators['local'].serialize()
@@ -970,12 +1476,7 @@ class Broker(Control):
         for authkey in self.sessions:
             if authkey not in allocations:
                 continue # skip sessions that do not have allocations
-            session = self.sessions[authkey]
-            state[authkey] = {
-                'pid'        : session[LOCAL].pid,
-                'address'    : list(session[REMOTE].address)
-            }
-            state[authkey]['allocations'] = allocations[authkey]
+            state[authkey] = self.describe_session(authkey,allocations[authkey])
         return state
 
     @Control.rpc
@@ -1000,7 +1501,11 @@ class Broker(Control):
         self.stop_sharing()
         self.drop_all_shares()
         self.stop_listers()
+        self.stop_journal() # the replacement broker takes over the journal
         self.allocating = False
+        self.drop_waiting(None, Restarting('broker is restarting'))
+        while self.spares:
+            self.drop_spare(self.spares.pop())
         self.fdtx = FdTx(None)
         uds_path = self.fdtx.listen(fdtx_dir, 'handover-%s' % rand_authkey())
         # make sure the caller will be able to interact with the new socket by
@@ -1084,11 +1589,20 @@ class Broker(Control):
             result.extend(self.allocators[a].list_stacks())
         return result
 
+    @Control.rpc
+    @Control.preauth('admin')
+    def list_spares(self):
+        return [s[LOCAL].pid for s in self.spares]
+
     @Control.rpc
     @Control.preauth('admin')
     def close_session(self, authkey):
         session  = self.sessions[authkey] # (Session, RemoteSession) tuple
         released = []
+        self.drop_waiting(session[REMOTE], Exception('session closed'))
+        self.record('close', session[REMOTE])
+        if self.journal:
+            self.journal.remove(authkey)
 
         # loop through share allocators
         for a in self.allocators:
@@ -1100,11 +1614,19 @@ class Broker(Control):
         except OSError, e:
             if e.errno not in [errno.ECHILD, errno.ESRCH]:
                 raise Exception('unhandled errno: %d' % e.errno)
+        # the RemoteSession closes its connection when it is garbage collected.
+        # take the connection out of the main loop first, unless it is the one
+        # that was lost (the main loop then cleans up after itself).
+        connection = session[REMOTE]._connection
+        if connection and connection != self.current_connection:
+            self.remove_connection(connection)
         del self.sessions[authkey]
         # re-add released resources to the remote master broker if this broker
         # is configured to share
         if released and self.is_sharing():
             self.update_sharing()
+        if released:
+            self.retry_waiting()
         if not self.allocating:
             # handover in progress. shut down when no sessions with allocations
             # remain
@@ -1149,6 +1671,7 @@ class Broker(Control):
         return True
 
 class RemoteBroker(RemoteControl):
+    pooled = True # unless resources are requested. see encode_rpc()
 
     def __init__(self, address=None, timeout=5, authkey=None, home=None):
         if not home:
@@ -1162,20 +1685,39 @@ class RemoteBroker(RemoteControl):
         self.config  = config
         self.session = None
 
-    def __del__(self):
-        if self.session:
-            del self.session
-        RemoteControl.__del__(self)
-
-    def get_resources(self, *profiles):
-        return self.get(*profiles)
-    def get_resource(self, *profiles):
-        return self.get(*profiles)
-
-    def get_resources_raw(self, *profiles):
-        fn = RemoteControl.__getattr__(self, 'get')
+    def encode_rpc(self, blob):
+        # the broker ties allocations to the connection and frees them when it
+        # is closed, so a connection that was used to request resources must
+        # not be given back to the pool. this catches all the ways to call the
+        # broker, including pipelines and batches that bypass get()
+        calls = blob.get('batch', [blob])
+        if [c for c in calls if c['method'].startswith('get')]:
+            self.pooled = False
+        return RemoteControl.encode_rpc(self, blob)
+
+    def get_resources(self, *profiles, **kwargs):
+        return self.get(*profiles, **kwargs)
+    def get_resource(self, *profiles, **kwargs):
+        return self.get(*profiles, **kwargs)
+
+    def get_resources_raw(self, *profiles, **kwargs):
+        wait     = kwargs.get('wait')
+        priority = kwargs.get('priority')
         try:
-            response = fn(*profiles)
+            if wait:
+                # the broker holds the response until the allocation succeeds
+                # or the wait times out. allow for the round trip on top
+                timeout = self.timeout
+                if timeout:
+                    timeout += wait
+                options = {'wait': wait}
+                if priority != None:
+                    options['priority'] = priority
+                response = self.submit('get', *profiles, **options).result(
+                    timeout
+                )
+            else:
+                response = RemoteControl.__getattr__(self, 'get')(*profiles)
         except AveException, e:
             # cast into a broker specific class. the factory will return the
             # original exception if it isn't a broker specific one
@@ -1208,13 +1750,17 @@ class RemoteBroker(RemoteControl):
         return self.session.get_multi_resource(*profiles)
 
 
-    def get(self, *profiles):
+    def get(self, *profiles, **kwargs):
         # two stage approached: first let the broker return session RPC keys.
         # then use those to ask the session for the resource RPC keys. both
         # steps may raise BUSY exceptions, etc.
         # the rationale for using two stages is that it avoids long stalls in
         # the broker's main loop during resource allocation, whose latencies
         # are unknowable in a networked setup.
+        wait     = kwargs.pop('wait', None) # seconds to wait for busy equipment
+        priority = kwargs.pop('priority', None) # only matters when waiting
+        if kwargs:
+            raise Exception('unknown arguments: %s' % kwargs.keys())
         multi = False
         seen_type = []
         for p in profiles:
@@ -1230,9 +1776,13 @@ class RemoteBroker(RemoteControl):
                 seen_type.append(p['type'])
 
         if multi:
+            if wait:
+                raise Exception('cannot wait for alternative profiles')
             response = self.get_multi_resources_raw(*profiles)
         else:
-            response = self.get_resources_raw(*profiles)
+            response = self.get_resources_raw(
+                *profiles, wait=wait, priority=priority
+            )
 
         result = ()
         for resource in response:
@@ -1276,3 +1826,80 @@ class RemoteBroker(RemoteControl):
         deferred = fn(*profiles)
         if deferred:
             self.session.yield_resources(deferred)
+
+class AsyncRemoteBroker(AsyncRemoteControl):
+    '''
+    Non-blocking counterpart of ``RemoteBroker``. The broker reclaims allocated
+    resources when the connection is closed, so the object must be kept open
+    for as long as the resources are used.
+    '''
+
+    def __init__(
+            self, address=None, timeout=5, authkey=None, home=None,
+            reactor=None
+        ):
+        if not home:
+            home = ave.config.load_etc()['home']
+        # load and validate the configuration file
+        config = load_configuration(get_configuration_path(home))
+        validate_configuration(config)
+        if not address:
+            address = (config['host'], config['port'])
+        AsyncRemoteControl.__init__(
+            self, address, authkey, timeout, None, reactor
+        )
+        self.config  = config
+        self.home    = home
+        self.session = None
+
+    def get_resources(self, *profiles):
+        '''
+        Allocate resources like ``RemoteBroker.get_resources()``. Only single
+        profiles are supported, not tuples of alternatives.
+
+        :returns: A ``Future`` whose result is an ``AsyncRemoteSession`` for
+            each allocated resource. A single session if only one resource was
+            allocated, a tuple otherwise.
+        '''
+        for p in profiles:
+            if type(p) is tuple:
+                raise Exception('alternative profiles are not supported')
+        result = Future()
+
+        def got_session(future):
+            # two stages, like RemoteBroker.get(): the broker returns session
+            # RPC keys. use those to ask the session for the resource keys
+            try:
+                response = future.result()
+            except AveException, e:
+                return result.set_exception(exception_factory(e))
+            except Exception, e:
+                return result.set_exception(e)
+            if not self.session:
+                self.session = AsyncRemoteSession(
+                    tuple(response['address']), str(response['authkey']),
+                    timeout=self.timeout, reactor=self.reactor
+                )
+            resources = self.session.get_resources(*response['resources'])
+            resources.add_done_callback(got_resources)
+
+        def got_resources(future):
+            try:
+                response = future.result()
+            except Exception, e:
+                return result.set_exception(e)
+            sessions = tuple([
+                AsyncRemoteSession(
+                    tuple(r['address']), str(r['authkey']), r['profile'],
+                    self.timeout, self.reactor
+                ) for r in response
+            ])
+            if len(sessions) == 1:
+                return result.set_result(sessions[0])
+            result.set_result(sessions)
+
+        self.call('get', *profiles).add_done_callback(got_session)
+        return result
+
+    def get_resource(self, *profiles):
+        return self.get_resources(*profiles)
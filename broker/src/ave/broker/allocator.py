@@ -4,6 +4,7 @@
 import os
 import sys
 import copy
+import types
 import traceback
 import json
 
@@ -15,6 +16,7 @@ from ave.network.exceptions  import ConnectionClosed, ConnectionTimeout
 from ave.workspace           import Workspace
 from ave.broker.profile      import *
 from ave.broker.session      import Session, RemoteSession
+from ave.broker.snapshot     import make_key
 
 from constants  import *
 from exceptions import *
@@ -27,6 +29,111 @@ def validate_profile(profile):
             raise Exception('invalid profile: %s' % profile)
     return profile
 
+SCALARS = (str, unicode, int, long, float, bool, types.NoneType)
+
+def has_plain_match(profile):
+    # subclasses that override Profile.match() may ignore or reinterpret keys
+    return getattr(type(profile).match, 'im_func', None) is Profile.match.im_func
+
+class EquipmentIndex(object):
+    '''
+    Inverted index over the equipment of an allocator. Maps (key, value) pairs
+    to the profiles that hold them, so that the candidates for a match can be
+    found by intersecting a few sets instead of matching every profile. Only
+    keys with scalar values are indexed. Profiles whose classes implement
+    their own ``match()`` are only indexed by type and always included among
+    the candidates. The caller must still match each candidate.
+    '''
+
+    def __init__(self):
+        self.pairs   = {}    # (key, value) -> set of profile ID's
+        self.plain   = set() # profile ID's indexed by all their pairs
+        self.typed   = {}    # type -> set of profile ID's with custom match()
+        self.entries = {}    # profile ID -> (sequence number, profile, pairs)
+        self.counter = 0
+
+    def add(self, profile, number=None):
+        if number == None: # candidates are returned in the order of addition
+            number = self.counter
+            self.counter += 1
+        key = id(profile)
+        if has_plain_match(profile):
+            pairs = [(k, v) for (k, v) in profile.items() if type(v) in SCALARS]
+            self.plain.add(key)
+        else:
+            pairs = []
+            self.typed.setdefault(profile.get('type'), set()).add(key)
+        for pair in pairs:
+            self.pairs.setdefault(pair, set()).add(key)
+        self.entries[key] = (number, profile, pairs)
+
+    def remove(self, profile):
+        key = id(profile)
+        number, profile, pairs = self.entries.pop(key)
+        for pair in pairs:
+            self.pairs[pair].discard(key)
+            if not self.pairs[pair]:
+                del self.pairs[pair]
+        self.plain.discard(key)
+        for keys in self.typed.values():
+            keys.discard(key)
+        return number
+
+    def candidates(self, profile):
+        sets = [
+            self.pairs.get((k, v), set()) for (k, v) in profile.items()
+            if type(v) in SCALARS
+        ]
+        if sets:
+            sets.sort(key=len)
+            found = sets[0].intersection(*sets[1:])
+        else:
+            found = set(self.plain)
+        if 'type' in profile and type(profile['type']) in SCALARS:
+            found.update(self.typed.get(profile['type'], []))
+        else:
+            for keys in self.typed.values():
+                found.update(keys)
+        return [e[1] for e in sorted([self.entries[k] for k in found])]
+
+def match_profiles(profiles, equipment, cost=None):
+    '''
+    Pair every profile with a distinct piece of equipment that matches it. The
+    pairing is a maximum bipartite matching found with augmenting paths, so a
+    greedy choice never blocks an assignment that is possible. Candidates are
+    tried in order of increasing *cost*, if given, to keep scarce equipment
+    for the profiles that need it.
+
+    :returns: A list with the index in *equipment* for each profile, or
+        ``None`` if no complete pairing exists.
+    '''
+    edges = []
+    for p in profiles:
+        found = [i for i in range(len(equipment)) if equipment[i].match(p)]
+        if cost:
+            found.sort(key=lambda i: cost(equipment[i])) # stable
+        edges.append(found)
+
+    owner = {} # index in equipment -> index in profiles
+    def augment(p, seen):
+        for i in edges[p]:
+            if i in seen:
+                continue
+            seen.add(i)
+            if i not in owner or augment(owner[i], seen):
+                owner[i] = p
+                return True
+        return False
+
+    # the most constrained profiles pick first
+    for p in sorted(range(len(profiles)), key=lambda p: len(edges[p])):
+        if not augment(p, set()):
+            return None
+    result = [None] * len(profiles)
+    for i in owner:
+        result[owner[i]] = i
+    return result
+
 class Allocator(object):
     ws_profile  = None # the profile used for all workspace allocation
     workspaces  = None # currently available workspaces
@@ -34,13 +141,21 @@ class Allocator(object):
     stacks      = None
     allocations = None
     collateral  = None
+    catalogue   = None # EquipmentIndex
+    membership  = None
+    stack_busy  = None
+    owned       = None
 
     def __init__(self):
         self.equipment   = []
+        self.catalogue   = EquipmentIndex()
         self.stacks      = []
+        self.membership  = {}  # Profile -> [index of stack, ...]
+        self.stack_busy  = []  # index of stack -> number of allocated members
         self.allocations = {}  # Profile -> (RemoteSession,
                                #     [CollateralProfile, ...])
         self.collateral  = {}  # Profile -> [RemoteSession, ...]
+        self.owned       = {}  # RemoteSession -> [Profile, ...]
 
     ### WORKSPACES #############################################################
 
@@ -94,6 +209,7 @@ class Allocator(object):
             elif owner == None:
                 # workspaces have no collateral. add empty list
                 self.allocations[resource] = (session, [])
+                self.owned.setdefault(session, []).append(resource)
             else:
                 raise Busy('resource already allocated: %s' % resource)
             return
@@ -101,15 +217,33 @@ class Allocator(object):
         if resource in self.allocations:
             raise Busy('resource already allocated: %s' % resource)
         self.allocations[resource] = (session, collateral)
+        self.owned.setdefault(session, []).append(resource)
+        self.count_stack_members(resource, 1)
         for c in collateral:
             if c not in self.collateral:
                 self.collateral[c] = []
             self.collateral[c].append(session)
 
+    def append_equipment(self, profile):
+        self.equipment.append(profile)
+        self.catalogue.add(profile)
+
+    def remove_equipment(self, profile):
+        # the listed profile may be a different object that compares equal
+        profile = self.equipment.pop(self.equipment.index(profile))
+        self.catalogue.remove(profile)
+
+    def reindex_equipment(self, profile):
+        '''
+        Must be called after a listed profile was modified in place.
+        '''
+        self.catalogue.add(profile, self.catalogue.remove(profile))
+
     def list_equipment(self, profile=None):
         if not profile:
             return copy.copy(self.equipment)
-        return [e for e in self.equipment if e.match(profile)]
+        candidates = self.catalogue.candidates(profile)
+        return [e for e in candidates if e.match(profile)]
 
     def list_available(self, profile):
         result = self.list_equipment(profile)
@@ -128,17 +262,14 @@ class Allocator(object):
         return result
 
     def list_allocations(self, session):
-        result  = []
-        for profile in self.allocations:
-            if session in [None, self.get_owner(profile)]:
-                result.append(profile)
-        return result
+        if session == None:
+            return self.allocations.keys()
+        return list(self.owned.get(session, []))
 
     def list_collateral(self, session):
         result  = []
-        for resource in self.allocations:
-            if session in [None, self.get_owner(resource)]:
-                result.extend(self.get_collateral(resource))
+        for resource in self.list_allocations(session):
+            result.extend(self.get_collateral(resource))
         return list(set(result))
 
     def is_available(self, profile):
@@ -170,7 +301,9 @@ class Allocator(object):
     ### STACKS #################################################################
 
     def set_stacks(self, stacks):
-        self.stacks = []
+        self.stacks     = []
+        self.membership = {}
+        self.stack_busy = []
         if type(stacks) != list:
             raise Exception('stacks must be a list of list of profiles')
         for s in stacks:
@@ -182,43 +315,84 @@ class Allocator(object):
         checked = []
         for p in stack:
             checked.append(validate_profile(p))
+        index = len(self.stacks)
+        for p in checked:
+            if index not in self.membership.setdefault(p, []):
+                self.membership[p].append(index)
         self.stacks.append(checked)
+        self.stack_busy.append(len([p for p in set(checked)
+                                      if p in self.allocations]))
+
+    def count_stack_members(self, resource, delta):
+        for index in self.membership.get(resource, []):
+            self.stack_busy[index] += delta
+
+    def reindex_allocations(self):
+        # must be called when the allocations are replaced wholesale
+        self.owned      = {}
+        self.stack_busy = [0] * len(self.stacks)
+        for resource in self.allocations:
+            self.owned.setdefault(self.get_owner(resource), []).append(resource)
+            self.count_stack_members(resource, 1)
 
     def list_stacks(self):
         return self.stacks
 
+    def specialisation(self, profile):
+        # stacked equipment is needed by requests for equipment that works
+        # together. prefer other equipment for requests that don't need that
+        return len(self.membership.get(profile, []))
+
     def find_collateral(self, allocation):
         result = []
         for a in allocation:
             if isinstance(a, BaseWorkspaceProfile):
                 continue # no collateral is possible
-            for stack in self.stacks:
-                if a not in stack:
-                    continue
-                for s in stack:
-                    result.append(s)
+            for index in self.membership.get(a, []):
+                result.extend(self.stacks[index])
         # profiles in the allocation should not be included in the collateral
         return [r for r in result if r not in allocation]
 
     def match_stack(self, session, stack, profiles):
-        tmp_stack = copy.deepcopy(stack)
-
-        def in_stack(stack, profile):
-            for equipment in stack:
-                try:
-                    equipment = self.fill_profile(equipment)
-                except: # equipment temporarily unavailable
-                    return False
-                if equipment.match(profile):
-                    stack.remove(equipment)
-                    return True
-            return False
+        members = []
+        for equipment in stack:
+            try:
+                members.append(self.fill_profile(equipment))
+            except: # equipment temporarily unavailable
+                return False
+        # not handled here. stacks don't contain workspaces
+        profiles = [p for p in profiles
+                      if not isinstance(p, BaseWorkspaceProfile)]
+        return match_profiles(profiles, members) != None
+
+    def assign_profiles(self, profiles, intended):
+        '''
+        Find out which of the intended resources satisfies which profile. A
+        stack may contain several resources of the same type, so the profiles
+        must be matched and not just their types.
+
+        :returns: A list with the index in *intended* for each profile.
+        '''
+        equipment = [p for p in profiles
+                       if not isinstance(p, BaseWorkspaceProfile)]
+        physical  = [i for i in range(len(intended))
+                       if not isinstance(intended[i], BaseWorkspaceProfile)]
+        pairing   = match_profiles(
+            equipment, [intended[i] for i in physical], self.specialisation
+        )
+        if pairing == None:
+            raise Busy('cannot allocate all equipment together')
+        # workspaces were matched by match_workspaces() in request order
+        workspaces = [i for i in range(len(intended)) if i not in physical]
+        pairing.reverse()
+        workspaces.reverse()
+        result = []
         for p in profiles:
             if isinstance(p, BaseWorkspaceProfile):
-                continue # not handled here. stacks don't contain workspaces
-            if not in_stack(tmp_stack, p):
-                return False
-        return True
+                result.append(workspaces.pop())
+            else:
+                result.append(physical[pairing.pop()])
+        return result
 
     ### ALLOCATION #############################################################
 
@@ -233,7 +407,7 @@ class Allocator(object):
             equipment = self.list_available(p)
             if not equipment:
                 raise Busy('all such equipment busy: %s' % p)
-            intended.append(equipment[0])
+            intended.append(min(equipment, key=self.specialisation))
 
         # if any stack contains the intended allocation, then the rest of the
         # stack has to be marked as collateral to avoid that different clients
@@ -250,7 +424,10 @@ class Allocator(object):
 
     def complex_allocation(self, profiles, session):
         candidates = []
-        for stack in copy.deepcopy(self.stacks):
+        for index in range(len(self.stacks)):
+            if self.stack_busy[index]:
+                continue # has allocated members. would be rejected below
+            stack = list(self.stacks[index]) # members are replaced, not changed
             if self.match_stack(session, stack, profiles):
                 candidates.append(stack)
 
@@ -301,9 +478,14 @@ class Allocator(object):
         return intended, collateral
 
     def deallocate(self, resource):
+        session = self.allocations[resource][SESSION]
         for c in self.allocations[resource][COLLATERAL]:
-            self.collateral[c].remove(self.allocations[resource][SESSION])
+            self.collateral[c].remove(session)
         del self.allocations[resource]
+        self.owned[session].remove(resource)
+        if not self.owned[session]:
+            del self.owned[session]
+        self.count_stack_members(resource, -1)
 
     def yield_resource(self, session, resource):
         if resource not in self.allocations:
@@ -327,11 +509,8 @@ class Allocator(object):
         return self.list_equipment(profile)[0]
 
     def close_session(self, session):
-        release    = [] # profiles of resources to be deallocated
+        release    = list(self.owned.get(session[REMOTE], []))
         collateral = []
-        for resource in self.allocations:
-            if self.get_owner(resource) == session[REMOTE]:
-                release.append(resource)
         for resource in release:
             collateral.extend(self.get_collateral(resource))
             self.deallocate(resource)
@@ -339,18 +518,89 @@ class Allocator(object):
 
 class ShareAllocator(Allocator):
     remote_address  = None
+    version         = None
+    reported        = None
+    withheld        = None
 
     def __init__(self, address):
         Allocator.__init__(self)
         self.remote_address = address
+        self.version        = None # of the last status received from the share
+        self.reported       = {}   # (type, Profile) -> Profile
+        self.withheld       = []   # yielded equipment. see yield_resource()
 
-    def set_equipment(self, equipment, allocations):
+    def set_equipment(self, equipment, allocations, version=None):
         self.equipment = []
+        self.catalogue = EquipmentIndex()
+        self.reported  = {}
+        self.withheld  = []
         for e in equipment:
-            self.equipment.append( profile_factory(e) )
+            e = profile_factory(e)
+            self.append_equipment(e)
+            self.reported[make_key(e)] = e
 
         self.deserialize_allocations(allocations)
         self.calculate_collateral()
+        self.version = version
+
+    def find_equipment(self, profile):
+        for e in self.equipment:
+            if e['type'] == profile['type'] and e == profile:
+                return e
+        return None
+
+    def apply_delta(self, base, version, delta):
+        '''
+        Update the equipment and allocations with the changes made by the share
+        since it sent the status numbered *base*.
+
+        :returns: False if *base* is not the last status received, in which
+            case nothing is changed and the share must send its full status.
+        '''
+        if self.version == None or base != self.version:
+            return False
+        DUMMY_SESSION = 0 # see deserialize_allocations()
+
+        for p in delta['removed']:
+            p = profile_factory(p)
+            self.reported.pop(make_key(p), None)
+            if self.find_equipment(p) is not None:
+                self.remove_equipment(p)
+        for p in delta['added'] + delta['changed']:
+            p = profile_factory(p)
+            self.reported[make_key(p)] = p
+            listed = self.find_equipment(p)
+            if listed is None:
+                self.append_equipment(p)
+            else: # allocations and stacks refer to the listed object
+                listed.clear()
+                listed.update(p)
+                self.reindex_equipment(listed)
+
+        # allocations made through this broker are kept until the client
+        # yields them, like in deserialize_allocations()
+        for p in delta['released']:
+            p = profile_factory(p)
+            if (p in self.allocations
+            and type(self.allocations[p][SESSION]) is not RemoteSession):
+                self.deallocate(p)
+        for entry in delta['allocated']:
+            p = profile_factory(entry['profile'])
+            if p in self.allocations:
+                if type(self.allocations[p][SESSION]) is RemoteSession:
+                    continue
+                self.deallocate(p)
+            collateral = [profile_factory(c) for c in entry['collateral']]
+            self.allocate(p, DUMMY_SESSION, collateral)
+
+        # yielded equipment is listed again on the next update from the share,
+        # just like when the full status is received
+        for key in self.withheld:
+            if key in self.reported and self.find_equipment(key[1]) is None:
+                self.append_equipment(self.reported[key])
+        self.withheld = []
+        self.version  = version
+        return True
 
     # return a JSON compatible representation. instead of authkeys an index is
     # used to build the dictionary
@@ -395,6 +645,7 @@ class ShareAllocator(Allocator):
                 if not allocation_profile in self.allocations:
                     self.allocations[allocation_profile] = \
                         (DUMMY_SESSION, collateral_profiles)
+        self.reindex_allocations()
 
     def calculate_collateral(self):
         # clear collateral to start
@@ -428,13 +679,15 @@ class ShareAllocator(Allocator):
 
     def yield_resource(self, session, resource):
         _ = Allocator.yield_resource(self, session, resource)
-        self.equipment.remove(resource)
+        self.remove_equipment(resource)
+        self.withheld.append(make_key(resource))
         return [] # collateral not released
 
     def close_session(self, session):
         release,_ = Allocator.close_session(self, session)
         for r in release:
-            self.equipment.remove(r)
+            self.remove_equipment(r)
+            self.withheld.append(make_key(r))
         return [] # nothing to release
 
 class LocalAllocator(Allocator):
@@ -453,7 +706,7 @@ class LocalAllocator(Allocator):
             TestDriveInterface
             self.testdrive = TestDriveInterface(timeout=1, home=self.home)
             spirent_profile = self.testdrive.get_profile()
-            self.equipment.append(spirent_profile)
+            self.append_equipment(spirent_profile)
         except ImportError:
             pass
         except NoConfig:
@@ -473,8 +726,9 @@ class LocalAllocator(Allocator):
                     for e in self.equipment:
                         if e == p and 'pretty' in e:
                             p['pretty'] = e['pretty']
-                self.equipment.remove(p) # replace found item below
-        self.equipment.extend(checked)
+                self.remove_equipment(p) # replace found item below
+        for p in checked:
+            self.append_equipment(p)
 
     # return a JSON compatible representation. all RemoteSession references are
     # reduced to their authkeys
@@ -488,6 +742,14 @@ class LocalAllocator(Allocator):
             result[authkey].append({'profile':profile, 'collateral':collateral})
         return result
 
+    # same format as serialize(), for a single session
+    def serialize_session(self, session):
+        result = []
+        for profile in self.list_allocations(session):
+            collateral = self.allocations[profile][COLLATERAL]
+            result.append({'profile':profile, 'collateral':collateral})
+        return result
+
     def list_handsets(self, profile):
         if not profile:
             return [e for e in self.equipment if type(e) == HandsetProfile]
@@ -585,7 +847,7 @@ class LocalAllocator(Allocator):
                     uid=resource['uid'], config=self.ws_cfg, home=self.home
                 )
                 workspace.delete()
-                self.equipment.remove(resource)
+                self.remove_equipment(resource)
         # need special handling of relays: close all circuits in the group
         if resource['type'] == 'relay':
             self.deallocate_relay(resource)
@@ -608,10 +870,10 @@ class LocalAllocator(Allocator):
                     raise NoSuch('no such workspace')
 
         # minimize the profiles of all resources that are about to be allocated
-        for i in range(len(intended)):
-            for p in profiles:
-                if type(intended[i]) == type(p):
-                    intended[i] = intended[i].minimize(p)
+        # against the profiles they were chosen for
+        chosen = self.assign_profiles(profiles, intended)
+        for i in range(len(profiles)):
+            intended[chosen[i]] = intended[chosen[i]].minimize(profiles[i])
 
         # allocate the equipment. this is the last point of possible failure
         for i in range(len(intended)):
@@ -633,19 +895,13 @@ class LocalAllocator(Allocator):
                     resource = ws.get_profile()
                     intended[i] = resource # replace the anonymous profile
                     if resource not in self.equipment:
-                        self.equipment.append(resource)
+                        self.append_equipment(resource)
             self.allocate(resource, session, collateral) # set internal records
             session.add_resource(resource) # tell the session about it
 
         # put the resources in the order they were requested and reduce the
         # result so that only requested resources are present.
-        visible = []
-        for p in profiles:
-            for i in intended:
-                if i['type'] == p['type']:
-                    visible.append(i)
-                    intended.remove(i)
-                    break
+        visible = [intended[i] for i in chosen]
 
         result = {
             'address'  : session.address,
@@ -0,0 +1,120 @@
+# Copyright (C) 2014 Sony Mobile Communications Inc.
+# All rights, including trade secret rights, reserved.
+
+import os
+import json
+
+JOURNAL_SLACK = 1000 # events written between compactions, at least
+
+def encode(entry):
+    return json.dumps(entry, separators=(',',':')) + '\n'
+
+def apply_entry(state, entry):
+    if entry[0] == 'snapshot':
+        state.clear()
+        state.update(entry[1])
+    elif entry[0] in ['allocate', 'yield']:
+        authkey, details = entry[1], entry[2]
+        if details['allocations']:
+            state[authkey] = details
+        else:
+            state.pop(authkey, None)
+    elif entry[0] == 'close':
+        state.pop(entry[1], None)
+    else:
+        raise Exception('unknown journal entry: %s' % entry[0])
+
+def load_journal(path):
+    '''
+    Read a journal written by a ``Journal``.
+
+    :returns: The sessions that held allocations when the journal was last
+        written to, in the format of ``Broker.serialize()``. An empty
+        dictionary if there is no journal.
+    '''
+    state = {}
+    if not os.path.exists(path):
+        return state
+    with open(path) as f:
+        lines = f.readlines()
+    for i in range(len(lines)):
+        try:
+            entry = json.loads(lines[i])
+        except ValueError:
+            if i == len(lines) - 1:
+                break # the broker crashed in the middle of writing the entry
+            raise Exception('corrupt journal entry on line %d: %s' % (i+1,path))
+        apply_entry(state, entry)
+    return state
+
+class Journal(object):
+    '''
+    Append-only record of the sessions that hold allocations in a broker. The
+    file starts with a snapshot of all such sessions and continues with one
+    compact JSON list per change:
+
+    * ``["snapshot", {authkey: details, ...}]``
+    * ``["allocate", authkey, details]``: The session got more allocations.
+    * ``["yield", authkey, details]``: The session yielded allocations.
+    * ``["close", authkey]``
+
+    The details are on the format of ``Broker.serialize()`` and always list all
+    the current allocations of the session, so entries can be replayed without
+    knowing what came before them. The file is rewritten with a new snapshot
+    when it has grown large compared to the number of sessions in it. Loading
+    it thus takes time in proportion to the live allocations, not to the
+    history of the broker.
+
+    The file contains session authkeys and is only readable by its owner.
+
+    :arg path: Where to write the journal.
+    :arg state: The sessions to write to the first snapshot.
+    '''
+
+    def __init__(self, path, state):
+        self.path  = path
+        self.file  = None
+        self.live  = set() # authkeys of sessions with allocations
+        self.count = 0     # entries written since the last snapshot
+        self.compact(state)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def write(self, entry):
+        self.file.write(encode(entry))
+        self.count += 1
+
+    def compact(self, state):
+        # write the snapshot to a new file and move it into place so that the
+        # journal is never seen half written
+        tmp = self.path + '.tmp'
+        fd  = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(encode(['snapshot', state]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        self.close()
+        self.file  = open(self.path, 'a', 1) # line buffered
+        self.live  = set(state.keys())
+        self.count = 0
+
+    def is_due(self):
+        return self.count > max(JOURNAL_SLACK, 2 * len(self.live))
+
+    def update(self, event, authkey, details):
+        if not details['allocations']:
+            if authkey not in self.live:
+                return # nothing to forget
+            self.live.remove(authkey)
+        else:
+            self.live.add(authkey)
+        self.write([event, authkey, details])
+
+    def remove(self, authkey):
+        if authkey in self.live:
+            self.live.remove(authkey)
+            self.write(['close', authkey])
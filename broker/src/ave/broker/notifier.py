@@ -4,8 +4,9 @@
 import json
 import traceback
 
-from ave.network.control import Control, RemoteControl
-from ave.broker.profile  import profile_factory
+from ave.network.control    import Control, RemoteControl
+from ave.network.exceptions import AveException
+from ave.broker.snapshot    import Snapshot
 
 
 def validate_address(addr):
@@ -21,10 +22,11 @@ class Notifier(Control):
     local_addr    = None
     ws_profile    = None
     stacks        = None
-    equipment     = None
     remote        = None
-    allocations   = None
-    collateral    = None
+    current       = None
+    acked         = None
+    version       = 0
+    incremental   = True
 
     def __init__(self, port, sock, remote_addr, remote_auth,local_addr,logging):
         Control.__init__(
@@ -37,9 +39,10 @@ class Notifier(Control):
         self.remote_auth = remote_auth
         self.remote      = None
         self.local_addr  = local_addr
-        self.equipment   = None
-        self.allocations = {}
-        self.collateral  = {}
+        self.current     = None  # Snapshot of the equipment status to share
+        self.acked       = None  # Snapshot of what the master has, if known
+        self.version     = 0     # number of the status that the master has
+        self.incremental = True  # False if the master does not take deltas
 
     def shutdown(self):
         if self.remote:
@@ -78,6 +81,7 @@ class Notifier(Control):
                 )
                 self.add_keepwatching(self.remote.connect(5), self.remote_auth)
                 self.log('connected to %s' % str(self.remote_addr))
+                self.acked = None # unknown what the master has
         except Exception, e:
             self.log('WARNING: could not connect to master: %s' % e)
             self.remote = None
@@ -88,15 +92,8 @@ class Notifier(Control):
                 self.remote.set_ws_profile(self.local_addr, self.ws_profile)
             if self.stacks:
                 self.remote.set_stacks(self.local_addr, self.stacks)
-            if self.equipment != None:
-                self.remote.set_equipment(
-                    self.local_addr,
-                    self.equipment,
-                    self.allocations
-                )
-                dump = json.dumps(self.equipment,indent=4)
-                addr = str(self.remote_addr)
-                self.log('shared equipment with %s:\n%s' % (addr,dump))
+            if self.current != None and self.current is not self.acked:
+                self.share_equipment()
         except Exception, e:
             self.log('WARNING: could not notify master: %s' % str(e))
             self.retry_later()
@@ -105,11 +102,41 @@ class Notifier(Control):
         # clear the todo-list
         self.ws_profile     = None
         self.stacks         = None
-        self.equipment      = None
-        self.collateral     = {}
-        self.allocations    = {}
         self.interval       = 1000 # do not sleep indefinitely in kernel space
 
+    def share_equipment(self):
+        addr = str(self.remote_addr)
+        if self.acked != None and self.incremental:
+            delta = self.acked.diff(self.current) # may be empty. see Broker
+            try:
+                applied = self.remote.update_equipment(
+                    self.local_addr, self.version, self.version + 1, delta
+                )
+            except AveException, e: # the full status is sent instead
+                self.log('WARNING: master did not take delta: %s' % e)
+                if 'no such RPC' in str(e): # predates update_equipment()
+                    self.incremental = False
+                applied = False
+            if applied:
+                self.version += 1
+                self.acked = self.current
+                dump = json.dumps(delta, indent=4)
+                self.log('shared equipment delta with %s:\n%s' % (addr,dump))
+                return
+        # the master has nothing to apply a delta to. send everything
+        equipment   = self.current.list_equipment()
+        allocations = self.current.serialize_allocations()
+        if self.incremental:
+            self.remote.set_equipment(
+                self.local_addr, equipment, allocations, self.version + 1
+            )
+        else:
+            self.remote.set_equipment(self.local_addr, equipment, allocations)
+        self.version += 1
+        self.acked = self.current
+        dump = json.dumps(equipment, indent=4)
+        self.log('shared equipment with %s:\n%s' % (addr,dump))
+
     def retry_later(self):
         if self.interval < 16000:
             self.interval *= 2 # avoid hammering the remote broker
@@ -128,8 +155,14 @@ class Notifier(Control):
 
     @Control.rpc
     def set_equipment(self, profiles, allocations):
-        self.equipment   = [profile_factory(p) for p in profiles]
-        self.allocations = allocations
+        self.current = Snapshot(profiles, allocations)
+        self.execute()
+
+    @Control.rpc
+    def update_equipment(self, delta):
+        # the snapshot held by self.acked must not be modified
+        self.current = self.current.copy()
+        self.current.patch(delta)
         self.execute()
 
 class RemoteNotifier(RemoteControl):
@@ -0,0 +1,63 @@
+# Copyright (C) 2014 Sony Mobile Communications Inc.
+# All rights, including trade secret rights, reserved.
+
+import json
+import time
+
+from ave.broker.session import RemoteSession
+
+def load_trace(path):
+    '''
+    Read a trace file written by a ``Recorder``.
+
+    :returns: A list of events. Each event is a list that starts with the name
+        of the event and the number of seconds since the recording started.
+    '''
+    events = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                events.append(json.loads(line))
+    return events
+
+class Recorder(object):
+    '''
+    Writes the allocation traffic of a broker to a trace file, one compact JSON
+    list per line. Sessions are written as sequence numbers because their
+    authkeys must not be disclosed. The events are:
+
+    * ``["stacks", time, [stack, ...]]``
+    * ``["equipment", time, [profile, ...]]``: all equipment when recording
+      starts.
+    * ``["add_equipment", time, [profile, ...]]``: new or updated equipment.
+    * ``["remove_equipment", time, [profile, ...]]``
+    * ``["get", time, session, [profile, ...], outcome]``: The outcome is one
+      of ``"allocated"``, ``"busy"``, ``"nosuch"`` or ``"waiting"``. A waiting
+      request is recorded again as allocated if it is satisfied later.
+    * ``["get_multi", time, session, [[profile, ...], ...], outcome]``
+    * ``["yield", time, session, [profile, ...]]``
+    * ``["close", time, session]``
+
+    The trace can be replayed with ``ave.broker.tools.replay``.
+    '''
+
+    def __init__(self, path):
+        self.path     = path
+        self.file     = open(path, 'w', 1) # line buffered
+        self.start    = time.time()
+        self.sessions = {} # authkey -> sequence number
+
+    def close(self):
+        self.file.close()
+
+    def convert(self, field):
+        if isinstance(field, RemoteSession):
+            if field.authkey not in self.sessions:
+                self.sessions[field.authkey] = len(self.sessions)
+            return self.sessions[field.authkey]
+        return field
+
+    def record(self, event, *fields):
+        entry = [event, round(time.time() - self.start, 6)]
+        entry.extend([self.convert(f) for f in fields])
+        self.file.write(json.dumps(entry, separators=(',',':')) + '\n')
@@ -4,15 +4,18 @@
 import os
 import sys
 import json
+import time
 import select
 import signal
 import errno
+import threading
 import traceback
 
 import ave.broker.profile
 
 from ave.network.exceptions   import *
 from ave.network.control      import Control, RemoteControl, Exit
+from ave.network.reactor      import AsyncRemoteControl
 from ave.broker.profile       import *
 from ave.broker.exceptions    import *
 
@@ -73,15 +76,43 @@ class AdoptedSession(object):
                 return
             raise e
 
+# sessions that live in a SessionHost process are represented in the broker by
+# instances of this class. like AdoptedSession it only implements .pid and
+# .terminate(). the session is terminated by asking the host to stop it.
+class HostedSession(object):
+
+    def __init__(self, pid, remote):
+        self.pid    = pid    # of the host
+        self.remote = remote # RemoteSession used by the broker
+
+    def join(self):
+        pass # the host process is joined by the broker
+
+    def terminate(self):
+        try:
+            self.remote.stop(__async__=True)
+        except Exception:
+            pass # the host closed the session or died already
+
+    def kill(self, signum):
+        self.terminate()
+
+def validate_broker_addr(broker_addr):
+    if (not isinstance(broker_addr, tuple)
+    or  type(broker_addr[0]) not in [str, unicode]
+    or  type(broker_addr[1]) != int
+    or  broker_addr[1] < 1):
+        raise Exception('address must be a (string, integer > 0) tuple')
+
 class Session(Control):
+    grace       = 0     # seconds to wait for a restarted broker to adopt us
+    broker_conn = None  # the connection that the broker called set_broker() on
+    orphaned    = None  # when the connection to the broker was lost
+    adopted     = False # True if adopted by a restarted broker
 
     def __init__(self, port, authkey, broker_addr, socket=None, ws_cfg=None,
-                 home=None, logging=True):
-        if (not isinstance(broker_addr, tuple)
-        or  type(broker_addr[0]) not in [str, unicode]
-        or  type(broker_addr[1]) != int
-        or  broker_addr[1] < 1):
-            raise Exception('address must be a (string, integer > 0) tuple')
+                 home=None, logging=True, grace=0):
+        validate_broker_addr(broker_addr)
         Control.__init__(
             self, port, authkey, socket, {}, 1, home, 'ave-broker-session',
             logging
@@ -94,11 +125,22 @@ class Session(Control):
         self.deferred    = None        # use remote broker in next allocation
         self.mdeferred   = []
         self.ws_cfg      = ws_cfg      # configuration used for all workspaces
+        self.grace       = grace
 
     @property
     def address(self):
         return (self.broker_addr[0], self.port)
 
+    def initialize(self):
+        Control.initialize(self)
+        if self.grace:
+            # outlive a crashed broker so that a restarted broker can take over
+            # the session from its journal
+            self.disable_death_signalling()
+
+    def get_session_authkey(self):
+        return self.keys[0]
+
     def trace(fn):
         def decorator(self, *vargs, **kwargs):
             try:
@@ -118,19 +160,41 @@ class Session(Control):
 
     # override callback defined by Control class:
     def lost_connection(self, connection, authkey):
+        if connection == self.broker_conn:
+            self.broker_conn = None
+            self.orphaned    = time.time()
+            return
         try:
             if self.get_remote_session(connection):
                 self.shutdown()
         except:
             pass
 
+    # override callback defined by Control class:
+    def idle(self):
+        if self.orphaned and time.time() - self.orphaned > self.grace:
+            self.log('no broker adopted the session')
+            self.shutdown()
+        # the client of an adopted session lost its connection to the broker
+        # in the crash, so the broker cannot tell when the client is done. end
+        # the session when the client stops using it instead
+        if self.adopted and not self.list_clients():
+            self.shutdown()
+
+    def list_clients(self):
+        result = []
+        for connection in self.established:
+            if connection == self.broker_conn:
+                continue
+            if (connection.address in self.r_sessions
+            or  connection.address in self.r_brokers):
+                continue
+            result.append(connection)
+        return result
+
     # need special handling of RPC to find the correct resource before calling
     # the wanted method on it
     def validate_rpc(self, rpc, authkey):
-        try: # welformed json blob?
-            rpc = json.loads(rpc)
-        except Exception, e:
-            raise Exception('malformed JSON: %s' % rpc)
         # mandatory fields present?
         if 'resource' not in rpc:
             raise Exception('the "resource" attribute is missing')
@@ -189,6 +253,26 @@ class Session(Control):
     def get_version(self):
         return 1
 
+    @Control.rpc
+    @Control.auth
+    def set_authkey(self, authkey):
+        # sessions started ahead of time by the broker are bound to a client
+        # when it connects. the key the broker connected with stops working
+        # for new connections
+        self.keys[0] = str(authkey)
+
+    @Control.rpc
+    @Control.auth
+    def set_broker(self):
+        # called by brokers that keep a journal, on their own connection to the
+        # session
+        if not self.grace:
+            raise Exception('session does not outlive its broker')
+        if self.orphaned:
+            self.adopted = True
+        self.orphaned    = None
+        self.broker_conn = self.current_connection
+
     def add_remote_session(self, session, authkey):
         # adds the remote session's connection to the main event loop to get
         # lost_connection() upcalls from Control.
@@ -337,7 +421,7 @@ class Session(Control):
 
                     result.append({
                         'address': list(self.address),
-                        'authkey': self.keys[0],
+                        'authkey': self.get_session_authkey(),
                         'profile': p
                     })
                 responses_map[k] = result
@@ -393,12 +477,171 @@ class Session(Control):
                 resource = self.resources[pp]
                 result.append({
                     'address': list(self.address),
-                    'authkey': self.keys[0],
+                    'authkey': self.get_session_authkey(),
                     'profile': p
                 })
             return result
 
+class HostedState(object):
+    # the book keeping of one session in a SessionHost
+
+    def __init__(self, authkey):
+        self.authkey     = authkey
+        self.resources   = {}
+        self.r_brokers   = {}
+        self.r_sessions  = {}
+        self.r_resources = {}
+        self.deferred    = None
+        self.mdeferred   = []
+        self.lock        = threading.Lock() # held during calls to resources
+
+def hosted_attribute(name):
+    # give Session methods the book keeping of the session that is served
+    def get(self):
+        return getattr(self.get_hosted(), name)
+    def set(self, value):
+        setattr(self.get_hosted(), name, value)
+    return property(get, set)
+
+def offload_resource(method, lock):
+    # calls to resources may block for a long time on equipment I/O. perform
+    # them on a worker thread, one at a time for each session
+    @Control.offload
+    def call(*vargs, **kwargs):
+        with lock:
+            return method(*vargs, **kwargs)
+    return call
+
+class SessionHost(Session):
+    '''
+    Serves many sessions from a single process, as an alternative to one
+    process per session. The broker connects with the host's *authkey* to open
+    sessions. Clients, and the broker itself, then connect with the authkey of
+    a session to use it. Each RPC is handled by the session whose key the
+    connection was authenticated with. A session that is stopped, or that
+    raises ``Exit``, is closed without affecting the others. Calls to the
+    resources of a session are performed on worker threads, so that a slow
+    call does not hold up the other sessions.
+    '''
+    resources   = hosted_attribute('resources')
+    r_brokers   = hosted_attribute('r_brokers')
+    r_sessions  = hosted_attribute('r_sessions')
+    r_resources = hosted_attribute('r_resources')
+    deferred    = hosted_attribute('deferred')
+    mdeferred   = hosted_attribute('mdeferred')
+
+    def __init__(self, port, authkey, broker_addr, socket=None, ws_cfg=None,
+                 home=None, logging=True):
+        validate_broker_addr(broker_addr)
+        Control.__init__(
+            self, port, None, socket, {'broker':authkey}, 1, home,
+            'ave-broker-sessions', logging
+        )
+        self.broker_addr = broker_addr
+        self.ws_cfg      = ws_cfg
+        self.hosted      = {} # authkey -> HostedState
+        self.closing     = [] # authkeys of sessions to close after the RPC
+        # let the resource calls of many sessions run at the same time
+        self.offload_size = 16
+
+    def get_hosted(self, authkey=None):
+        if authkey == None:
+            authkey = self.established.get(self.current_connection)
+        if authkey not in self.hosted:
+            raise Exception('session closed')
+        return self.hosted[authkey]
+
+    def get_session_authkey(self):
+        return self.get_hosted().authkey
+
+    def validate_rpc(self, rpc, authkey):
+        method, resource, vargs, kwargs, async = \
+            Session.validate_rpc(self, rpc, authkey)
+        if hasattr(method, 'ave.control.preauth'):
+            if authkey != self.keys['broker']:
+                raise Exception('not authorized to make this call')
+        if resource != None:
+            method = offload_resource(method, self.get_hosted().lock)
+        return method, resource, vargs, kwargs, async
+
+    def shutdown(self, details=None):
+        for authkey in self.hosted:
+            self.hosted[authkey].resources.clear()
+        Control.shutdown(self, details) # does not return. always do last
+
+    def step_main(self):
+        Control.step_main(self)
+        while self.closing:
+            self.close_hosted(self.closing.pop())
+
+    def close_hosted(self, authkey):
+        if authkey not in self.hosted:
+            return
+        hosted = self.hosted.pop(authkey)
+        del self.keys[authkey]
+        hosted.resources.clear()
+        # drop the connections of clients, of the broker and to other brokers
+        for connection in self.established.keys():
+            if self.established.get(connection) == authkey:
+                self.remove_connection(connection)
+                connection.close()
+
+    # override callback defined by Control class:
+    def exit_rpc(self, connection, exit, rpc_id, codec):
+        # the session that raised Exit is closed, not the host
+        response = { 'exception': exit.details }
+        response = self.encode_response(response, rpc_id, codec)
+        authkey  = self.established.get(connection)
+        self.write_last_message(connection, response)
+        self.close_hosted(authkey)
+
+    # override callback defined by Control class:
+    def new_connection(self, connection, authkey):
+        # a closed session is gone as far as its clients are concerned, just
+        # like the process of a closed Session
+        if authkey == None:
+            self.remove_connection(connection)
+            connection.close()
+
+    # override callback defined by Control class:
+    def lost_connection(self, connection, authkey):
+        # a lost remote session ends the session, like in Session. the caller
+        # removes the lost connection, so close the others afterwards
+        if authkey in self.hosted:
+            if connection.address in self.hosted[authkey].r_sessions:
+                self.closing.append(authkey)
+
+    def add_remote_broker(self, broker, authkey):
+        # track the connections to other brokers as part of the session, so
+        # that they are closed together with it
+        Session.add_remote_broker(self, broker, self.get_session_authkey())
+
+    @Control.rpc
+    @Control.preauth('broker')
+    def open_session(self, authkey):
+        authkey = str(authkey)
+        if authkey in self.hosted:
+            raise Exception('INTERNAL ERROR: session already hosted')
+        self.hosted[authkey] = HostedState(authkey)
+        self.keys[authkey]   = authkey
+
+    @Control.rpc
+    @Control.auth
+    def stop(self):
+        self.closing.append(self.get_session_authkey())
+
+    @Control.rpc
+    @Control.auth
+    def crash(self): # only used for testing purposes
+        self.closing.append(self.get_session_authkey())
+
+    @Control.rpc
+    @Control.auth
+    def set_authkey(self, authkey):
+        raise Exception('hosted sessions cannot be bound to other keys')
+
 class RemoteSession(RemoteControl):
+    pooled = True # sessions only track the connection from the broker
 
     def __init__(
             self, address, authkey, profile=None, timeout=None, optimist=False,
@@ -407,3 +650,17 @@ class RemoteSession(RemoteControl):
         RemoteControl.__init__(
             self, address, authkey, timeout, optimist, sock, profile
         )
+
+class AsyncRemoteSession(AsyncRemoteControl):
+    '''
+    Non-blocking counterpart of ``RemoteSession``. Resources that are allocated
+    with ``AsyncRemoteBroker.get_resources()`` are returned as instances of this
+    class, with the profile of the resource set.
+    '''
+
+    def __init__(
+            self, address, authkey, profile=None, timeout=None, reactor=None
+        ):
+        AsyncRemoteControl.__init__(
+            self, address, authkey, timeout, profile, reactor
+        )
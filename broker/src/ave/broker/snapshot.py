@@ -0,0 +1,95 @@
+# Copyright (C) 2014 Sony Mobile Communications Inc.
+# All rights, including trade secret rights, reserved.
+
+from ave.profile        import Profile, FrozenProfile
+from ave.broker.profile import profile_factory
+
+DELTA_FIELDS = ['added', 'changed', 'removed', 'allocated', 'released']
+
+def make_key(profile):
+    # profiles of different types may use the same kind of unique identifier
+    if not isinstance(profile, Profile):
+        profile = profile_factory(profile)
+    return (profile['type'], profile)
+
+def make_delta():
+    return dict([(field, []) for field in DELTA_FIELDS])
+
+def is_empty(delta):
+    for field in DELTA_FIELDS:
+        if delta[field]:
+            return False
+    return True
+
+class Snapshot(object):
+    '''
+    The equipment and allocations of a sharing broker, as last seen by some
+    other party. Profiles are stored as frozen copies so that later
+    modifications of the listed profiles show up as changes. Unchanged profiles
+    are shared between snapshots and compare by identity.
+
+    :arg equipment: A list of profiles.
+    :arg allocations: A dictionary of lists of allocations, on the form
+        ``{<any>: [{'profile': <profile>, 'collateral': [<profile>, ...]}]}``.
+        This is the format of ``Allocator.serialize()``.
+    '''
+    equipment   = None
+    allocations = None
+
+    def __init__(self, equipment=[], allocations={}):
+        self.equipment   = {} # (type, Profile) -> FrozenProfile
+        self.allocations = {} # (type, Profile) -> frozen allocation dict
+        for profile in equipment:
+            self.equipment[make_key(profile)] = FrozenProfile(profile)
+        for entries in allocations.values():
+            for entry in entries:
+                self.allocations[make_key(entry['profile'])] = FrozenProfile({
+                    'profile'   : entry['profile'],
+                    'collateral': list(entry['collateral'])
+                })
+
+    def copy(self):
+        result = Snapshot()
+        result.equipment   = dict(self.equipment)
+        result.allocations = dict(self.allocations)
+        return result
+
+    def list_equipment(self):
+        return [e.thaw() for e in self.equipment.values()]
+
+    def serialize_allocations(self):
+        return {0: [a.thaw() for a in self.allocations.values()]}
+
+    def diff(self, newer):
+        '''
+        :returns: A delta that turns this snapshot into *newer*.
+        '''
+        delta = make_delta()
+        for key in newer.equipment:
+            if key not in self.equipment:
+                delta['added'].append(newer.equipment[key].thaw())
+            elif self.equipment[key] is not newer.equipment[key]:
+                delta['changed'].append(newer.equipment[key].thaw())
+        for key in self.equipment:
+            if key not in newer.equipment:
+                delta['removed'].append(self.equipment[key].thaw())
+        for key in newer.allocations:
+            if self.allocations.get(key) is not newer.allocations[key]:
+                delta['allocated'].append(newer.allocations[key].thaw())
+        for key in self.allocations:
+            if key not in newer.allocations:
+                delta['released'].append(self.allocations[key]['profile'])
+        return delta
+
+    def patch(self, delta):
+        '''
+        Apply a delta that was produced by ``diff()``.
+        '''
+        for profile in delta['removed']:
+            self.equipment.pop(make_key(profile), None)
+        for profile in delta['added'] + delta['changed']:
+            self.equipment[make_key(profile)] = FrozenProfile(profile)
+        for profile in delta['released']:
+            self.allocations.pop(make_key(profile), None)
+        for entry in delta['allocated']:
+            self.allocations[make_key(entry['profile'])] = FrozenProfile(entry)
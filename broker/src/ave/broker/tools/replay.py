@@ -0,0 +1,291 @@
+# Copyright (C) 2014 Sony Mobile Communications Inc.
+# All rights, including trade secret rights, reserved.
+
+'''
+Replay a trace written by ``ave.broker.recorder.Recorder`` against an allocator
+in the current process, without any sockets or session processes, to measure
+how allocation behaves under recorded lab traffic.
+'''
+
+import sys
+import time
+import getopt
+
+import ave.config
+
+from ave.base_workspace     import BaseWorkspaceProfile
+from ave.broker.profile     import profile_factory
+from ave.broker.allocator   import LocalAllocator, ShareAllocator
+from ave.broker.exceptions  import Busy, NoSuch, Shared
+from ave.broker.recorder    import load_trace
+from ave.broker.snapshot    import make_delta
+
+usage = '''
+Syntax: ave-broker-replay [options] <trace>
+
+Options:
+    --help                    Display this message
+    --allocator=local|share   Replay against a LocalAllocator (default) or a
+                              ShareAllocator
+
+Traces are written by brokers that have the "record" setting in broker.json or
+that were told to start_recording().
+'''
+
+class ReplaySession(object):
+    address = None
+
+    def __init__(self, number):
+        self.authkey = 'replay-%d' % number
+
+    def add_resource(self, resource):
+        pass
+
+class ReplayLocalAllocator(LocalAllocator):
+
+    def deallocate_relay(self, resource):
+        pass # there is no relay server to talk to
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def is_workspace(profile):
+    return isinstance(profile, BaseWorkspaceProfile)
+
+def convert(profiles):
+    # workspaces are created on demand and have nothing to do with contention
+    # over equipment
+    result = [profile_factory(p) for p in profiles]
+    return [p for p in result if not is_workspace(p)]
+
+class Replay(object):
+    '''
+    Feeds the events of a trace to an allocator. Requests that were recorded
+    as waiting are not replayed until they are recorded as allocated. Time is
+    taken from the trace when utilisation is computed, but the allocator calls
+    are made back to back.
+
+    :arg kind: Either ``"local"`` or ``"share"``.
+    '''
+
+    def __init__(self, kind='local', home=None):
+        if kind == 'local':
+            self.allocator = ReplayLocalAllocator(home, None)
+        elif kind == 'share':
+            self.allocator = ShareAllocator(('replay', 0))
+            self.allocator.set_equipment([], {}, 0)
+        else:
+            raise Exception('unknown allocator kind: %s' % kind)
+        self.kind      = kind
+        self.sessions  = {} # trace sequence number -> (None, ReplaySession)
+        self.latencies = [] # seconds per replayed request
+        self.counts    = {
+            'events':0, 'gets':0, 'allocated':0, 'busy':0, 'nosuch':0,
+            'skipped':0
+        }
+        self.last      = 0.0 # trace time of the last event
+        self.busy_time = 0.0 # integral of allocated equipment over trace time
+        self.full_time = 0.0 # integral of listed equipment over trace time
+        self.wall      = 0.0 # seconds spent in allocator calls
+
+    def get_session(self, number):
+        if number not in self.sessions:
+            # the allocators expect (Session, RemoteSession) tuples
+            self.sessions[number] = (None, ReplaySession(number))
+        return self.sessions[number]
+
+    def count_allocated(self):
+        return len([
+            p for p in self.allocator.allocations if not is_workspace(p)
+        ])
+
+    def count_equipment(self):
+        return len([
+            p for p in self.allocator.equipment if not is_workspace(p)
+        ]) + len(self.allocator.withheld if self.kind == 'share' else [])
+
+    def advance(self, now):
+        if now > self.last:
+            self.busy_time += self.count_allocated() * (now - self.last)
+            self.full_time += self.count_equipment() * (now - self.last)
+            self.last = now
+
+    def update_share(self, **changes):
+        # stands in for the next update from the share, which also lists the
+        # withheld equipment again
+        delta   = make_delta()
+        delta.update(changes)
+        version = self.allocator.version
+        self.allocator.apply_delta(version, version + 1, delta)
+
+    def set_equipment(self, profiles):
+        profiles = convert(profiles)
+        if self.kind == 'share':
+            self.allocator.set_equipment(profiles, {}, 0)
+        else:
+            self.allocator.add_equipment(profiles)
+
+    def add_equipment(self, profiles):
+        profiles = convert(profiles)
+        if self.kind == 'share':
+            self.update_share(added=profiles)
+        else:
+            self.allocator.add_equipment(profiles)
+
+    def remove_equipment(self, profiles):
+        profiles = convert(profiles)
+        if self.kind == 'share':
+            return self.update_share(removed=profiles)
+        for p in profiles:
+            if p in self.allocator.equipment:
+                self.allocator.remove_equipment(p)
+
+    def allocate(self, session, profiles):
+        try:
+            self.allocator.get_resources(profiles, session[1])
+        except Shared:
+            pass # the share would have been asked to finish the allocation
+
+    def get(self, session, requests):
+        requests = [convert(r) for r in requests]
+        requests = [r for r in requests if r]
+        if not requests:
+            self.counts['skipped'] += 1
+            return
+        self.counts['gets'] += 1
+        start = time.time()
+        try:
+            for profiles in requests:
+                self.allocate(session, profiles)
+            outcome = 'allocated'
+        except Busy:
+            outcome = 'busy'
+        except NoSuch:
+            outcome = 'nosuch'
+        self.latencies.append(time.time() - start)
+        self.counts[outcome] += 1
+
+    def yield_resources(self, session, profiles):
+        owned = self.allocator.list_allocations(session[1])
+        for p in convert(profiles):
+            # the replayed allocation may have picked other equipment than the
+            # recorded one. yield the same kind of equipment in that case
+            if p not in owned:
+                p = ([o for o in owned if o['type'] == p['type']] or [None])[0]
+            if p is None:
+                self.counts['skipped'] += 1
+                continue
+            self.allocator.yield_resource(session[1], p)
+            owned.remove(p)
+        if self.kind == 'share':
+            self.update_share()
+
+    def close(self, session):
+        self.allocator.close_session(session)
+        if self.kind == 'share':
+            self.update_share()
+
+    def run(self, events):
+        for event in events:
+            name, now, fields = event[0], event[1], event[2:]
+            self.advance(now)
+            self.counts['events'] += 1
+            start = time.time()
+            if name == 'stacks':
+                self.allocator.set_stacks(fields[0])
+            elif name == 'equipment':
+                self.set_equipment(fields[0])
+            elif name == 'add_equipment':
+                self.add_equipment(fields[0])
+            elif name == 'remove_equipment':
+                self.remove_equipment(fields[0])
+            elif name in ['get', 'get_multi']:
+                if fields[2] == 'waiting':
+                    self.counts['skipped'] += 1
+                elif name == 'get':
+                    self.get(self.get_session(fields[0]), [fields[1]])
+                else:
+                    self.get(self.get_session(fields[0]), fields[1])
+            elif name == 'yield':
+                self.yield_resources(self.get_session(fields[0]), fields[1])
+            elif name == 'close':
+                self.close(self.get_session(fields[0]))
+                del self.sessions[fields[0]]
+            else:
+                raise Exception('unknown event in trace: %s' % name)
+            self.wall += time.time() - start
+        return self.report()
+
+    def report(self):
+        result = dict(self.counts)
+        result['busy_rate'] = 0.0
+        if self.counts['gets']:
+            result['busy_rate'] = self.counts['busy'] / float(self.counts['gets'])
+        result['wall_time']   = self.wall
+        result['throughput']  = 0.0
+        if self.wall:
+            result['throughput'] = self.counts['events'] / self.wall
+        result['p50'] = percentile(self.latencies, 0.50) * 1000 # milliseconds
+        result['p99'] = percentile(self.latencies, 0.99) * 1000
+        result['utilisation'] = 0.0
+        if self.full_time:
+            result['utilisation'] = self.busy_time / self.full_time
+        return result
+
+def replay(path, kind='local', home=None):
+    '''
+    Replay the trace in the file *path*.
+
+    :returns: A dictionary with the number of replayed ``events`` and requests
+        (``gets``), how many of the requests were ``allocated``, ``busy`` or
+        ``nosuch``, the ``busy_rate``, the ``wall_time`` spent in the allocator,
+        the ``throughput`` in events per second, the ``p50`` and ``p99``
+        request latencies in milliseconds and the ``utilisation`` of the
+        equipment over the recorded time.
+    '''
+    return Replay(kind, home).run(load_trace(path))
+
+def format_report(report):
+    lines = [
+        'events      : %d' % report['events'],
+        'requests    : %d' % report['gets'],
+        'allocated   : %d' % report['allocated'],
+        'busy        : %d (%.1f%%)' % (report['busy'], report['busy_rate']*100),
+        'nosuch      : %d' % report['nosuch'],
+        'skipped     : %d' % report['skipped'],
+        'wall time   : %.3f s' % report['wall_time'],
+        'throughput  : %.0f events/s' % report['throughput'],
+        'latency p50 : %.3f ms' % report['p50'],
+        'latency p99 : %.3f ms' % report['p99'],
+        'utilisation : %.1f%%' % (report['utilisation'] * 100)
+    ]
+    return '\n'.join(lines)
+
+def main(argv):
+    try:
+        (opts, args) = getopt.getopt(argv[1:], '', ['help', 'allocator='])
+    except getopt.GetoptError, e:
+        print(usage)
+        return 1
+    kind = 'local'
+    for o, a in opts:
+        if o == '--help':
+            print(usage)
+            return 0
+        if o == '--allocator':
+            kind = a
+    if len(args) != 1 or kind not in ['local', 'share']:
+        print(usage)
+        return 1
+    home = None
+    if kind == 'local':
+        home = ave.config.load_etc()['home']
+    try:
+        print(format_report(replay(args[0], kind, home)))
+    except Exception, e:
+        print('ERROR: could not replay %s: %s' % (args[0], e))
+        return 2
+    return 0
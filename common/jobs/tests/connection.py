@@ -361,3 +361,160 @@ def t10():
     pinger.join()
 
     return result
+
+# check that a large message is received intact by a blocking connection
+def t11():
+    pretty = '%s t11' % __file__
+    print(pretty)
+
+    payload = ''.join([chr(i % 256) for i in range(1024*1024*4)])
+
+    class Ping(Process):
+
+        def close_fds(self, exclude=[]):
+            exclude.append(self.args[1].fileno())
+            Process.close_fds(self, exclude)
+
+        def run(self, port, sock):
+            listener = BlockingConnection(('', port), socket=sock)
+            c = listener.accept(timeout=3)
+            c.put(payload, timeout=5)
+            while True:
+                time.sleep(1)
+
+    def test(port):
+        c = BlockingConnection(('', port))
+        c.connect(timeout=3)
+        try:
+            msg = c.get(timeout=5)
+        except Exception, e:
+            print('FAIL %s: get() failed: %s' % (pretty, e))
+            return False
+        if type(msg) != str:
+            print('FAIL %s: wrong message type: %s' % (pretty, type(msg)))
+            return False
+        if msg != payload:
+            print('FAIL %s: wrong message: %d bytes' % (pretty, len(msg)))
+            return False
+        return True
+
+    sock,port = find_free_port()
+    pinger = Ping(args=(port,sock))
+    pinger.start()
+
+    result = test(port)
+
+    pinger.terminate()
+    pinger.join()
+
+    return result
+
+# check that a non-blocking connection assembles a message that arrives in many
+# small pieces, and that empty messages can be received
+def t12():
+    pretty = '%s t12' % __file__
+    print(pretty)
+
+    a, b = socket.socketpair()
+    a.setblocking(0)
+    b.setblocking(0)
+    reader = Connection(None, a)
+    writer = Connection(None, b)
+
+    message = Connection.make_header('hello world') + 'hello world'
+    for i in range(len(message)):
+        if reader.get() != None:
+            print('FAIL %s: got message before it was complete' % pretty)
+            return False
+        writer.write(message[i])
+    msg = reader.get()
+    if msg != 'hello world':
+        print('FAIL %s: wrong message: %s' % (pretty, msg))
+        return False
+
+    writer.write(Connection.make_header(''))
+    msg = reader.get()
+    if msg != '':
+        print('FAIL %s: wrong empty message: %r' % (pretty, msg))
+        return False
+
+    return True
+
+# check that an output queue coalesces small messages into one write, writes
+# large messages in slices, and refuses to grow beyond its limit
+def t13():
+    pretty = '%s t13' % __file__
+    print(pretty)
+
+    class CountingConnection(Connection):
+        writes = 0
+
+        def write(self, obj):
+            self.writes += 1
+            return Connection.write(self, obj)
+
+    a, b = socket.socketpair()
+    a.setblocking(0)
+    b.setblocking(0)
+    reader = Connection(None, a)
+    writer = CountingConnection(None, b)
+
+    queue = OutputQueue()
+    for i in range(10):
+        queue.append('message %d' % i)
+    if not queue.flush(writer):
+        print('FAIL %s: small messages not flushed' % pretty)
+        return False
+    if writer.writes != 1:
+        print('FAIL %s: wrong number of writes: %d' % (pretty, writer.writes))
+        return False
+    for i in range(10):
+        msg = reader.get()
+        if msg != 'message %d' % i:
+            print('FAIL %s: wrong message %d: %s' % (pretty, i, msg))
+            return False
+
+    # the socket buffer can't hold the large message. read while flushing
+    payload = ''.join([chr(i % 256) for i in range(1024*1024)])
+    queue.append(payload)
+    queue.append('last')
+    received = []
+    for i in range(10000):
+        done = queue.flush(writer)
+        msg = reader.get()
+        while msg != None:
+            received.append(msg)
+            msg = reader.get()
+        if done and len(received) == 2:
+            break
+    if received != [payload, 'last']:
+        print('FAIL %s: wrong messages: %s' % (pretty, [len(r) for r in received]))
+        return False
+    if len(queue) != 0:
+        print('FAIL %s: queue not empty: %d' % (pretty, len(queue)))
+        return False
+
+    queue = OutputQueue(limit=100)
+    queue.append('x' * 50)
+    try:
+        queue.append('x' * 50)
+        print('FAIL %s: queue grew beyond its limit' % pretty)
+        return False
+    except ConnectionFull:
+        pass
+
+    # a single message larger than the limit is accepted by an empty queue
+    queue = OutputQueue(limit=100)
+    try:
+        queue.append('x' * 150)
+    except ConnectionFull:
+        print('FAIL %s: large message refused by empty queue' % pretty)
+        return False
+    try:
+        queue.append('x')
+        print('FAIL %s: queue grew beyond its limit' % pretty)
+        return False
+    except ConnectionFull:
+        pass
+
+    return True
@@ -15,12 +15,15 @@ import traceback
 from datetime import datetime
 
 import ave.cmd
+import ave.network.codec
 
 from ave.network.control    import Control, RemoteControl, Exit
 from ave.network.connection import *
 from ave.network.exceptions import *
 from ave.network.pipe       import Pipe
+from ave.network.pool       import ConnectionPool
 from ave.network.process    import Process
+from ave.network.reactor    import Reactor, AsyncRemoteControl
 
 from decorators import smoke
 from setup      import MockControl
@@ -1118,3 +1121,622 @@ def t38(control, remote, queue):
         return False
 
     return True
+
+# check that several calls can be in flight on the same connection and that
+# the responses are matched against the right calls, even when they are
+# collected in a different order than the calls were made.
+@setup(MockControl)
+def t39(control, remote, pipe):
+    pretty = '%s t39' % __file__
+    print(pretty)
+
+    pipeline = remote.pipeline()
+    try:
+        pending = [pipeline.sync_ping('ping %d' % i) for i in range(10)]
+        failing = pipeline.raise_plain_exception('pipelined')
+    except Exception, e:
+        print('FAIL %s: could not pipeline calls: %s' % (pretty, e))
+        return False
+
+    # a regular call made while the pipelined calls are in flight
+    try:
+        response = remote.sync_ping('regular')
+    except Exception, e:
+        print('FAIL %s: regular call failed: %s' % (pretty, e))
+        return False
+    if response != 'regular':
+        print('FAIL %s: wrong regular response: %s' % (pretty, response))
+        return False
+
+    for i in reversed(range(10)):
+        response = pending[i].result()
+        if response != 'ping %d' % i:
+            print('FAIL %s: wrong response %d: %s' % (pretty, i, response))
+            return False
+
+    try:
+        failing.result()
+        print('FAIL %s: pipelined exception was not raised' % pretty)
+        return False
+    except AveException, e:
+        if e.message != 'pipelined':
+            print('FAIL %s: wrong exception: %s' % (pretty, e))
+            return False
+
+    return True
+
+# check that the control echoes the request ID of tagged calls and leaves the
+# responses of untagged calls unchanged
+@setup(MockControl)
+def t40(control, remote, pipe):
+    pretty = '%s t40' % __file__
+    print(pretty)
+
+    remote.sync_ping() # make sure the connection is established
+
+    blob = RemoteControl.make_rpc_blob('sync_ping', None, __id__=17)
+    remote._connection.put(blob)
+    response = json.loads(remote._connection.get(timeout=3))
+    if response != {'id': 17, 'result': 'pong'}:
+        print('FAIL %s: wrong tagged response: %s' % (pretty, response))
+        return False
+
+    blob = RemoteControl.make_rpc_blob('sync_ping', None)
+    remote._connection.put(blob)
+    response = json.loads(remote._connection.get(timeout=3))
+    if response != {'result': 'pong'}:
+        print('FAIL %s: wrong untagged response: %s' % (pretty, response))
+        return False
+
+    return True
+
+# check that a batch of calls is performed in order in a single round trip and
+# that a failing call does not affect the others
+@setup(MockControl)
+def t41(control, remote, pipe):
+    pretty = '%s t41' % __file__
+    print(pretty)
+
+    try:
+        with remote.batch() as batch:
+            first   = batch.sync_ping('first')
+            failing = batch.raise_plain_exception('batched')
+            missing = batch.no_such_method()
+            last    = batch.upper('last')
+    except Exception, e:
+        print('FAIL %s: could not send batch: %s' % (pretty, e))
+        return False
+
+    if first.result() != 'first':
+        print('FAIL %s: wrong first result: %s' % (pretty, first.result()))
+        return False
+    if last.result() != 'LAST':
+        print('FAIL %s: wrong last result: %s' % (pretty, last.result()))
+        return False
+    try:
+        failing.result()
+        print('FAIL %s: batched exception was not raised' % pretty)
+        return False
+    except AveException, e:
+        if e.message != 'batched':
+            print('FAIL %s: wrong exception: %s' % (pretty, e))
+            return False
+    try:
+        missing.result()
+        print('FAIL %s: call to missing method did not fail' % pretty)
+        return False
+    except Exception, e:
+        if 'no such RPC' not in str(e):
+            print('FAIL %s: wrong exception: %s' % (pretty, e))
+            return False
+
+    # the connection must still be usable for regular calls
+    if remote.sync_ping() != 'pong':
+        print('FAIL %s: connection broken after batch' % pretty)
+        return False
+
+    return True
+
+# check that results are not available before the batch has been sent and that
+# nothing is sent if the batch context raises an exception
+@setup(MockControl)
+def t42(control, remote, pipe):
+    pretty = '%s t42' % __file__
+    print(pretty)
+
+    batch = remote.batch()
+    pending = batch.sync_ping()
+    try:
+        pending.result()
+        print('FAIL %s: got result before batch was sent' % pretty)
+        return False
+    except Exception, e:
+        if str(e) != 'batch has not been sent yet':
+            print('FAIL %s: wrong exception: %s' % (pretty, e))
+            return False
+
+    try:
+        with remote.batch() as batch:
+            batch.stop()
+            raise Exception('abort')
+    except Exception, e:
+        if str(e) != 'abort':
+            print('FAIL %s: wrong exception: %s' % (pretty, e))
+            return False
+
+    # the control must still be alive
+    if remote.sync_ping() != 'pong':
+        print('FAIL %s: batch was sent anyway' % pretty)
+        return False
+
+    return True
+
+# check that a client and a control negotiate the binary codec and that calls
+# made with it return the same objects as calls made with JSON
+@setup(MockControl)
+def t43(control, remote, pipe):
+    pretty = '%s t43' % __file__
+    print(pretty)
+
+    plain = RemoteControl(remote.address, remote.authkey, 5)
+    plain.codecs = ['json']
+
+    arg = {'a':('b', 1), 2:[None, True, 1.5, u'ä', 'ö'], 'c':{}, 'd':()}
+    try:
+        binary = remote.sync_ping(arg)
+        text   = plain.sync_ping(arg)
+    except Exception, e:
+        print('FAIL %s: call failed: %s' % (pretty, e))
+        return False
+
+    if remote._codec != 'marshal':
+        print('FAIL %s: binary codec not negotiated: %s' % (pretty,remote._codec))
+        return False
+    if plain._codec != 'json':
+        print('FAIL %s: JSON not used: %s' % (pretty, plain._codec))
+        return False
+    if binary != text or repr(binary) != repr(text):
+        print('FAIL %s: results differ: %s != %s' % (pretty, binary, text))
+        return False
+
+    try:
+        remote.raise_plain_exception('binary')
+        print('FAIL %s: exception was not raised' % pretty)
+        return False
+    except AveException, e:
+        if e.message != 'binary':
+            print('FAIL %s: wrong exception: %s' % (pretty, e))
+            return False
+
+    return True
+
+# check that a client falls back on JSON if the control does not advertise any
+# codecs, like controls that predate codec negotiation
+def t44():
+    pretty = '%s t44' % __file__
+    print(pretty)
+
+    class OldControl(MockControl):
+        codecs = []
+
+    sock, port = find_free_port()
+    control = OldControl(port, 'password', sock)
+    control.start()
+    remote = RemoteControl(('', port), 'password', 5)
+
+    result = True
+    try:
+        if remote.upper('old') != 'OLD':
+            print('FAIL %s: wrong response' % pretty)
+            result = False
+        elif remote._codec != 'json':
+            print('FAIL %s: wrong codec: %s' % (pretty, remote._codec))
+            result = False
+    except Exception, e:
+        print('FAIL %s: call failed: %s' % (pretty, e))
+        result = False
+
+    control.terminate()
+    control.join()
+    return result
+
+# check that a pooled RemoteControl gives its connection back to the pool when
+# it is garbage collected and that the next one with the same address and
+# authkey borrows it instead of connecting again
+@setup(MockControl)
+def t45(control, remote, pipe):
+    pretty = '%s t45' % __file__
+    print(pretty)
+
+    class PooledControl(RemoteControl):
+        pooled = True
+        pool   = ConnectionPool()
+
+    first = PooledControl(remote.address, remote.authkey, 5)
+    first.sync_ping()
+    connection = first._connection
+    del first
+    if len(PooledControl.pool) != 1:
+        print('FAIL %s: connection not pooled' % pretty)
+        return False
+
+    second = PooledControl(remote.address, remote.authkey, 5)
+    if second.sync_ping() != 'pong':
+        print('FAIL %s: wrong response on borrowed connection' % pretty)
+        return False
+    if second._connection is not connection:
+        print('FAIL %s: connection not borrowed' % pretty)
+        return False
+
+    # a different authkey must not get the same connection
+    other = PooledControl(remote.address, None, 5)
+    other.sync_ping()
+    if other._connection is connection:
+        print('FAIL %s: connection borrowed with wrong authkey' % pretty)
+        return False
+
+    # a connection with an unanswered call must not be pooled
+    del other
+    second._outstanding.append(None) # pretend that a call timed out
+    del second
+    if len(PooledControl.pool) != 1:
+        print('FAIL %s: wrong pool size: %d' % (pretty,len(PooledControl.pool)))
+        return False
+
+    return True
+
+# check that the pool discards connections that were closed by the peer, that
+# have been idle too long, or that exceed the size limit
+def t46():
+    pretty = '%s t46' % __file__
+    print(pretty)
+
+    sock, port = find_free_port()
+    control = MockControl(port, 'password', sock)
+    control.start()
+    key = (('', port), 'password')
+
+    def make_connection():
+        remote = RemoteControl(('', port), 'password', 5)
+        return remote.make_connection(5) # not owned by the RemoteControl
+
+    result = True
+    pool = ConnectionPool(size=1, idle=60)
+    first  = make_connection()
+    second = make_connection()
+    pool.give(key, first, 'json')
+    pool.give(key, second, 'json')
+    if len(pool) != 1 or pool.take(key) != (second, 'json'):
+        print('FAIL %s: size limit not enforced' % pretty)
+        result = False
+
+    pool = ConnectionPool(size=1, idle=0)
+    pool.give(key, make_connection(), 'json')
+    time.sleep(0.1)
+    if pool.take(key) != None:
+        print('FAIL %s: idle connection not evicted' % pretty)
+        result = False
+
+    pool = ConnectionPool()
+    pool.give(key, make_connection(), 'json')
+    control.terminate()
+    control.join()
+    time.sleep(0.5)
+    if pool.take(key) != None:
+        print('FAIL %s: closed connection was borrowed' % pretty)
+        result = False
+
+    return result
+
+# check that messages queued by the control are written before the response to
+# the call that queued them, also when they don't fit in the socket buffer
+@setup(MockControl)
+def t47(control, remote, pipe):
+    pretty = '%s t47' % __file__
+    print(pretty)
+
+    large = 'x' * 1024 * 1024
+    remote.connect(5)
+    connection = remote._connection
+    connection.put(RemoteControl.make_rpc_blob('push', None, 'a', large), 5)
+    connection.put(RemoteControl.make_rpc_blob('sync_ping', None), 5)
+
+    expected = [{'pushed':'a'}, {'pushed':large}, {'result':None}]
+    expected.append({'result':'pong'})
+    for i in range(len(expected)):
+        try:
+            msg = json.loads(connection.get(timeout=5))
+        except Exception, e:
+            print('FAIL %s: could not get message %d: %s' % (pretty, i, e))
+            return False
+        if msg != expected[i]:
+            print('FAIL %s: wrong message %d: %.80s' % (pretty, i, msg))
+            return False
+
+    return True
+
+# check that an offloaded call does not stop the control from serving other
+# clients, and that the calls of each client are still performed in order
+@setup(MockControl)
+def t48(control, remote, pipe):
+    pretty = '%s t48' % __file__
+    print(pretty)
+
+    remote.connect(5)
+    connection = remote._connection
+    connection.put(RemoteControl.make_rpc_blob('offloaded_sleep', None, 1), 5)
+    connection.put(RemoteControl.make_rpc_blob('upper', None, 'after'), 5)
+
+    other = RemoteControl(remote.address, remote.authkey, 5)
+    start = time.time()
+    if other.sync_ping() != 'pong':
+        print('FAIL %s: wrong response from other client' % pretty)
+        return False
+    if time.time() - start > 0.5:
+        print('FAIL %s: other client was blocked' % pretty)
+        return False
+
+    expected = [{'result':1}, {'result':'AFTER'}]
+    for i in range(len(expected)):
+        try:
+            msg = json.loads(connection.get(timeout=5))
+        except Exception, e:
+            print('FAIL %s: could not get response %d: %s' % (pretty, i, e))
+            return False
+        if msg != expected[i]:
+            print('FAIL %s: wrong response %d: %s' % (pretty, i, msg))
+            return False
+
+    # exceptions in offloaded calls are passed to the client as usual
+    try:
+        other.offloaded_sleep(0, 'offloaded')
+        print('FAIL %s: exception not raised' % pretty)
+        return False
+    except AveException, e:
+        if e.message != 'offloaded':
+            print('FAIL %s: wrong exception: %s' % (pretty, e))
+            return False
+
+    return True
+
+# check that a single reactor drives calls on many connections at the same time
+# and that results and exceptions are passed to the futures
+@setup(MockControl)
+def t49(control, remote, pipe):
+    pretty = '%s t49' % __file__
+    print(pretty)
+
+    reactor = Reactor()
+    clients = [
+        AsyncRemoteControl(remote.address, remote.authkey, 5, reactor=reactor)
+        for i in range(3)
+    ]
+    start   = time.time()
+    sleeps  = [c.offloaded_sleep(1) for c in clients]
+    ping    = clients[0].sync_ping()
+    upper   = clients[1].upper('hello')
+    failing = clients[2].raise_plain_exception('async')
+    done, pending = reactor.wait(sleeps + [ping, upper, failing], 5)
+    if pending:
+        print('FAIL %s: calls did not complete: %s' % (pretty, pending))
+        return False
+    if time.time() - start > 1.8:
+        print('FAIL %s: calls were not concurrent' % pretty)
+        return False
+
+    if [s.result() for s in sleeps] != [1, 1, 1]:
+        print('FAIL %s: wrong sleep results: %s' % (pretty, sleeps))
+        return False
+    if ping.result() != 'pong' or upper.result() != 'HELLO':
+        print('FAIL %s: wrong results: %s %s' % (pretty, ping, upper))
+        return False
+    try:
+        failing.result()
+        print('FAIL %s: exception not raised' % pretty)
+        return False
+    except AveException, e:
+        if e.message != 'async':
+            print('FAIL %s: wrong exception: %s' % (pretty, e))
+            return False
+
+    # the clients keep their connections
+    if reactor.run(clients[0].sync_ping('again'), 5) != 'again':
+        print('FAIL %s: connection not reused' % pretty)
+        return False
+
+    return True
+
+# check that calls on an AsyncRemoteControl time out and that connection errors
+# are passed to the futures
+@setup(MockControl)
+def t50(control, remote, pipe):
+    pretty = '%s t50' % __file__
+    print(pretty)
+
+    reactor = Reactor()
+    client  = AsyncRemoteControl(remote.address, remote.authkey, 0.5, None,
+        reactor)
+    try:
+        reactor.run(client.offloaded_sleep(2), 5)
+        print('FAIL %s: call did not time out' % pretty)
+        return False
+    except ConnectionTimeout:
+        pass
+
+    sock, port = find_free_port(listen=False)
+    sock.close()
+    refused = AsyncRemoteControl(('',port), None, 5, None, reactor)
+    try:
+        reactor.run(refused.sync_ping(), 5)
+        print('FAIL %s: call on refused connection succeeded' % pretty)
+        return False
+    except ConnectionRefused:
+        pass
+
+    # the peer closes the connection when it exits. the call fails with the
+    # exit exception
+    client = AsyncRemoteControl(remote.address, remote.authkey, 5, None, reactor)
+    try:
+        reactor.run(client.raise_exit('bye'), 5)
+        print('FAIL %s: exit not raised' % pretty)
+        return False
+    except Exit, e:
+        if e.message != 'bye':
+            print('FAIL %s: wrong exit message: %s' % (pretty, e))
+            return False
+
+    return True
+
+# check that the control keeps per-method call statistics and reports them
+# with the built-in get_rpc_stats() RPC
+@setup(MockControl)
+def t51(control, remote, pipe):
+    pretty = '%s t51' % __file__
+    print(pretty)
+
+    for i in range(3):
+        remote.sync_ping()
+    try:
+        remote.raise_plain_exception('hello')
+    except Exception:
+        pass
+    try:
+        remote.no_such_method()
+    except Exception:
+        pass
+    remote.offloaded_sleep(0.1)
+
+    stats = remote.get_rpc_stats()
+    methods = stats['methods']
+
+    ping = methods['sync_ping']
+    if ping['calls'] != 3 or ping['errors'] != 0:
+        print('FAIL %s: wrong ping counters: %s' % (pretty, ping))
+        return False
+    for phase in ['validate', 'execute', 'serialize', 'send']:
+        if ping[phase]['count'] != 3:
+            print('FAIL %s: wrong %s count: %s' % (pretty, phase, ping[phase]))
+            return False
+        if sum(ping[phase]['histogram']) != 3:
+            print('FAIL %s: wrong %s histogram: %s' % (pretty, phase, ping))
+            return False
+        if len(ping[phase]['histogram']) != len(stats['bounds']) + 1:
+            print('FAIL %s: wrong number of buckets: %s' % (pretty, ping))
+            return False
+    if methods['raise_plain_exception']['errors'] != 1:
+        print('FAIL %s: error not counted: %s' % (pretty, methods))
+        return False
+    if stats['invalid'] != 1:
+        print('FAIL %s: invalid call not counted: %s' % (pretty, stats))
+        return False
+    if methods['offloaded_sleep']['execute']['total'] < 0.1:
+        print('FAIL %s: wrong offloaded execution time: %s' % (pretty,methods))
+        return False
+    # the call to get_rpc_stats() itself has not been answered yet
+    if methods['get_rpc_stats']['send']['count'] != 0:
+        print('FAIL %s: stats call already sent: %s' % (pretty, methods))
+        return False
+    if stats['connections']['established'] != 1:
+        print('FAIL %s: wrong connection count: %s' % (pretty, stats))
+        return False
+    expected = {'connections':0, 'bytes':0, 'offloaded':0, 'deferred':0}
+    if stats['queues'] != expected:
+        print('FAIL %s: wrong queue stats: %s' % (pretty, stats['queues']))
+        return False
+
+    # the statistics are not shown to callers that did not authenticate
+    try:
+        RemoteControl(remote.address, None, 5).get_rpc_stats()
+        print('FAIL %s: unauthenticated caller got stats' % pretty)
+        return False
+    except Exception, e:
+        if 'not authenticated' not in str(e):
+            print('FAIL %s: wrong error: %s' % (pretty, e))
+            return False
+
+    return True
+
+# check that a control only decodes binary payloads from clients that declared
+# the binary codec in the handshake and authenticated with a key. marshal would
+# otherwise let anonymous peers make the control allocate huge objects
+@setup(MockControl)
+def t52(control, remote, pipe):
+    pretty = '%s t52' % __file__
+    print(pretty)
+
+    # a wellformed call, so that only the codec check can refuse it
+    blob = ave.network.codec.encode(ave.network.codec.jsonify(
+        RemoteControl.make_rpc_dict('sync_ping', None)
+    ), 'marshal')
+
+    def attempt(authkey, codec):
+        conn = BlockingConnection(remote.address)
+        conn.connect()
+        digest = make_digest(conn.get(), authkey)
+        conn.put(digest + ave.network.codec.declare(codec))
+        try:
+            finish_challenge(conn.get())
+        except AuthError:
+            pass # anonymous clients may still make calls
+        conn.put(blob)
+        response = json.loads(conn.get(timeout=5))
+        conn.close()
+        return response
+
+    for authkey, codec in [('password', 'json'), ('', 'marshal')]:
+        try:
+            response = attempt(authkey, codec)
+        except Exception, e:
+            print('FAIL %s: refusal not received: %s' % (pretty, e))
+            return False
+        if 'exception' not in response or 'result' in response:
+            print('FAIL %s: binary payload accepted: %s' % (pretty, response))
+            return False
+
+    # the client does not even try the binary codec without a key
+    anonymous = RemoteControl(remote.address, None, 5)
+    if anonymous.sync_ping() != 'pong':
+        print('FAIL %s: anonymous call failed' % pretty)
+        return False
+    if anonymous._codec != 'json':
+        print('FAIL %s: anonymous client used %s' % (pretty, anonymous._codec))
+        return False
+
+    # the control survived and still talks marshal with authenticated clients
+    if remote.sync_ping() != 'pong' or remote._codec != 'marshal':
+        print('FAIL %s: binary codec broken: %s' % (pretty, remote._codec))
+        return False
+
+    return True
+
+# check that a response larger than the output queue limit is still sent when
+# nothing else is queued for the connection
+def t53():
+    pretty = '%s t53' % __file__
+    print(pretty)
+
+    class SmallQueue(MockControl):
+        def __init__(self, *vargs, **kwargs):
+            MockControl.__init__(self, *vargs, **kwargs)
+            self.out_limit = 1000
+
+    sock, port = find_free_port()
+    control = SmallQueue(port, 'password', sock)
+    control.start()
+    remote = RemoteControl(('', port), 'password', 5)
+
+    result = True
+    try:
+        if remote.upper('a' * 5000) != 'A' * 5000:
+            print('FAIL %s: wrong response' % pretty)
+            result = False
+        elif remote.sync_ping() != 'pong':
+            print('FAIL %s: connection lost' % pretty)
+            result = False
+    except Exception, e:
+        print('FAIL %s: call failed: %s' % (pretty, e))
+        result = False
+
+    control.terminate()
+    control.join()
+    return result
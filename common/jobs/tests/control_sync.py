@@ -380,6 +380,47 @@ def t09():
 
     return True
 
+# check that both event polling backends step through connection, handshake,
+# RPC and disconnection in the same number of steps
+def t10():
+    pretty = '%s t10' % __file__
+    print(pretty)
+
+    for backend in ['poll', 'epoll']:
+        sock,port = find_free_port()
+        pipe = Pipe()
+        ctrl = StepControl(port, 'password', sock, {'admin':None}, pipe, 0.1)
+        ctrl.poll_backend = backend
+        ctrl.initialize()
+        conn = BlockingConnection(('',port))
+
+        try:
+            step_connect(conn, ctrl)
+            step_authenticate(conn, ctrl, 'password')
+            pipe.get(timeout=1) # throw away new_connection indication
+            rpc = RemoteControl.make_rpc_blob('upper', None, 'a')
+            msg = step_call(conn, ctrl, rpc)
+        except Exception, e:
+            print('FAIL %s: %s backend failed: %s' % (pretty, backend, e))
+            return False
+        if msg != {'result': 'A'}:
+            print('FAIL %s: wrong %s response: %s' % (pretty, backend, msg))
+            return False
+
+        conn.close()
+        ctrl.step_main() # detect lost connection
+        try:
+            msg = pipe.get(timeout=1)
+        except Exception, e:
+            print('FAIL %s: %s lost no connection: %s' % (pretty, backend, e))
+            return False
+        if len(ctrl.fds) != 1: # only the listener should remain
+            print('FAIL %s: %s kept fds: %s' % (pretty, backend, ctrl.fds))
+            return False
+        ctrl.listener.close()
+
+    return True
+
 # TODO: check *ALL* possible call sites for Control.lost_connection(). this is
 # only reported for fully established connections, so disconnects in any other
 # states should *NOT* cause a call to Control.lost_connection().
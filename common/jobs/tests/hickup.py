@@ -206,3 +206,29 @@ def t06(pretty, factory):
 
     proc.join()
     return ok
+
+# check that the trace file includes the RPC statistics of the control
+@setup.factory()
+def t07(pretty, factory):
+    ctrl = factory.make_control(home=factory.HOME.path)
+    ctrl.upper('a')
+    os.kill(ctrl.get_pid(), signal.SIGUSR1)
+
+    hickup_dir = os.path.join(factory.HOME.path, '.ave', 'hickup')
+    if not wait_hickup_dir(hickup_dir, 3):
+        print('FAIL %s: hickup dir not created' % pretty)
+        return False
+    time.sleep(0.5) # the file may not be completely written yet
+
+    files = glob.glob(os.path.join(hickup_dir, '*'))
+    with open(files[0]) as f:
+        contents = f.read()
+    if 'rpc stats:' not in contents:
+        print('FAIL %s: no stats in trace file: %s' % (pretty, contents))
+        return False
+    stats = json.loads(contents.split('rpc stats:\n')[1])
+    if stats['methods']['upper']['calls'] != 1:
+        print('FAIL %s: wrong stats: %s' % (pretty, stats['methods']))
+        return False
+
+    return True
@@ -1,11 +1,14 @@
 import os
 import time
+import errno
 import psutil
 import signal
 import traceback
 
 from ave.network.connection import find_free_port
-from ave.network.process    import Process, get_proc_name, get_children
+import ave.network.process
+
+from ave.network.process    import Process, ForkServer, get_proc_name, get_children
 from ave.network.pipe       import Pipe
 from ave.network.exceptions import Unstarted, Unwaitable, Unjoinable, Unknown
 from ave.relay.lister       import RelayLister
@@ -54,6 +57,43 @@ class P3(Process):
     def run(self):
         time.sleep(2)
 
+class Touch(Process):
+
+    def __init__(self, path):
+        Process.__init__(self)
+        self.path = path
+
+    def run(self):
+        with open(self.path, 'w') as f:
+            f.write('%d' % os.getpid())
+        while True:
+            time.sleep(1)
+
+class Inspector(Process):
+
+    def __init__(self, pipe, check, slow=False):
+        Process.__init__(self)
+        self.pipe  = pipe
+        self.check = check
+        self.slow  = slow
+
+    def close_fds(self, exclude):
+        if self.slow: # pretend that the kernel does not support close_range()
+            ave.network.process._close_range = False
+        exclude.append(self.pipe.w)
+        Process.close_fds(self, exclude)
+
+    def run(self):
+        still_open = []
+        for fd in self.check:
+            try:
+                os.fstat(fd)
+                still_open.append(fd)
+            except OSError, e:
+                if e.errno != errno.EBADF:
+                    raise
+        self.pipe.put(still_open)
+
 class Dummy(Process):
 
     def __init__(self, pid):
@@ -294,3 +334,94 @@ def t9(pretty, factory):
 
     os.kill(pid, signal.SIGKILL) # the process will die anyway, but whatever
     return True
+
+# can start daemons through a fork server?
+@setup.factory()
+def t10(pretty, factory):
+    server = ForkServer()
+    server.start()
+    factory.processes.append(server)
+
+    path = os.path.join(factory.HOME.path, 'touched')
+    try:
+        pid = server.spawn(Touch, [path], synchronize=True)
+    except Exception, e:
+        print('FAIL %s: could not spawn: %s' % (pretty, e))
+        return False
+    factory.processes.append(Dummy(pid)) # so that setup kills it
+
+    for i in range(10):
+        if os.path.exists(path) and open(path).read():
+            break
+        time.sleep(0.3)
+    else:
+        print('FAIL %s: spawned process did not run' % pretty)
+        return False
+
+    if int(open(path).read()) != pid:
+        print('FAIL %s: wrong pid: %s' % (pretty, pid))
+        return False
+
+    if pid in get_children(os.getpid()) or pid in get_children(server.pid):
+        print('FAIL %s: spawned process was not daemonized' % pretty)
+        return False
+
+    return True
+
+# fork server refuses to start things that are not processes?
+@setup.factory()
+def t11(pretty, factory):
+    server = ForkServer()
+    server.start()
+    factory.processes.append(server)
+
+    try:
+        server.spawn(Pipe)
+        print('FAIL %s: could spawn a non-process' % pretty)
+        return False
+    except Exception, e:
+        if 'not a Process class' not in str(e):
+            print('FAIL %s: wrong error: %s' % (pretty, e))
+            return False
+
+    server.terminate()
+    server.join()
+    try:
+        server.spawn(Touch, ['/dev/null'])
+        print('FAIL %s: could spawn through dead fork server' % pretty)
+        return False
+    except Exception, e:
+        if 'fork server is not running' not in str(e):
+            print('FAIL %s: wrong error 2: %s' % (pretty, e))
+            return False
+
+    return True
+
+def check_close_fds(pretty, slow):
+    pipes = [os.pipe() for i in range(200)]
+    check = [fd for pair in pipes for fd in pair]
+    pipe  = Pipe()
+    p = Inspector(pipe, check + [pipe.w], slow)
+    p.start()
+    try:
+        still_open = pipe.get(timeout=5)
+    finally:
+        p.join(5)
+        for fd in check:
+            os.close(fd)
+
+    if still_open != [pipe.w]:
+        print('FAIL %s: wrong descriptors left open: %s' % (pretty, still_open))
+        return False
+
+    return True
+
+# all file descriptors except the excluded are closed in children?
+@setup.factory()
+def t12(pretty, factory):
+    return check_close_fds(pretty, False)
+
+# same thing when the kernel does not support close_range()?
+@setup.factory()
+def t13(pretty, factory):
+    return check_close_fds(pretty, True)
@@ -165,6 +165,14 @@ class MockControl(Control):
     def sleep(self, seconds):
         time.sleep(seconds)
 
+    @Control.rpc
+    @Control.offload
+    def offloaded_sleep(self, seconds, message=None):
+        time.sleep(seconds)
+        if message:
+            raise Exception(message)
+        return seconds
+
     @Control.rpc
     def kill(self, sig=signal.SIGKILL):
         os.kill(self.pid, sig)
@@ -177,6 +185,14 @@ class MockControl(Control):
     def get_pid(self):
         return os.getpid()
 
+    @Control.rpc
+    def push(self, *messages):
+        # queued ahead of the response to this call
+        for message in messages:
+            self.queue_message(
+                self.current_connection, json.dumps({'pushed': message})
+            )
+
     @Control.rpc
     def upper(self, message):
         return message.upper()
@@ -0,0 +1,115 @@
+# Copyright (C) 2014 Sony Mobile Communications Inc.
+# All rights, including trade secret rights, reserved.
+
+import json
+import marshal
+
+# a Control advertises the codecs it can decode by appending their names to the
+# salt of its authentication challenge. the digest is computed over the whole
+# salt, so peers that don't know about codecs still authenticate correctly. they
+# just never see the advertisement and keep on using JSON.
+ADVERTISE = b'#CODECS#'
+
+# a client that picks a binary codec declares it by appending the same marker
+# and the codec name to its digest. the control only accepts binary payloads on
+# connections where the client declared the codec and authenticated with a key.
+# marshal trusts the lengths in its input and must never see anonymous traffic.
+
+# binary payloads start with a NUL byte followed by a one byte codec tag. a JSON
+# document can never start with NUL, so the receiver can tell the formats apart.
+BINARY  = b'\x00'
+MARSHAL = b'm'
+
+CODECS = ['marshal', 'json'] # in order of preference
+
+def advertise(codecs):
+    if not codecs:
+        return b''
+    return ADVERTISE + ','.join(codecs)
+
+def parse_advertisement(challenge):
+    index = challenge.rfind(ADVERTISE)
+    if index < 0:
+        return [] # peer predates codec negotiation
+    return challenge[index + len(ADVERTISE):].split(',')
+
+def declare(codec):
+    if codec == 'json':
+        return b'' # also what clients that predate codec negotiation send
+    return ADVERTISE + codec
+
+def parse_declaration(message):
+    '''
+    Split the digest message of a client into the digest proper and the codec
+    that the client declared.
+
+    :returns: A (digest, codec name) tuple.
+    '''
+    index = message.rfind(ADVERTISE)
+    if index < 0:
+        return message, 'json'
+    return message[:index], message[index + len(ADVERTISE):]
+
+def choose(preferred, advertised):
+    '''
+    Pick the first codec in *preferred* that the peer advertised. Defaults to
+    JSON, which every peer understands.
+    '''
+    for codec in preferred:
+        if codec in advertised:
+            return codec
+    return 'json'
+
+def jsonify_key(key):
+    # JSON objects only have string keys. json.dumps() converts other scalars
+    if isinstance(key, unicode):
+        return key
+    if isinstance(key, str):
+        return key.decode('utf-8')
+    if key is None or isinstance(key, (int, long, float)):
+        return unicode(json.dumps(key))
+    raise TypeError('key %r is not a string' % (key,))
+
+def jsonify(obj):
+    '''
+    Convert *obj* to the objects that a JSON round trip would produce: strings
+    become unicode, tuples become lists and dictionary keys become strings.
+    Binary codecs preserve types exactly, so a peer would otherwise receive
+    different objects depending on which codec was negotiated.
+    '''
+    if obj is None or isinstance(obj, (unicode, bool, int, long, float)):
+        return obj
+    if isinstance(obj, str):
+        return obj.decode('utf-8')
+    if isinstance(obj, (list, tuple)):
+        return [jsonify(o) for o in obj]
+    if isinstance(obj, dict):
+        return dict((jsonify_key(k), jsonify(v)) for (k, v) in obj.iteritems())
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+def encode(obj, codec='json'):
+    '''
+    Serialize *obj* with the named codec. The object must only contain the
+    types produced by ``jsonify()``. Falls back to JSON if the codec can't
+    handle some part of the object.
+    '''
+    if codec == 'marshal':
+        try:
+            return BINARY + MARSHAL + marshal.dumps(obj)
+        except ValueError:
+            pass
+    return json.dumps(obj)
+
+def decode(payload, codec='json'):
+    '''
+    Deserialize a payload produced by ``encode()``. JSON is always accepted.
+
+    :arg codec: The binary codec negotiated for the connection, if any. Binary
+        payloads in any other codec are refused without being looked at.
+    :returns: An (object, codec name) tuple.
+    '''
+    if payload[:1] != BINARY:
+        return json.loads(payload), 'json'
+    if payload[1:2] == MARSHAL and codec == 'marshal':
+        return marshal.loads(payload[2:]), 'marshal'
+    raise Exception('codec tag not negotiated: %r' % payload[1:2])
@@ -11,6 +11,7 @@ import select
 import struct
 import random
 import traceback
+import collections
 
 from datetime import datetime, timedelta
 
@@ -70,15 +71,132 @@ def find_free_port(start=49152, stop=65536, listen=True):
             pass
     raise Exception('no free port available')
 
+### PREALLOCATED RECEIVE BUFFERS ##############################################
+
+MAX_RECV_SIZE = 0x7fffffff # system limit for socket.recv()
+
+class ReceiveBuffer(object):
+    '''
+    A preallocated buffer that is filled in place with ``recv_into()`` until it
+    holds exactly *size* bytes. Partial reads never copy the bytes received so
+    far, so a message is assembled in linear time with a single allocation.
+    '''
+    data = None # bytearray
+    view = None # memoryview on data
+    done = 0    # number of bytes received so far
+
+    def __init__(self, size):
+        # don't allocate buffers that socket.recv_into() could never fill
+        if size > MAX_RECV_SIZE:
+            raise OverflowError('message size exceeds system limit: %d' % size)
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.done = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def complete(self):
+        return self.done == len(self.data)
+
+    def fill(self, connection):
+        '''
+        Perform one read from *connection* into the unfilled part of the buffer.
+        Returns *True* if the buffer is complete. Raises ``ConnectionAgain`` if
+        there is nothing to read and ``ConnectionClosed`` if the peer is gone.
+        '''
+        if not self.complete:
+            self.done += Connection.read_into(connection, self.view[self.done:])
+        return self.complete
+
+    def value(self):
+        return str(self.data)
+
+### OUTPUT QUEUES ##############################################################
+
+class OutputQueue(object):
+    '''
+    Framed messages waiting to be written on a non-blocking connection. Each
+    write coalesces headers and payloads of queued messages into one string of
+    at most *chunk* bytes, so that a small message costs a single system call.
+    Larger payloads are written in slices without copying them.
+
+    :arg limit: The maximum number of bytes to keep queued. A message is
+        always accepted by an empty queue, however large it is.
+    :arg chunk: The maximum number of bytes to write in one system call.
+    '''
+    frames  = None # deque of headers, payloads and slices of payloads
+    size    = 0    # number of bytes queued, including pending
+    pending = None # coalesced bytes of a partially completed write
+    offset  = 0    # number of pending bytes written so far
+
+    def __init__(self, limit=1024*1024*64, chunk=1024*64):
+        self.limit  = limit
+        self.chunk  = chunk
+        self.frames = collections.deque()
+        self.size   = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, payload):
+        header = Connection.make_header(payload)
+        # the limit guards against peers that stop reading. a single large
+        # message on an idle connection is sent anyway, like Connection.put()
+        if self.size and self.size + len(header) + len(payload) > self.limit:
+            raise ConnectionFull()
+        self.frames.append(header)
+        self.frames.append(payload)
+        self.size += len(header) + len(payload)
+
+    def coalesce(self):
+        parts = []
+        total = 0
+        while self.frames and total < self.chunk:
+            part = self.frames.popleft()
+            room = self.chunk - total
+            if len(part) > room:
+                self.frames.appendleft(buffer(part, room))
+                part = buffer(part, 0, room)
+            parts.append(part)
+            total += len(part)
+        if len(parts) == 1:
+            return parts[0]
+        return ''.join([str(part) for part in parts])
+
+    def flush(self, connection):
+        '''
+        Write queued bytes on *connection* until the queue is empty or the
+        write would block.
+
+        :returns: *True* if the queue is empty.
+        :raises: *ConnectionClosed* if the connection is no longer open.
+        '''
+        while self.size:
+            if self.pending == None:
+                self.pending = self.coalesce()
+                self.offset  = 0
+            try:
+                done = connection.write(buffer(self.pending, self.offset))
+            except ConnectionAgain:
+                return False
+            self.offset += done
+            self.size   -= done
+            if self.offset == len(self.pending):
+                self.pending = None
+        return True
+
 ### THE CONNECTION CLASS #######################################################
 
 class Connection(object):
     address             = None # (string, integer)
     socket              = None
-    partial_get_header  = None # build with network input until len = 4
-    partial_get_payload = None # build with network input until len = header
+    partial_get_header  = None # ReceiveBuffer filled until it holds 4 bytes
+    partial_get_payload = None # ReceiveBuffer filled until len = header
     partial_put_header  = None # reduce with network output until len = 0
     partial_put_payload = None # reduce with network output until len = 0
+    watched             = False # set when added to the main loop of a Control
 
     def __init__(self, address, socket=None):
         if ((not socket)
@@ -198,25 +316,34 @@ class Connection(object):
                 raise ConnectionClosed(str(e))
             raise
 
+    def read_into(self, view):
+        try:
+            size = self.socket.recv_into(view)
+            if not size:
+                raise ConnectionClosed()
+            return size
+        except socket.error, e:
+            if e.errno == errno.EAGAIN:
+                raise ConnectionAgain(str(e))
+            if e.errno == errno.EBADF:
+                raise ConnectionClosed(str(e))
+            if e.errno == errno.ECONNRESET:
+                raise ConnectionClosed(str(e))
+            raise
+
     def read_header(self):
-        partial = self.partial_get_header or ''
-        if len(partial) == 4:
-            return partial
-        header = self.read(4 - len(partial))
-        self.partial_get_header = partial + header
-        if len(partial) + len(header) != 4:
+        if not self.partial_get_header:
+            self.partial_get_header = ReceiveBuffer(4)
+        if not self.partial_get_header.fill(self):
             return None
-        return partial + header
+        return self.partial_get_header.value()
 
     def read_payload(self, size):
-        partial = self.partial_get_payload or ''
-        if len(partial) == size:
-            return partial
-        payload = self.read(size - len(partial))
-        self.partial_get_payload = partial + payload
-        if len(partial) + len(payload) != size:
+        if not self.partial_get_payload:
+            self.partial_get_payload = ReceiveBuffer(size)
+        if not self.partial_get_payload.fill(self):
             return None
-        return partial + payload
+        return self.partial_get_payload.value()
 
     @classmethod
     def make_header(cls, payload):
@@ -273,7 +400,7 @@ class Connection(object):
                 return None
             size = struct.unpack('>L', header)[0]
             payload = self.read_payload(size)
-            if not payload:
+            if payload == None:
                 return None
         except ConnectionAgain:
             return None
@@ -328,20 +455,22 @@ class BlockingConnection(Connection):
         return Connection.accept(self, Class=BlockingConnection)
 
     def read(self, size, timeout=None):
-        payload = ''
+        return self.read_buffer(ReceiveBuffer(size), timeout)
+
+    def read_buffer(self, buf, timeout=None):
         if timeout != None:
             limit = time.time() + timeout
-        while len(payload) < size:
+        while not buf.complete:
             if timeout != None and time.time() > limit:
                 raise ConnectionTimeout()
             try:
-                payload += Connection.read(self, size - len(payload))
+                buf.fill(self)
             except ConnectionAgain:
                 if timeout != None:
                     self.poll(select.POLLIN, limit-time.time()) # TODO: check events
                 else:
                     self.poll(select.POLLIN, -1)
-        return payload
+        return buf.value()
 
     def write(self, payload, timeout=None):
         size  = len(payload)
@@ -372,11 +501,11 @@ class BlockingConnection(Connection):
     def get(self, timeout=None):
         if timeout != None:
             limit = time.time() + timeout
-        header = self.read(4, timeout)
+        header = self.read_buffer(ReceiveBuffer(4), timeout)
         size   = struct.unpack('>L', header)[0]
         if timeout != None:
             timeout = limit - time.time()
-        return self.read(size, timeout)
+        return self.read_buffer(ReceiveBuffer(size), timeout)
 
     def put(self, payload, timeout=None):
         if type(payload) != str:
@@ -10,25 +10,39 @@ import json
 import time
 import types
 import errno
+import bisect
+import fcntl
+import Queue
 import select
 import signal
 import ctypes
 import psutil
+import threading
 
 from socket   import error as SocketError
 from datetime import datetime, timedelta
 
 import ave.config
 import ave.cmd
+import ave.network.codec
 
 from ave.network.process    import Process
 from ave.network.connection import *
+from ave.network.pool       import ConnectionPool
 from ave.network.exceptions import *
 
 INMASK  = select.POLLIN | select.POLLPRI
 OUTMASK = select.POLLOUT
 ERRMASK = select.POLLERR | select.POLLHUP | select.POLLNVAL
 
+# connection states. used to dispatch events in the main loop
+LISTENER       = 0
+ACCEPTING      = 1
+AUTHENTICATING = 2
+ESTABLISHED    = 3
+KEEPWATCHING   = 4
+OFFLOADER      = 5
+
 # the recommended method to implement get_children() and get_proc_name() is to
 # use the psutil module but unfortunately the version in Ubuntu 10 is too old
 # to support the needed functions.
@@ -71,7 +85,7 @@ def to_milliseconds(interval):
 # used to make sure a control never tries to dump objects that cannot be JSON
 # serialized
 def enforce_unicode(obj):
-    if (not obj) or type(obj) in [int, long, float, unicode, bool]:
+    if obj is None or type(obj) in [int, long, float, unicode, bool]:
         return obj
     if type(obj) == str:
         return unicode(obj, errors='replace')
@@ -80,10 +94,101 @@ def enforce_unicode(obj):
     if isinstance(obj, dict):
         result = {}
         for key in obj:
-            result[enforce_unicode(key)] = enforce_unicode(obj[key])
+            value = enforce_unicode(obj[key])
+            if type(key) not in [str, unicode]: # JSON only has string keys
+                key = ave.network.codec.jsonify_key(key)
+            result[enforce_unicode(key)] = value
         return result
     raise Exception('INTERNAL ERROR: OBJECT IS NOT JSON COMPATIBLE: %s' % obj)
 
+class Poller(object):
+    '''
+    Event polling backed by ``select.poll()``.
+    '''
+
+    def __init__(self):
+        self.poller = select.poll()
+
+    def register(self, fd, mask, new=True):
+        self.poller.register(fd, mask) # also modifies existing registrations
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout):
+        return self.poller.poll(timeout) # milliseconds
+
+class EPoller(object):
+    '''
+    Level triggered event polling backed by ``select.epoll()``. The event bits
+    of ``epoll`` and ``poll`` have the same values on Linux, so the two can be
+    used interchangeably. The registered mask of each file descriptor is kept
+    so that unchanged masks don't cost a system call.
+    '''
+
+    def __init__(self):
+        self.poller  = select.epoll()
+        self.masks   = {}    # fd -> registered mask
+        self.invalid = set() # closed fd's that were (re)registered
+
+    def register(self, fd, mask, new=True):
+        try:
+            if new: # the descriptor number may have been reused by a new socket
+                try:
+                    self.poller.register(fd, mask)
+                except IOError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    self.poller.modify(fd, mask)
+            elif self.masks.get(fd) != mask:
+                try:
+                    self.poller.modify(fd, mask)
+                except IOError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    self.poller.register(fd, mask)
+        except IOError, e:
+            if e.errno != errno.EBADF:
+                raise
+            # poll() accepts closed descriptors and reports POLLNVAL for them.
+            # do the same so that the owner gets to clean up the connection
+            self.invalid.add(fd)
+        self.masks[fd] = mask
+
+    def unregister(self, fd):
+        self.masks.pop(fd, None)
+        self.invalid.discard(fd)
+        try:
+            self.poller.unregister(fd)
+        except (IOError, ValueError), e:
+            # the kernel drops closed descriptors from the epoll set by itself
+            if isinstance(e, IOError) and e.errno not in [errno.EBADF,
+                                                          errno.ENOENT]:
+                raise
+
+    def poll(self, timeout):
+        if self.invalid:
+            return [(fd, select.POLLNVAL) for fd in self.invalid]
+        if timeout < 0:
+            return self.poller.poll(-1)
+        return self.poller.poll(timeout / 1000.0) # seconds
+
+def make_poller(backend=None):
+    '''
+    Create a poller. *backend* may be "epoll", "poll", or ``None`` to pick the
+    best one available on the system.
+    '''
+    if backend == None:
+        if hasattr(select, 'epoll'):
+            backend = 'epoll'
+        else:
+            backend = 'poll'
+    if backend == 'epoll':
+        return EPoller()
+    if backend == 'poll':
+        return Poller()
+    raise Exception('unknown poll backend: %s' % backend)
+
 class Partial(Exception):
     header  = None
     payload = None
@@ -92,6 +197,162 @@ class Partial(Exception):
         self.header  = header
         self.payload = payload
 
+class Offloader(object):
+    '''
+    A bounded pool of worker threads that perform calls on behalf of a main
+    loop. Each completed call is put on the done queue and a byte is written on
+    the wakeup pipe, so that a main loop which polls ``fileno()`` wakes up to
+    collect it. The threads are started on demand and never stopped.
+
+    :arg size: The maximum number of worker threads.
+    '''
+
+    def __init__(self, size):
+        self.size    = size
+        self.threads = []
+        self.tasks   = Queue.Queue()
+        self.done    = Queue.Queue()
+        self.busy    = 0 # tasks submitted and not yet collected
+        self.r, self.w = os.pipe()
+        for fd in [self.r, self.w]:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+    def fileno(self):
+        return self.r
+
+    def submit(self, key, fn, *vargs):
+        self.busy += 1
+        self.tasks.put((key, fn, vargs))
+        if len(self.threads) < min(self.size, self.busy):
+            t = threading.Thread(target=self.work)
+            t.daemon = True # must not keep the process alive
+            t.start()
+            self.threads.append(t)
+
+    def work(self):
+        while True:
+            key, fn, vargs = self.tasks.get()
+            try:
+                self.done.put((key, fn(*vargs), None))
+            except BaseException, e:
+                self.done.put((key, None, e))
+            try:
+                os.write(self.w, 'x')
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                # the pipe is full of unread wakeups. one more is not needed
+
+    def collect(self):
+        '''
+        Empty the wakeup pipe and get all completed calls.
+
+        :returns: A list of (key, result, exception) tuples.
+        '''
+        try:
+            while os.read(self.r, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        result = []
+        while True:
+            try:
+                result.append(self.done.get_nowait())
+            except Queue.Empty:
+                break
+        self.busy -= len(result)
+        return result
+
+class Reply(object):
+    '''
+    Handle to a call whose response was deferred with
+    ``Control.defer_response()``. Exactly one of ``send()`` and ``fail()``
+    should be called, from the main loop of the control. Completing a reply
+    whose client has disconnected does nothing.
+    '''
+
+    def __init__(self, control, connection, rpc_id, codec, async, name):
+        self.control    = control
+        self.connection = connection
+        self.rpc_id     = rpc_id
+        self.codec      = codec
+        self.async      = async
+        self.name       = name
+        self.begin      = time.time()
+
+    def send(self, result):
+        self.control.complete_reply(self, {'result': enforce_unicode(result)})
+
+    def fail(self, exception):
+        if isinstance(exception, AveException):
+            details = dict(exception.details)
+        else:
+            details = {
+                'type'   : type(exception).__name__,
+                'message': unicode(exception)
+            }
+        details.setdefault('trace', [])
+        self.control.complete_reply(self, {'exception': details})
+
+class RpcStats(object):
+    '''
+    Per-method call counters and latency histograms, kept by the main loop of
+    a ``Control``. Each call is timed in four phases: *validate* (decode and
+    access checks), *execute* (the method call), *serialize* (encoding of the
+    response) and *send* (from queueing of the response until the output queue
+    of the connection was drained). Histogram bucket *i* counts the samples
+    that took at most ``BOUNDS[i]`` seconds. The last bucket counts the rest.
+    '''
+    PHASES = ['validate', 'execute', 'serialize', 'send']
+    BOUNDS = [0.0001 * 2**i for i in range(18)] # 100us to 13s
+
+    def __init__(self):
+        self.since   = time.time()
+        self.methods = {} # method name -> {phase: [count, total, max, buckets]}
+        self.errors  = {} # method name -> number of calls that raised
+        self.invalid = 0  # calls that could not be validated
+
+    def record(self, method, phase, seconds):
+        if method not in self.methods:
+            self.methods[method] = dict([
+                (p, [0, 0.0, 0.0, [0] * (len(self.BOUNDS) + 1)])
+                for p in self.PHASES
+            ])
+        entry = self.methods[method][phase]
+        entry[0] += 1
+        entry[1] += seconds
+        if seconds > entry[2]:
+            entry[2] = seconds
+        entry[3][bisect.bisect_left(self.BOUNDS, seconds)] += 1
+
+    def record_error(self, method):
+        self.errors[method] = self.errors.get(method, 0) + 1
+
+    def report(self):
+        methods = {}
+        for method, phases in self.methods.items():
+            methods[method] = {
+                'calls' : phases['validate'][0],
+                'errors': self.errors.get(method, 0)
+            }
+            for phase, (count, total, high, buckets) in phases.items():
+                methods[method][phase] = {
+                    'count'    : count,
+                    'total'    : total,
+                    'max'      : high,
+                    'histogram': list(buckets)
+                }
+        return {
+            'since'  : self.since,
+            'bounds' : self.BOUNDS,
+            'invalid': self.invalid,
+            'methods': methods
+        }
+
 class Control(Process):
     '''
     This is the base class for all RPC capable AVE services. It accepts new
@@ -127,6 +388,9 @@ class Control(Process):
         make sense to use and could potentially affect system performance
         severely.
     '''
+    poll_backend = None # "epoll", "poll" or None to pick the best available
+    codecs = ave.network.codec.CODECS # advertised to clients in the handshake
+
     def __init__(self, port,authkey=None,socket=None,alt_keys={},interval=None,
         home=None, proc_name=None, logging=False):
         if (not socket) and (type(port) != int or port < 1):
@@ -157,16 +421,35 @@ class Control(Process):
             home = ave.config.load_etc()['home']
         self.home           = home
         self.interval       = to_milliseconds(interval)
-        self.unpend         = []    # fd's to ignore in pending events handling
+        self.unpend         = set() # fd's to ignore in pending events handling
         self.rejecting      = False
-        self.accepting      = []    # connections
+        self.accepting      = {}    # connection -> None
         self.authenticating = {}    # connection -> salt
         self.established    = {}    # connection -> authkey or None
+        self.negotiated     = {}    # connection -> binary codec
         self.keepwatching   = {}
         self.listener       = None
-        self.outgoing       = {}    # connection -> message
+        self.outgoing       = {}    # connection -> OutputQueue
+        self.out_limit      = 1024*1024*64 # max bytes queued per connection
+        self.offloader      = None  # started on first call to offloaded method
+        self.offload_size   = 4     # max worker threads in the offloader
+        self.offloaded      = set() # connections with calls in the offloader
+        self.rpc_stats      = None  # RpcStats. created by initialize()
+        self.sending        = {}    # connection -> [(method, queued at)]
+        self.calling        = None  # the call being performed. see Reply
+        self.deferring      = None  # Reply made by defer_response()
+        self.replies        = {}    # connection -> set of unanswered Replies
         self.buf_sizes      = (1024*16, 1024*16) # setsockopt() parameters
         self.deferred_joins = None
+        self.states         = {}    # fd -> connection state
+        self.steps          = {     # connection state -> event handler
+            LISTENER      : self.step_listener,
+            ACCEPTING     : self.step_accepting,
+            AUTHENTICATING: self.step_authenticating,
+            ESTABLISHED   : self.step_established,
+            KEEPWATCHING  : self.step_keepwatching,
+            OFFLOADER     : self.step_offloader
+        }
 
     def close_fds(self, exclude):
         if self.socket:
@@ -176,11 +459,14 @@ class Control(Process):
     def initialize(self):
         Process.initialize(self)
         self.deferred_joins = []
+        self.rpc_stats = RpcStats()
         self.listener = Connection(('',self.port), self.socket)
         if not self.listener.socket: # do not replace caller provided socket
             self.listener.listen()
-        self.poller = select.poll()
-        self.pollable(self.listener.fileno(), self.listener, INMASK | ERRMASK)
+        self.poller = make_poller(self.poll_backend)
+        self.pollable(
+            self.listener.fileno(), self.listener, INMASK | ERRMASK, LISTENER
+        )
 
     ### PROCESS MANAGEMENT #####################################################
 
@@ -247,6 +533,10 @@ class Control(Process):
             f.write('stack:\n%s' % ''.join(traceback.format_stack(frame)))
             f.write('locals:\n%s\n' % frame.f_locals)
             f.write('globals:\n%s' % frame.f_globals)
+            if self.rpc_stats:
+                f.write('\nrpc stats:\n%s\n' % json.dumps(
+                    enforce_unicode(self.get_rpc_stats()), indent=4
+                ))
 
     def join_later(self, proc):
         '''
@@ -303,15 +593,25 @@ class Control(Process):
 
     ### ADD/REMOVE CONNECTIONS TO THE MAIN LOOP HANDLING #######################
 
-    def pollable(self, fd, connection, mask):
+    def pollable(self, fd, connection, mask, state=None):
         assert fd > 0
-        self.poller.register(fd, mask)
+        self.poller.register(fd, mask, self.fds.get(fd) is not connection)
         self.fds[fd] = connection
+        if state != None:
+            self.states[fd] = state
 
     def unpollable(self, fd):
+        # must be called before the connection is closed. epoll does not drop
+        # a closed descriptor from its set while a child process still holds
+        # a copy of it.
         self.poller.unregister(fd)
-        del self.fds[fd]
-        self.unpend.append(fd) # file descriptors may appear more than once in
+        connection = self.fds.pop(fd)
+        self.outgoing.pop(connection, None)
+        self.sending.pop(connection, None)
+        self.replies.pop(connection, None)
+        self.negotiated.pop(connection, None)
+        self.states.pop(fd, None)
+        self.unpend.add(fd) # file descriptors may appear more than once in
         # the same batch of polling events. if the first such event causes the
         # removal of a connection, the handling of the next pending event will
         # fail as its file descriptor cannot be found. self.unpend is cleared
@@ -336,14 +636,70 @@ class Control(Process):
         '''
         assert(connection != None)
         assert(connection.socket != None)
+        connection.watched = True # never give it back to a connection pool
         self.established[connection] = authkey
-        self.pollable(connection.fileno(), connection, INMASK | OUTMASK)
+        self.pollable(
+            connection.fileno(), connection, INMASK | OUTMASK, ESTABLISHED
+        )
 
     def add_keepwatching(self, connection, authkey):
         assert(connection != None)
         assert(connection.socket != None)
+        connection.watched = True # never give it back to a connection pool
         self.keepwatching[connection] = authkey
-        self.pollable(connection.fileno(), connection, INMASK | OUTMASK)
+        self.pollable(
+            connection.fileno(), connection, INMASK | OUTMASK, KEEPWATCHING
+        )
+
+    def queue_message(self, connection, payload):
+        '''
+        May be used by a subclass to send a message on an established
+        connection without blocking the main loop. Queued messages are written
+        in order when the connection becomes writable.
+
+        :raises: *ConnectionFull* if too many bytes are queued already. A
+            message is always accepted when nothing else is queued.
+        '''
+        if connection not in self.established:
+            raise Exception('not established: %s' % connection)
+        if connection not in self.outgoing:
+            self.outgoing[connection] = OutputQueue(self.out_limit)
+        self.outgoing[connection].append(payload)
+        self.update_mask(connection)
+
+    def flush_messages(self, connection, fd):
+        # write as much of the output queue as the socket accepts. stop polling
+        # for POLLOUT when the queue is empty
+        queue = self.outgoing.get(connection)
+        if queue and not queue.flush(connection):
+            return False
+        self.outgoing.pop(connection, None)
+        now = time.time()
+        for method, queued in self.sending.pop(connection, []):
+            self.rpc_stats.record(method, 'send', now - queued)
+        self.update_mask(connection)
+        return True
+
+    def update_mask(self, connection):
+        # poll for output while messages are queued. don't read more calls
+        # from a client while one of its calls is performed by the offloader.
+        # that keeps the calls of each client in order
+        mask = 0
+        if connection not in self.offloaded:
+            mask |= INMASK
+        if connection in self.outgoing:
+            mask |= OUTMASK
+        self.pollable(connection.fileno(), connection, mask)
+
+    def write_last_message(self, connection, payload):
+        # the connection is about to be closed. write queued messages and the
+        # last one if it can be done without blocking. don't try to recover
+        queue = self.outgoing.pop(connection, OutputQueue(self.out_limit))
+        try:
+            queue.append(payload)
+            queue.flush(connection)
+        except:
+            pass
 
     def remove_connection(self, connection):
         '''
@@ -355,7 +711,7 @@ class Control(Process):
         elif connection in self.authenticating:
             self.authenticating.pop(connection)
         elif connection in self.accepting:
-            self.accepting.remove(connection)
+            self.accepting.pop(connection)
         try:
             self.unpollable(connection.fileno())
         except:
@@ -417,10 +773,7 @@ class Control(Process):
             blob = { 'exception': details.details }
         else:
             blob = { 'exception': { 'type': 'Exit', 'message': str(details) } }
-        try:
-            connection.put(json.dumps(blob))
-        except:
-            pass # don't try to recover
+        self.write_last_message(connection, json.dumps(blob))
 
     def main_loop(self):
         self.alive = True
@@ -441,14 +794,14 @@ class Control(Process):
                 # happens if peer hangs up during accept or the control is
                 # rejecting new connections
                 return
-            self.pollable(new.fileno(), new, OUTMASK)
-            self.accepting.append(new)
+            self.pollable(new.fileno(), new, OUTMASK, ACCEPTING)
+            self.accepting[new] = None
             # ignore all events for the same file descriptor in the current step
             # of the main loop. the OS may reuse descriptors aggressively and so
             # the events list may include POLLNVAL for the same descriptor. we
             # don't need to handle such a POLLNVAL event because that connection
             # is replaced (and GCed) by the call to self.pollable() above.
-            self.unpend.append(new.fileno())
+            self.unpend.add(new.fileno())
 
     def step_accepting(self, connection, event, fd):
         #print('%s(%s, %s)' %
@@ -457,22 +810,22 @@ class Control(Process):
         if event & ERRMASK:
             #print('%s %d close accepting %d %d %s' % (
             #   self.proc_name,os.getpid(),fd,connection.port,event_str(event)))
-            self.accepting.remove(connection)
-            connection.close()
+            self.accepting.pop(connection)
             self.unpollable(fd)
+            connection.close()
 
         elif event & OUTMASK:
-            self.accepting.remove(connection)
-            salt = make_salt()
+            self.accepting.pop(connection)
+            salt = make_salt() + ave.network.codec.advertise(self.codecs)
             try:
                 connection.put(CHALLENGE + salt)
                 self.authenticating[connection] = salt
-                self.pollable(fd, connection, INMASK)
+                self.pollable(fd, connection, INMASK, AUTHENTICATING)
             except ConnectionClosed:
                 #print('%s %d peer closed accepting %d %d OUT' % (
                 #    self.proc_name, os.getpid(), fd, connection.port))
-                connection.close()
                 self.unpollable(fd)
+                connection.close()
 
     def step_authenticating(self, connection, event, fd):
         #print('%s(%s, %s)' %
@@ -482,8 +835,8 @@ class Control(Process):
             #print('%s %d close authenticating %d %d %s' % (
             #   self.proc_name,os.getpid(),fd,connection.port,event_str(event)))
             self.authenticating.pop(connection)
-            connection.close()
             self.unpollable(fd)
+            connection.close()
 
         elif event & INMASK:
             try:
@@ -494,8 +847,8 @@ class Control(Process):
             except ConnectionClosed:
                 salt = self.authenticating[connection]
                 self.authenticating.pop(connection)
-                connection.close()
                 self.unpollable(fd)
+                connection.close()
                 #print('%s %d peer closed authenticating %d %d IN' % (
                 #    self.proc_name, os.getpid(), fd, connection.port))
                 return
@@ -513,14 +866,18 @@ class Control(Process):
                     authkey = self.established[connection]
                     self.lost_connection(connection, authkey)
                     self.established.pop(connection)
-                connection.close()
                 self.unpollable(fd)
+                connection.close()
                 return
 
 
             salt    = self.authenticating[connection]
             keys    = self.get_authkeys()
+            digest, codec = ave.network.codec.parse_declaration(digest)
             authkey = validate_digest(salt, digest, keys) # may return None
+            # anonymous clients are held to JSON, whatever they declared
+            if authkey and codec in self.codecs and codec != 'json':
+                self.negotiated[connection] = codec
             # replace the digest salt with the accepted authkey and inform the
             # main loop that we need to send it to the client.
             self.authenticating[connection] = authkey
@@ -532,13 +889,13 @@ class Control(Process):
             try:
                 connection.put(json.dumps({ 'authenticated':authkey != None }))
                 self.established[connection] = authkey # remember client's key
+                self.pollable(fd, connection, INMASK, ESTABLISHED)
                 self.new_connection(connection, authkey)
-                self.pollable(fd, connection, INMASK)
             except ConnectionClosed:
                 #print('%s %d peer closed authenticating %d %d OUT' % (
                 #    self.proc_name, os.getpid(), fd, connection.port))
-                connection.close()
                 self.unpollable(fd)
+                connection.close()
 
     def step_established(self, connection, event, fd):
         #print('%s(%s, %s)' %
@@ -550,18 +907,31 @@ class Control(Process):
             authkey = self.established[connection]
             self.lost_connection(connection, authkey)
             self.established.pop(connection)
-            connection.close()
             self.unpollable(fd)
+            connection.close()
+            return
 
-        elif event & INMASK:
+        if event & OUTMASK:
+            # drain the output queue before reading more calls from the peer
+            try:
+                if not self.flush_messages(connection, fd):
+                    return # no room in socket buffer. retry later
+            except ConnectionClosed:
+                #print('%s %d peer closed established %d %d OUT' % (
+                #    self.proc_name, os.getpid(), fd, connection.port))
+                self.unpollable(fd)
+                connection.close()
+                return
+
+        if event & INMASK:
             try:
                 rpc = connection.get()
             except ConnectionClosed:
                 authkey = self.established[connection]
                 self.lost_connection(connection, authkey)
                 self.established.pop(connection)
-                connection.close()
                 self.unpollable(fd)
+                connection.close()
                 #print('%s %d peer closed established %d %d IN' % (
                 #    self.proc_name, os.getpid(), fd, connection.port))
                 return
@@ -574,65 +944,190 @@ class Control(Process):
                 # for POLLOUT before writing it, because we should disconnect
                 # the client immediately. this probably means the message could
                 # get lost if the network is congested enough.
-                connection.put(json.dumps(response))
+                self.write_last_message(connection, json.dumps(response))
                 authkey = self.established[connection]
                 self.lost_connection(connection, authkey)
                 self.established.pop(connection)
-                connection.close()
                 self.unpollable(fd)
+                connection.close()
                 return
 
             if rpc == None: # incomplete message read, try again later
-                self.pollable(fd, connection, INMASK)
                 return
             key = self.established[connection] # authkey presented by client
+            rpc_id = None
+            batch  = None
+            codec  = 'json'
+            name   = None # method name used in the call statistics
+            begin  = time.time()
             try:
-                method,resource,vargs,kwargs,async = self.validate_rpc(rpc, key)
+                rpc, codec = self.decode_rpc(
+                    rpc, self.negotiated.get(connection, 'json')
+                )
+                rpc_id = rpc.get('id') # set by clients that pipeline calls
+                if 'batch' in rpc: # many calls in one message
+                    batch, async = rpc['batch'], False
+                else:
+                    method,resource,vargs,kwargs,async = \
+                        self.validate_rpc(rpc, key)
+                    name = rpc['method']
+                    self.rpc_stats.record(name,'validate',time.time()-begin)
             except Exception, e:
-                response = json.dumps({'exception': enforce_unicode(str(e))})
-                self.outgoing[connection] = response # pending to be sent
-                self.pollable(fd, connection, OUTMASK)
-                return # as done as it gets
+                self.rpc_stats.invalid += 1
+                response = {'exception': enforce_unicode(str(e))}
+                response = self.encode_response(response, rpc_id, codec)
+                async    = False
+            else:
+                if batch == None and hasattr(method, 'ave.control.offload'):
+                    self.offload_rpc(
+                        connection, (method, resource, vargs, kwargs),
+                        rpc_id, codec, async, name
+                    )
+                    return # the response is queued when the call completes
+                try:
+                    if batch != None:
+                        response = self.perform_batch(batch, key)
+                    else:
+                        begin = time.time()
+                        self.calling  = (connection,rpc_id,codec,async,name)
+                        self.deferring = None
+                        try:
+                            response = self.perform_rpc(
+                                method, resource, vargs, kwargs
+                            )
+                        finally:
+                            self.calling = None
+                        if self.park_reply(connection, response):
+                            return # answered later through the Reply
+                        self.record_execute(name, response, begin)
+                    if not async:
+                        begin = time.time()
+                        response = self.encode_response(response,rpc_id,codec)
+                        if name != None:
+                            self.rpc_stats.record(
+                                name, 'serialize', time.time() - begin
+                            )
+                except Exit, e:
+                    self.exit_rpc(connection, e, rpc_id, codec)
+                    return
+                except Exception:
+                    # disconnect the client and continue. TODO: log the exception
+                    authkey = self.established[connection]
+                    self.lost_connection(connection, authkey)
+                    self.established.pop(connection)
+                    self.unpollable(fd)
+                    connection.close()
+                    return
 
-            try:
-                response = self.perform_rpc(method, resource, vargs, kwargs)
-                if not async:
-                    self.outgoing[connection] = response # pending to be sent
-                    self.pollable(fd, connection, OUTMASK)
+            if async:
                 return # all done
-            except Exit, e:
-                response = { 'exception': e.details }
-                # TODO: try/except around put()
-                connection.put(json.dumps(response)) # TODO: wait for OUTMASK?
-                self.shutdown()
-            except Exception:
-                # disconnect the client and continue. TODO: log the exception
-                authkey = self.established[connection]
-                self.lost_connection(connection, authkey)
-                self.established.pop(connection)
-                connection.close()
-                self.unpollable(fd)
+            self.respond(connection, response, name) # sent on POLLOUT
 
-        elif event & OUTMASK:
-            try:
-                response = self.outgoing[connection]
-            except KeyError:
-                # the deferred response must *not* be None, but may happen
-                # anyway if a connection was added explicitly by the subclass
-                self.pollable(fd, connection, INMASK)
-                return
-            try:
-                if not connection.put(response): # could not send whole message
-                    self.pollable(fd, connection, OUTMASK) # retry later
-                    return
-            except ConnectionClosed:
-                #print('%s %d peer closed established %d %d OUT' % (
-                #    self.proc_name, os.getpid(), fd, connection.port))
-                connection.close()
-                self.unpollable(fd)
-                return
-            self.outgoing[connection] = None
-            self.pollable(fd, connection, INMASK)
+    def defer_response(self):
+        '''
+        May be called by an RPC method to leave the call unanswered when the
+        method returns. The return value of the method is then ignored. The
+        response is sent later by completing the returned ``Reply``. Other
+        calls are handled in the meantime, also calls from the same client.
+        Cannot be used in offloaded or batched calls.
+
+        :returns: A ``Reply``.
+        '''
+        if not self.calling:
+            raise Exception('no call to defer')
+        if not isinstance(threading.current_thread(), threading._MainThread):
+            raise Exception('cannot defer response outside the main loop')
+        self.deferring = Reply(self, *self.calling)
+        return self.deferring
+
+    def park_reply(self, connection, response):
+        reply, self.deferring = self.deferring, None
+        if not reply:
+            return False
+        if response and 'exception' in response:
+            return False # the method raised after deferring. respond now
+        self.replies.setdefault(connection, set()).add(reply)
+        return True
+
+    def complete_reply(self, reply, response):
+        replies = self.replies.get(reply.connection, set())
+        if reply not in replies:
+            return # the client is gone or the reply was already completed
+        replies.remove(reply)
+        if not replies:
+            del self.replies[reply.connection]
+        self.record_execute(reply.name, response, reply.begin)
+        if reply.async:
+            return
+        begin = time.time()
+        response = self.encode_response(response, reply.rpc_id, reply.codec)
+        self.rpc_stats.record(reply.name, 'serialize', time.time() - begin)
+        self.respond(reply.connection, response, reply.name)
+
+    def record_execute(self, name, response, begin):
+        self.rpc_stats.record(name, 'execute', time.time() - begin)
+        if response and 'exception' in response:
+            self.rpc_stats.record_error(name)
+
+    def respond(self, connection, response, name=None):
+        try:
+            self.queue_message(connection, response)
+            if name != None:
+                self.sending.setdefault(connection, []).append(
+                    (name, time.time())
+                )
+        except ConnectionFull:
+            # the peer makes calls without reading the responses
+            authkey = self.established[connection]
+            self.lost_connection(connection, authkey)
+            self.established.pop(connection)
+            self.unpollable(connection.fileno())
+            connection.close()
+
+    def exit_rpc(self, connection, exit, rpc_id, codec):
+        response = { 'exception': exit.details }
+        response = self.encode_response(response, rpc_id, codec)
+        # stop accepting before the client learns about the exit, or it may
+        # reconnect into the backlog and get reset instead of refused. fast
+        # reconnects happen with pooled connections.
+        if self.listener:
+            self.listener.close()
+        self.write_last_message(connection, response)
+        self.shutdown()
+
+    def offload_rpc(self, connection, call, rpc_id, codec, async, name):
+        if not self.offloader:
+            self.offloader = Offloader(self.offload_size)
+            self.pollable(
+                self.offloader.fileno(), self.offloader, INMASK, OFFLOADER
+            )
+        self.offloaded.add(connection)
+        self.update_mask(connection)
+        self.offloader.submit(
+            (connection, rpc_id, codec, async, name, time.time()),
+            self.perform_rpc, *call
+        )
+
+    def step_offloader(self, offloader, event, fd):
+        for key, response, error in offloader.collect():
+            connection, rpc_id, codec, async, name, begin = key
+            self.offloaded.discard(connection)
+            if not error:
+                # includes the time spent waiting for a free worker thread
+                self.record_execute(name, response, begin)
+            if connection not in self.established:
+                continue # lost while the call was performed. nothing to do
+            if isinstance(error, Exit):
+                self.exit_rpc(connection, error, rpc_id, codec)
+                continue
+            if error: # perform_rpc() catches everything else but e.g. SystemExit
+                raise error
+            self.update_mask(connection)
+            if not async:
+                begin = time.time()
+                response = self.encode_response(response, rpc_id, codec)
+                self.rpc_stats.record(name, 'serialize', time.time() - begin)
+                self.respond(connection, response, name)
 
     def step_keepwatching(self, connection, event, fd):
         if event & INMASK:
@@ -642,18 +1137,19 @@ class Control(Process):
                 authkey = self.keepwatching[connection]
                 self.lost_connection(connection, authkey)
                 self.keepwatching.pop(connection)
-                connection.close()
                 self.unpollable(fd)
+                connection.close()
                 return
 
     # run one step in the main loop
     def step_main(self):
-        self.unpend = [] # TODO: reduce scope from class to function
+        self.unpend = set() # TODO: reduce scope from class to function
         try:
             events = self.poller.poll(self.interval)
-        except select.error, e: # (errno, string) tuple
+        except (select.error, IOError), e: # (errno, string) tuple
             if e[0] == errno.EINTR:
                 return # let caller decide how to proceed
+            raise
         if not events:
             self.idle()
             return
@@ -663,27 +1159,31 @@ class Control(Process):
                                   # another event in the same poller batch.
             connection = self.get_connection(fd)
             self.current_connection = connection
+            self.steps[self.states[fd]](connection, event, fd)
 
-            if connection == self.listener:
-                self.step_listener(self.listener, event, fd)
-
-            elif connection in self.accepting:
-                self.step_accepting(connection, event, fd)
-
-            elif connection in self.authenticating:
-                self.step_authenticating(connection, event, fd)
-
-            elif connection in self.established:
-                self.step_established(connection, event, fd)
-
-            elif connection in self.keepwatching:
-                self.step_keepwatching(connection, event, fd)
+    def decode_rpc(self, payload, negotiated='json'):
+        # clients that negotiated a binary codec use it for every RPC. others
+        # send JSON. the response is encoded the same way as the request
+        try: # welformed blob?
+            rpc, codec = ave.network.codec.decode(payload, negotiated)
+        except Exception, e:
+            raise Exception('malformed JSON: %s' % payload)
+        if type(rpc) != dict:
+            raise Exception('RPC is not a JSON object: %s' % payload)
+        return rpc, codec
+
+    def encode_response(self, response, rpc_id=None, codec='json'):
+        # echo the request ID, if any, so that a client with several pipelined
+        # calls in flight can match the response against the right call
+        if rpc_id != None:
+            response['id'] = rpc_id
+        if codec != 'json' and 'result' not in response:
+            # results have already passed enforce_unicode() but exception
+            # details may hold any kind of strings and sequences
+            response = ave.network.codec.jsonify(response)
+        return ave.network.codec.encode(response, codec)
 
     def validate_rpc(self, rpc, authkey):
-        try: # welformed json blob?
-            rpc = json.loads(rpc)
-        except Exception, e:
-            raise Exception('malformed JSON: %s' % rpc)
         # mandatory fields present?
         if 'method' not in rpc:
             raise Exception('the "method" attribute is missing')
@@ -756,7 +1256,33 @@ class Control(Process):
             trace = traceback.extract_tb(trace)[1:] # don't include handle_rpc()
             for entry in trace: # can't serialize tuples
                 response['exception']['trace'].append(list(entry))
-        return json.dumps(response)
+        return response
+
+    def perform_batch(self, batch, authkey):
+        # validate and perform each call in turn. a call that fails does not
+        # stop the ones after it. the client gets one response per call.
+        if type(batch) != list:
+            raise Exception('RPC batch is not a list: %s' % batch)
+        responses = []
+        for rpc in batch:
+            begin = time.time()
+            try:
+                if type(rpc) != dict:
+                    raise Exception('RPC is not a JSON object: %s' % rpc)
+                method,resource,vargs,kwargs,async = \
+                    self.validate_rpc(rpc, authkey)
+                self.rpc_stats.record(
+                    rpc['method'], 'validate', time.time() - begin
+                )
+            except Exception, e:
+                self.rpc_stats.invalid += 1
+                responses.append({'exception': enforce_unicode(str(e))})
+                continue
+            begin = time.time()
+            response = self.perform_rpc(method, resource, vargs, kwargs)
+            self.record_execute(rpc['method'], response, begin)
+            responses.append(response)
+        return {'batch': responses}
 
     @staticmethod
     def rpc(fn):
@@ -768,6 +1294,11 @@ class Control(Process):
         setattr(fn, 'ave.control.auth', True)
         return fn
 
+    @staticmethod
+    def offload(fn):
+        setattr(fn, 'ave.control.offload', True)
+        return fn
+
     class PreAuthDecorator:
         def __init__(self, *accounts):
             self.accounts = accounts
@@ -777,8 +1308,134 @@ class Control(Process):
 
     preauth = PreAuthDecorator
 
+    # staticmethod objects are not callable until the class has been created,
+    # so use the plain functions to decorate methods in the class body
+    @rpc.__func__
+    @auth.__func__
+    @preauth('admin')
+    def get_rpc_stats(self):
+        '''
+        Built-in RPC that reports the call statistics of the main loop, the
+        number of connections in each state and the amount of queued output.
+        See ``RpcStats`` for details about the per-method statistics. Only
+        callers that authenticated with the "admin" key, if there is one, or
+        with any key otherwise, are allowed to call it.
+        '''
+        stats = self.rpc_stats.report()
+        stats['connections'] = {
+            'accepting'     : len(self.accepting),
+            'authenticating': len(self.authenticating),
+            'established'   : len(self.established),
+            'keepwatching'  : len(self.keepwatching)
+        }
+        stats['queues'] = {
+            'connections': len(self.outgoing), # with unsent output
+            'bytes'      : sum([len(q) for q in self.outgoing.values()]),
+            'offloaded'  : len(self.offloaded), # calls in worker threads
+            'deferred'   : sum([len(r) for r in self.replies.values()])
+        }
+        return stats
+
+class Pending(object):
+    '''
+    Handle to a call that was made through ``RemoteControl.pipeline()``. The
+    response is not read from the network until ``result()`` is called.
+    '''
+
+    def __init__(self, remote, rpc_id):
+        self.remote = remote
+        self.rpc_id = rpc_id
+
+    def __repr__(self):
+        return 'Pending(id=%d)' % self.rpc_id
+
+    def result(self, timeout=None):
+        '''
+        Wait for the response to the call. Responses to other pipelined calls
+        that arrive first are kept until their own ``result()`` is called.
+
+        :arg timeout: Overrides the timeout of the ``RemoteControl``.
+        :returns: The return value of the remote function.
+        :raises: The exception raised by the remote function, if any.
+        '''
+        return self.remote.collect(self.rpc_id, timeout)
+
+class Pipeline(object):
+    '''
+    Proxy returned by ``RemoteControl.pipeline()``. Every attribute is an RPC
+    that is sent immediately and returns a ``Pending`` instead of blocking for
+    the response.
+    '''
+
+    def __init__(self, remote):
+        self.remote = remote
+
+    def __getattr__(self, attribute):
+        def submit(*vargs, **kwargs):
+            return self.remote.submit(attribute, *vargs, **kwargs)
+        return submit
+
+class Batched(object):
+    '''
+    Handle to a call that was made through ``RemoteControl.batch()``. The
+    result is available when the batch has been sent.
+    '''
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    def __repr__(self):
+        return 'Batched(index=%d)' % self.index
+
+    def result(self):
+        '''
+        :returns: The return value of the remote function.
+        :raises: The exception raised by the remote function, if any.
+        '''
+        if self.batch.responses == None:
+            raise Exception('batch has not been sent yet')
+        response = self.batch.responses[self.index]
+        return self.batch.remote.handle_response(response)
+
+class Batch(object):
+    '''
+    Context returned by ``RemoteControl.batch()``. Every attribute is an RPC
+    that is queued and returns a ``Batched`` handle. All queued calls are sent
+    in a single message when the context is exited.
+    '''
+
+    def __init__(self, remote):
+        self.remote    = remote
+        self.calls     = [] # (method, vargs, kwargs) tuples
+        self.responses = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, trace):
+        if type == None: # don't send anything if the block raised
+            self.send()
+        return False
+
+    def __getattr__(self, attribute):
+        def queue(*vargs, **kwargs):
+            if self.responses != None:
+                raise Exception('batch has already been sent')
+            self.calls.append((attribute, vargs, kwargs))
+            return Batched(self, len(self.calls) - 1)
+        return queue
+
+    def send(self):
+        if self.responses != None:
+            raise Exception('batch has already been sent')
+        self.responses = self.remote.send_batch(self.calls)
+
 class RemoteControl(object):
     profile = None
+    codecs  = ave.network.codec.CODECS # preferred codecs, best first
+    pool    = ConnectionPool() # shared by all instances in the process
+    pooled  = False # set by subclasses whose peers keep no per-connection state
     '''
     Class used to connect to ``Control`` objects. Creates a ``Connection``
     object internally to handle socket traffic with the peer.
@@ -795,13 +1452,18 @@ class RemoteControl(object):
     '''
     def __init__(self, address, authkey, timeout, optimist=True, sock=None,
         profile=None, home=None):
-        self._connection = None
-        self.address     = address
-        self.authkey     = authkey
-        self.timeout     = timeout or None
-        self.optimist    = optimist
-        self.profile     = profile
-        self.home        = home
+        self._connection  = None
+        self._codec       = 'json' # negotiated during the handshake
+        self._borrowed    = False  # connection may be given back to the pool
+        self._next_id     = 0
+        self._outstanding = [] # request ID's in the order they were sent
+        self._responses   = {} # request ID -> response received out of turn
+        self.address      = address
+        self.authkey      = authkey
+        self.timeout      = timeout or None
+        self.optimist     = optimist
+        self.profile      = profile
+        self.home         = home
         if sock:
             self._connection = BlockingConnection(self.address, sock)
         try:
@@ -817,28 +1479,67 @@ class RemoteControl(object):
 
     def __del__(self):
         if self._connection:
+            if self._borrowed and self.pooled and not self._outstanding:
+                try:
+                    self.pool.give(
+                        (tuple(self.address), self.authkey),
+                        self._connection, self._codec
+                    )
+                    return
+                except Exception: # e.g. during interpreter shutdown
+                    pass
             self._connection.close()
 
     @classmethod
     def make_rpc_blob(cls, method, resource, *vargs, **kwargs):
+        return json.dumps(cls.make_rpc_dict(method, resource, *vargs, **kwargs))
+
+    @classmethod
+    def make_rpc_dict(cls, method, resource, *vargs, **kwargs):
         async = False
         if '__async__' in kwargs:
             async = not not kwargs['__async__'] # cast to boolean
             del kwargs['__async__']
+        rpc_id = None
+        if '__id__' in kwargs:
+            rpc_id = kwargs['__id__']
+            del kwargs['__id__']
         blob = {
             'method'  : method,
             'resource': resource,
             'params'  : { 'vargs': list(vargs), 'kwargs': kwargs },
             'async'   : async
         }
-        return json.dumps(blob)
+        if rpc_id != None:
+            blob['id'] = rpc_id
+        return blob
 
     @property
     def port(self):
         return self.address[1]
 
     def connect(self, timeout):
-        self._connection = self.make_connection(timeout)
+        self._connection  = self.make_connection(timeout)
+        self._borrowed    = False
+        self._outstanding = []
+        self._responses   = {}
+        return self._connection
+
+    def borrow_connection(self, timeout):
+        # connections made implicitly by RPC calls may be taken from the pool
+        # and given back to it when this object is garbage collected. explicit
+        # calls to connect() always create a new connection because the caller
+        # may hand it over to someone else (e.g. Control.add_connection()).
+        if self.pooled:
+            entry = self.pool.take((tuple(self.address), self.authkey))
+            if entry:
+                self._connection, self._codec = entry
+                self._borrowed    = True
+                self._outstanding = []
+                self._responses   = {}
+                return self._connection
+        self.connect(timeout)
+        self._borrowed = self.pooled
         return self._connection
 
     def make_connection(self, timeout):
@@ -853,33 +1554,148 @@ class RemoteControl(object):
         challenge = c.get(timeout)
         if timeout:
             timeout = max(limit - time.time(), 0)
-        c.put(make_digest(challenge, self.authkey or ''), timeout)
+        # use the best codec that the peer advertised in its challenge. the
+        # peer only accepts binary codecs from clients that have a key
+        self._codec = 'json'
+        if self.authkey:
+            self._codec = ave.network.codec.choose(
+                self.codecs, ave.network.codec.parse_advertisement(challenge)
+            )
+        digest = make_digest(challenge, self.authkey or '')
+        c.put(digest + ave.network.codec.declare(self._codec), timeout)
         # expect second message to finalize the authentication
         if timeout:
             timeout = max(limit - time.time(), 0)
         try:
             finish_challenge(c.get(timeout))
         except AuthError, e:
-            pass # do nothing. peer tracks authentication status
+            self._codec = 'json' # do nothing else. peer tracks auth status
         return c
 
+    def encode_rpc(self, blob):
+        if self._codec == 'json':
+            return json.dumps(blob)
+        # profiles are dict subclasses and callers may pass tuples. normalize
+        # the blob so that the peer gets the same objects as with JSON
+        blob = ave.network.codec.jsonify(blob)
+        return ave.network.codec.encode(blob, self._codec)
+
+    def pipeline(self):
+        '''
+        Get a proxy object that is used to make calls without waiting for the
+        response to one call before the next is sent. Each call on the proxy
+        returns a ``Pending`` handle whose ``result()`` blocks for the response.
+        All calls share the connection of this ``RemoteControl``.
+
+        .. Note:: Calls made through the proxy go straight to the peer. Client
+            side logic in subclasses (e.g. ``RemoteBroker.get()``) is bypassed.
+        '''
+        return Pipeline(self)
+
+    def batch(self):
+        '''
+        Get a context that queues calls until it is exited and then sends all
+        of them to the peer in a single message. The peer performs the calls in
+        order and returns all results in a single response. Each call in the
+        context returns a ``Batched`` handle whose ``result()`` is valid after
+        the context has been exited.
+
+        .. Note:: Calls made in the context go straight to the peer. Client
+            side logic in subclasses (e.g. ``RemoteBroker.get()``) is bypassed.
+        '''
+        return Batch(self)
+
+    def send_batch(self, calls):
+        if not calls:
+            return []
+        batch = [
+            RemoteControl.make_rpc_dict(method, self.profile, *vargs, **kwargs)
+            for (method, vargs, kwargs) in calls
+        ]
+        self._next_id += 1
+        rpc_id = self._next_id
+        if not self._connection:
+            self.borrow_connection(self.timeout)
+        blob = self.encode_rpc({'batch': batch, 'id': rpc_id})
+        self._connection.put(blob, self.timeout)
+        self._outstanding.append(rpc_id)
+        response = self.receive(rpc_id, self.timeout)
+        if 'batch' in response:
+            return response['batch']
+        # the peer does not support batches. fall back on pipelined calls
+        pending = [
+            self.submit(method, *vargs, **kwargs)
+            for (method, vargs, kwargs) in calls
+        ]
+        return [self.receive(p.rpc_id, self.timeout) for p in pending]
+
+    def submit(self, attribute, *vargs, **kwargs):
+        '''
+        Send an RPC tagged with a request ID and return a ``Pending`` for it
+        without waiting for the response.
+        '''
+        self._next_id += 1
+        rpc_id = self._next_id
+        kwargs['__id__'] = rpc_id
+        if not self._connection:
+            self.borrow_connection(self.timeout)
+        blob = self.encode_rpc(RemoteControl.make_rpc_dict(
+            attribute, self.profile, *vargs, **kwargs
+        ))
+        self._connection.put(blob, self.timeout)
+        self._outstanding.append(rpc_id)
+        return Pending(self, rpc_id)
+
+    def receive(self, rpc_id, timeout):
+        while rpc_id not in self._responses:
+            response, codec = ave.network.codec.decode(
+                self._connection.get(timeout), self._codec
+            )
+            if 'id' in response:
+                key = response.pop('id')
+            elif self._outstanding:
+                # peer does not tag its responses, which means that it answers
+                # calls in the order they were sent
+                key = self._outstanding[0]
+            else:
+                key = None
+            if key in self._outstanding:
+                self._outstanding.remove(key)
+            self._responses[key] = response
+        return self._responses.pop(rpc_id)
+
+    def collect(self, rpc_id, timeout=None):
+        if timeout == None:
+            timeout = self.timeout
+        return self.handle_response(self.receive(rpc_id, timeout))
+
+    def handle_response(self, response):
+        if 'exception' in response:
+            self.panotti.shout(self.job_guid, response, self.home, False)
+            raise exception_factory(response['exception'])
+        return response['result']
+
     def __getattr__(self, attribute):
         def make_rpc(*vargs, **kwargs):
             async   = ('__async__' in kwargs) and (not not kwargs['__async__'])
+            if self._outstanding and not async:
+                # pipelined calls are in flight. tag this one too so that its
+                # response can be told apart from theirs
+                return self.submit(attribute, *vargs, **kwargs).result()
             timeout = self.timeout
             if async:
                 timeout = 1 # better to fail quickly than to block on __async__
-            blob = RemoteControl.make_rpc_blob(
-                attribute, self.profile, *vargs, **kwargs
-            )
             if not self._connection:
-                self._connection = self.make_connection(timeout)
+                self.borrow_connection(timeout)
+            blob = self.encode_rpc(RemoteControl.make_rpc_dict(
+                attribute, self.profile, *vargs, **kwargs
+            ))
+            if not async:
+                # track the call like an untagged pipelined call. the connection
+                # is not given back to the pool if the response never arrives
+                self._outstanding.append(None)
             self._connection.put(blob, timeout)
             if async:
                 return None
-            response = json.loads(self._connection.get(self.timeout))
-            if 'exception' in response:
-                self.panotti.shout(self.job_guid, response, self.home, False)
-                raise exception_factory(response['exception'])
-            return response['result']
+            return self.collect(None)
         return make_rpc
@@ -41,6 +41,14 @@ class ConnectionReset(Exception):
     def __init__(self, msg='connection reset'):
         Exception.__init__(self, msg)
 
+class ConnectionFull(Exception):
+    '''
+    Too many bytes are queued for writing on the connection. I.e. the peer does
+    not read its messages.
+    '''
+    def __init__(self, msg='connection output queue is full'):
+        Exception.__init__(self, msg)
+
 # process exceptions
 
 class Unstarted(Exception):
@@ -0,0 +1,107 @@
+# Copyright (C) 2014 Sony Mobile Communications Inc.
+# All rights, including trade secret rights, reserved.
+
+import os
+import time
+import select
+
+INMASK  = select.POLLIN | select.POLLPRI
+ERRMASK = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+def is_idle(connection):
+    # an idle connection has nothing to read. if it is readable, then the peer
+    # either closed it or sent something that nobody is waiting for.
+    try:
+        poller = select.poll()
+        poller.register(connection.fileno(), INMASK | ERRMASK)
+        return not poller.poll(0)
+    except Exception:
+        return False
+
+class ConnectionPool(object):
+    '''
+    Keeps authenticated connections that are no longer used by any
+    ``RemoteControl`` so that new ``RemoteControl`` objects with the same
+    address and authentication key can skip the handshake.
+
+    :arg size: The maximum number of idle connections to keep. The connection
+        that was idle the longest is closed to make room for a new one.
+    :arg idle: Seconds before an idle connection is closed.
+    '''
+
+    def __init__(self, size=16, idle=60):
+        self.size    = size
+        self.idle    = idle
+        self.pid     = os.getpid()
+        self.conns   = {} # (address, authkey) -> [(connection, codec, since)]
+        self.orphans = [] # connections inherited from the parent process
+
+    def __len__(self):
+        return sum([len(entries) for entries in self.conns.values()])
+
+    def check_pid(self):
+        # a child process must not use the connections of its parent. neither
+        # may it close them: Process.start() closes all file descriptors in the
+        # child, so the numbers may already belong to other files. keep the
+        # objects referenced so that garbage collection won't close them.
+        if os.getpid() == self.pid:
+            return
+        self.orphans.append(self.conns)
+        self.conns = {}
+        self.pid   = os.getpid()
+
+    def evict(self, limit):
+        for key in self.conns.keys():
+            keep = []
+            for entry in self.conns[key]:
+                if entry[2] < limit:
+                    entry[0].close()
+                else:
+                    keep.append(entry)
+            if keep:
+                self.conns[key] = keep
+            else:
+                del self.conns[key]
+
+    def take(self, key):
+        '''
+        Get an idle connection for the key, or ``None`` if there is no healthy
+        one in the pool.
+
+        :returns: A (connection, codec) tuple or ``None``.
+        '''
+        self.check_pid()
+        self.evict(time.time() - self.idle)
+        entries = self.conns.get(key, [])
+        while entries:
+            connection, codec, since = entries.pop() # most recently used first
+            if is_idle(connection):
+                return connection, codec
+            connection.close()
+        return None
+
+    def give(self, key, connection, codec):
+        '''
+        Put a connection that is not in use by anyone into the pool.
+        '''
+        self.check_pid()
+        now = time.time()
+        self.evict(now - self.idle)
+        if self.size < 1 or connection.watched or not is_idle(connection):
+            connection.close()
+            return
+        if len(self) >= self.size:
+            oldest = min(
+                self.conns.keys(), key=lambda k: self.conns[k][0][2]
+            )
+            self.conns[oldest].pop(0)[0].close()
+            if not self.conns[oldest]:
+                del self.conns[oldest]
+        self.conns.setdefault(key, []).append((connection, codec, now))
+
+    def clear(self):
+        '''
+        Close all idle connections.
+        '''
+        self.check_pid()
+        self.evict(float('inf'))
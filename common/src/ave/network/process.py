@@ -8,6 +8,7 @@ import time
 import errno
 import signal
 import ctypes
+import threading
 import traceback
 
 import json
@@ -33,6 +34,40 @@ def get_proc_name(pid):
     except Exception, e:
         raise Exception('could not get process name for PID %d: %s' % (pid, e))
 
+# close_range(2) has the same system call number on all architectures. it is
+# available in Linux 5.9 and later. older kernels return ENOSYS and some
+# sandboxes return EPERM, in which case file descriptors are closed one by one.
+SYS_close_range = 436
+_close_range    = True # cleared when the kernel turns out to lack support
+
+def close_range(first, last):
+    global _close_range
+    if not _close_range:
+        return False
+    libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    result = libc.syscall(
+        ctypes.c_long(SYS_close_range), ctypes.c_ulong(first),
+        ctypes.c_ulong(last), ctypes.c_ulong(0)
+    )
+    if result == 0:
+        return True
+    if ctypes.get_errno() in [errno.ENOSYS, errno.EPERM]:
+        _close_range = False
+    return False
+
+def close_fds_except(exclude):
+    # close every gap between the sorted descriptors to keep, then everything
+    # above the highest one. this takes one system call per kept descriptor no
+    # matter how many descriptors are open.
+    first = 0
+    for fd in sorted(set(exclude)):
+        if fd < first:
+            continue
+        if fd > first and not close_range(first, fd - 1):
+            return False
+        first = fd + 1
+    return close_range(first, 0xffffffff)
+
 class Process(object):
     _pid    = -1
     target  = None
@@ -90,6 +125,8 @@ class Process(object):
         # close all file descriptors except 0,1,2, whatever file descriptor is
         # connected to /dev/ptmx, and whatever the subclass wants to keep open.
         exclude.extend([0,1,2])
+        if close_fds_except(exclude):
+            return
         for fd in self.list_fds().keys():
             if fd in exclude:
                 continue
@@ -163,13 +200,22 @@ class Process(object):
 
     def _daemonize(self):
         # double-fork. refer to "Advanced Programming in the UNIX Environment"
+        # the first parent tells the second child over a pipe when the first
+        # child has been reaped. re-parenting is complete at that point, so the
+        # second child does not have to poll its ppid.
+        confirm_r, confirm_w = os.pipe()
         try: # first fork
             pid = os.fork()
             if pid > 0: # first parent
+                os.close(confirm_r)
                 os.waitpid(pid, 0) # wait for second child to start
+                os.write(confirm_w, 'r')
+                os.close(confirm_w)
                 return False # return to caller of daemonize()
         except OSError, e:
             self.log('fork #1 failed: %s' % e)
+            os.close(confirm_r)
+            os.close(confirm_w)
             return # return caller of daemonize()
 
         # decouple first parent
@@ -188,8 +234,18 @@ class Process(object):
             os._exit(1)
 
         # wait until ppid changes
-        while os.getppid() == ppid:
-            time.sleep(0.1)
+        os.close(confirm_w)
+        while True:
+            try:
+                confirmed = os.read(confirm_r, 1)
+                break
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
+        os.close(confirm_r)
+        if not confirmed: # first parent died before it could confirm
+            while os.getppid() == ppid:
+                time.sleep(0.1)
 
         return True
 
@@ -287,3 +343,127 @@ class Process(object):
                 time.ctime(), self.proc_name, os.getpid(), message
             ))
             sys.stderr.flush()
+
+class ForkServer(Process):
+    '''
+    A small helper process that starts daemonized processes on behalf of its
+    owner. The helper should be started early, before the owner has grown large
+    or opened many file descriptors, so that new processes are forked from a
+    small and clean template instead of from the owner itself.
+
+    The helper can only construct processes whose classes can be imported by
+    name and whose constructor arguments can be serialized to JSON.
+
+    :arg preload: A list of module names to import in the helper before it
+        serves any requests.
+    '''
+
+    def __init__(self, preload=None, logging=False):
+        Process.__init__(self, None, None, logging, 'ave-forkserver')
+        self.preload  = preload or []
+        self.requests = Pipe() # owner -> helper
+        self.replies  = Pipe() # helper -> owner
+        self.lock     = threading.Lock()
+        self.owner    = None
+
+    def start(self, daemonize=False, synchronize=False):
+        Process.start(self, daemonize, synchronize)
+        self.owner = os.getpid()
+        # keep only the owner's ends of the pipes open
+        os.close(self.requests.r)
+        os.close(self.replies.w)
+        self.requests.r = -1
+        self.replies.w  = -1
+
+    def close_fds(self, exclude):
+        exclude.extend([self.requests.r, self.replies.w])
+        Process.close_fds(self, exclude)
+
+    def run(self):
+        self.requests.w = -1 # closed by close_fds()
+        self.replies.r  = -1
+        for module in self.preload:
+            __import__(module)
+        while True:
+            try:
+                request = self.requests.get()
+            except (ConnectionClosed, ConnectionReset):
+                return # the owner is gone
+            try:
+                self.replies.put({'pid': self.fork(*request)})
+            except Exception, e:
+                self.replies.put({'error': str(e)})
+
+    def fork(self, module, name, args, kwargs, synchronize):
+        __import__(module)
+        cls = getattr(sys.modules[module], name)
+        if not (isinstance(cls, type) and issubclass(cls, Process)):
+            raise Exception('not a Process class: %s.%s' % (module, name))
+        process = cls(*args, **kwargs)
+        process.start(daemonize=True, synchronize=synchronize)
+        if synchronize:
+            return process.pid
+        return None
+
+    def spawn(self, cls, args=None, kwargs=None, synchronize=False):
+        '''
+        Let the helper construct a process of class *cls* and start it with
+        ``start(daemonize=True)``.
+
+        :arg cls: A subclass of ``Process``.
+        :arg args: A list of JSON serializable constructor arguments.
+        :arg kwargs: A dictionary of JSON serializable keyword arguments.
+        :arg synchronize: Wait until the new process is fully initialized.
+        :returns: The PID of the new process if *synchronize* is ``True``,
+            otherwise ``None``.
+        :raises Exception: If the helper is not running or if the process
+            could not be created.
+        '''
+        if self.owner != os.getpid():
+            raise Exception('fork server is not owned by this process')
+        request = [
+            cls.__module__, cls.__name__, list(args or []), kwargs or {},
+            synchronize
+        ]
+        with self.lock:
+            try:
+                self.requests.put(request)
+                reply = self.replies.get()
+            except (OSError, ConnectionClosed, ConnectionReset), e:
+                raise Exception('fork server is not running: %s' % e)
+        if 'error' in reply:
+            raise Exception('fork server could not start process: %s'
+                            % reply['error'])
+        return reply['pid']
+
+_forkserver = None
+
+def start_forkserver(preload=None):
+    '''
+    Start a ``ForkServer`` for the current process unless one is running.
+
+    :returns: The ``ForkServer``.
+    '''
+    global _forkserver
+    if get_forkserver():
+        return _forkserver
+    _forkserver = ForkServer(preload)
+    _forkserver.start(synchronize=True)
+    return _forkserver
+
+def get_forkserver():
+    '''
+    :returns: The ``ForkServer`` started by the current process or ``None``.
+        Children do not inherit the fork server of their parent.
+    '''
+    if _forkserver and _forkserver.owner == os.getpid():
+        return _forkserver
+    return None
+
+def stop_forkserver():
+    global _forkserver
+    server = get_forkserver()
+    _forkserver = None
+    if server:
+        server.terminate()
+        server.join()
@@ -0,0 +1,411 @@
+# Copyright (C) 2014 Sony Mobile Communications Inc.
+# All rights, including trade secret rights, reserved.
+
+import os
+import json
+import time
+import errno
+import select
+import socket
+
+import ave.network.codec
+
+from ave.network.connection import *
+from ave.network.exceptions import *
+from ave.network.control    import RemoteControl, make_poller
+from ave.network.control    import INMASK, OUTMASK, ERRMASK
+
+# client connection states
+CLOSED         = 0
+CONNECTING     = 1
+CHALLENGED     = 2 # waiting for the challenge
+AUTHENTICATING = 3 # waiting for the authentication result
+ESTABLISHED    = 4
+
+class Future(object):
+    '''
+    The result of a call made with an ``AsyncRemoteControl``. It is completed
+    by a ``Reactor`` when the response arrives.
+    '''
+
+    def __init__(self):
+        self._done      = False
+        self._result    = None
+        self._exception = None
+        self._callbacks = []
+
+    def __repr__(self):
+        if not self._done:
+            return 'Future(pending)'
+        if self._exception:
+            return 'Future(exception=%r)' % self._exception
+        return 'Future(result=%r)' % (self._result,)
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        '''
+        :returns: The return value of the remote function.
+        :raises: The exception raised by the remote function, if any.
+        '''
+        if not self._done:
+            raise Exception('call has not completed yet')
+        if self._exception:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        if not self._done:
+            raise Exception('call has not completed yet')
+        return self._exception
+
+    def add_done_callback(self, fn):
+        '''
+        Call *fn* with the future as its only argument when the future is
+        completed. Called immediately if the future is completed already.
+        '''
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def set_result(self, result):
+        self.complete(result, None)
+
+    def set_exception(self, exception):
+        self.complete(None, exception)
+
+    def complete(self, result, exception):
+        if self._done:
+            raise Exception('future already completed')
+        self._done      = True
+        self._result    = result
+        self._exception = exception
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+class Reactor(object):
+    '''
+    Polls the connections of many ``AsyncRemoteControl`` objects in a single
+    thread and completes their futures as responses arrive.
+
+    :arg backend: The poll backend. See ``ave.network.control.make_poller()``.
+    '''
+    _default = None # per process. see Reactor.default()
+
+    def __init__(self, backend=None):
+        self.pid     = os.getpid()
+        self.poller  = make_poller(backend)
+        self.clients = {} # fd -> AsyncRemoteControl
+
+    @classmethod
+    def default(cls):
+        # a child process must not share the poller of its parent
+        if not cls._default or cls._default.pid != os.getpid():
+            cls._default = Reactor()
+        return cls._default
+
+    def register(self, fd, client, mask):
+        self.poller.register(fd, mask, self.clients.get(fd) is not client)
+        self.clients[fd] = client
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+        del self.clients[fd]
+
+    def step(self, timeout=None):
+        '''
+        Poll all connections once and handle their events.
+
+        :arg timeout: Maximum number of seconds to wait for events. ``None``
+            waits until any call either completes or times out.
+        '''
+        now = time.time()
+        deadlines = [c.deadline() for c in self.clients.values()]
+        deadlines = [d for d in deadlines if d != None]
+        if timeout != None:
+            deadlines.append(now + timeout)
+        if deadlines:
+            wait = int(max(min(deadlines) - now, 0) * 1000 + 1) # milliseconds
+        else:
+            wait = -1
+        try:
+            events = self.poller.poll(wait)
+        except (select.error, IOError), e: # (errno, string) tuple
+            if e[0] != errno.EINTR:
+                raise
+            events = []
+        for fd, event in events:
+            if fd in self.clients: # may be closed by another event handler
+                self.clients[fd].handle_event(event)
+        now = time.time()
+        for client in self.clients.values():
+            client.expire(now)
+
+    def wait(self, futures, timeout=None):
+        '''
+        Handle events until all *futures* are completed.
+
+        :arg timeout: Maximum number of seconds to wait.
+        :returns: A (done, pending) tuple of lists of futures.
+        '''
+        limit = None
+        if timeout != None:
+            limit = time.time() + timeout
+        while True:
+            pending = [f for f in futures if not f.done()]
+            if not pending:
+                break
+            if not self.clients:
+                raise Exception('no connections to wait for: %s' % pending)
+            if limit == None:
+                self.step()
+            elif time.time() >= limit:
+                break
+            else:
+                self.step(limit - time.time())
+        return [f for f in futures if f.done()], pending
+
+    def run(self, future, timeout=None):
+        '''
+        Handle events until *future* is completed.
+
+        :returns: The result of the future.
+        :raises: *ConnectionTimeout* if the future was not completed in time.
+        '''
+        done, pending = self.wait([future], timeout)
+        if pending:
+            raise ConnectionTimeout('timed out')
+        return future.result()
+
+class AsyncRemoteControl(object):
+    '''
+    Non-blocking counterpart of ``RemoteControl``. Uses the same framing,
+    authentication and codec negotiation, but calls return ``Future`` objects
+    instead of blocking. Connections are established on the first call. Many
+    calls may be in flight at the same time, on many controls, and a single
+    ``Reactor`` drives all of them.
+
+    :arg address: A (host, port) tuple.
+    :arg authkey: The authentication key, if any, to use.
+    :arg timeout: Seconds before a call fails with ``ConnectionTimeout``,
+        including the time needed to connect. ``None`` waits forever.
+    :arg profile: Set by subclasses that call methods on resources.
+    :arg reactor: The ``Reactor`` to use. Defaults to ``Reactor.default()``.
+    '''
+    codecs  = ave.network.codec.CODECS # preferred codecs, best first
+    profile = None
+
+    def __init__(
+            self, address, authkey, timeout=None, profile=None, reactor=None
+        ):
+        self.address  = tuple(address)
+        self.authkey  = authkey
+        self.timeout  = timeout or None
+        self.profile  = profile
+        self.reactor  = reactor or Reactor.default()
+        self._connection = None
+        self._fd         = None
+        self._state      = CLOSED
+        self._codec      = 'json' # negotiated during the handshake
+        self._output     = None   # OutputQueue
+        self._next_id    = 0
+        self._calls      = {} # request ID -> (Future, deadline)
+        self._order      = [] # request ID's in the order they were sent
+        self._waiting    = [] # (request ID, blob, Future) to send on connect
+
+    def __getattr__(self, attribute):
+        if attribute.startswith('_'):
+            raise AttributeError(attribute)
+        def make_call(*vargs, **kwargs):
+            return self.call(attribute, *vargs, **kwargs)
+        return make_call
+
+    def call(self, method, *vargs, **kwargs):
+        '''
+        Call *method* on the peer. ``__async__=True`` may be passed to not wait
+        for a response, in which case the future is completed when the call
+        has been queued for sending.
+
+        :returns: A ``Future``.
+        '''
+        self._next_id += 1
+        rpc_id = self._next_id
+        async = ('__async__' in kwargs) and (not not kwargs['__async__'])
+        if not async:
+            kwargs['__id__'] = rpc_id
+        blob = RemoteControl.make_rpc_dict(
+            method, self.profile, *vargs, **kwargs
+        )
+        future = Future()
+        if not async:
+            deadline = None
+            if self.timeout:
+                deadline = time.time() + self.timeout
+            self._calls[rpc_id] = (future, deadline)
+        if self._state == ESTABLISHED:
+            self.send(rpc_id, blob, future)
+        else:
+            self._waiting.append((rpc_id, blob, future))
+            if self._state == CLOSED:
+                self.connect()
+        return future
+
+    def close(self):
+        '''
+        Close the connection. Calls in progress fail with ``ConnectionClosed``.
+        '''
+        self.fail(ConnectionClosed('closed by client'))
+
+    def connect(self):
+        self._connection = Connection(self.address)
+        try:
+            self._connection.connect()
+        except ConnectionInProgress:
+            pass
+        except socket.error, e:
+            self._connection = None
+            if e.errno == errno.ECONNREFUSED:
+                return self.fail(ConnectionRefused())
+            return self.fail(ConnectionClosed(str(e)))
+        self._fd     = self._connection.fileno()
+        self._state  = CONNECTING
+        self._output = OutputQueue()
+        self.reactor.register(self._fd, self, OUTMASK)
+
+    def update_mask(self):
+        if self._state == CONNECTING:
+            mask = OUTMASK # writable when the connection attempt completes
+        else:
+            mask = INMASK
+            if len(self._output):
+                mask |= OUTMASK
+        self.reactor.register(self._fd, self, mask)
+
+    def encode_rpc(self, blob):
+        if self._codec == 'json':
+            return json.dumps(blob)
+        blob = ave.network.codec.jsonify(blob)
+        return ave.network.codec.encode(blob, self._codec)
+
+    def send(self, rpc_id, blob, future):
+        self._output.append(self.encode_rpc(blob))
+        if rpc_id in self._calls:
+            self._order.append(rpc_id)
+        else:
+            future.set_result(None) # asynchronous call. no response expected
+        self.update_mask()
+
+    def deadline(self):
+        deadlines = [d for (f, d) in self._calls.values() if d != None]
+        if not deadlines:
+            return None
+        return min(deadlines)
+
+    def expire(self, now):
+        for rpc_id in self._calls.keys():
+            future, deadline = self._calls[rpc_id]
+            if deadline != None and deadline <= now:
+                # a late response is thrown away when it arrives
+                del self._calls[rpc_id]
+                self._waiting = [w for w in self._waiting if w[0] != rpc_id]
+                future.set_exception(ConnectionTimeout('timed out'))
+
+    def fail(self, exception):
+        if self._fd != None:
+            self.reactor.unregister(self._fd)
+            self._fd = None
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+        self._state  = CLOSED
+        self._output = None
+        calls   = [f for (f, d) in self._calls.values()]
+        calls  += [f for (i, b, f) in self._waiting if not f.done()]
+        self._calls   = {}
+        self._order   = []
+        self._waiting = []
+        for future in calls:
+            if not future.done():
+                future.set_exception(exception)
+
+    def handle_event(self, event):
+        try:
+            if self._state == CONNECTING:
+                self.handle_connecting(event)
+                return
+            if event & OUTMASK:
+                self._output.flush(self._connection)
+            if event & INMASK:
+                self.handle_input()
+            if event & ERRMASK and self._state != CLOSED:
+                raise ConnectionClosed()
+            if self._state != CLOSED:
+                self.update_mask()
+        except Exception, e: # e.g. ConnectionClosed or a malformed message
+            self.fail(e)
+
+    def handle_connecting(self, event):
+        error = self._connection.socket.getsockopt(
+            socket.SOL_SOCKET, socket.SO_ERROR
+        )
+        if error == errno.ECONNREFUSED:
+            return self.fail(ConnectionRefused())
+        if error or event & ERRMASK:
+            return self.fail(ConnectionClosed(os.strerror(error)))
+        self._state = CHALLENGED
+        self.update_mask()
+
+    def handle_input(self):
+        while self._state != CLOSED:
+            message = self._connection.get()
+            if message == None:
+                return # incomplete message read, try again later
+            if self._state == CHALLENGED:
+                # use the best codec that the peer advertised in its challenge.
+                # the peer only accepts binary codecs from clients with a key
+                if self.authkey:
+                    self._codec = ave.network.codec.choose(
+                        self.codecs,
+                        ave.network.codec.parse_advertisement(message)
+                    )
+                digest = make_digest(message, self.authkey or '')
+                self._output.append(
+                    digest + ave.network.codec.declare(self._codec)
+                )
+                self._state = AUTHENTICATING
+            elif self._state == AUTHENTICATING:
+                try:
+                    finish_challenge(message)
+                except AuthError:
+                    self._codec = 'json' # peer tracks authentication status
+                self._state = ESTABLISHED
+                waiting, self._waiting = self._waiting, []
+                for rpc_id, blob, future in waiting:
+                    self.send(rpc_id, blob, future)
+            else:
+                self.handle_response(
+                    ave.network.codec.decode(message, self._codec)[0]
+                )
+
+    def handle_response(self, response):
+        if 'id' in response:
+            key = response.pop('id')
+        elif self._order:
+            # peer does not tag its responses, which means that it answers
+            # calls in the order they were sent. an exit message also lands
+            # here, which makes the oldest call fail with the exit exception
+            key = self._order[0]
+        else:
+            return # unsolicited message. nobody is waiting for it
+        if key in self._order:
+            self._order.remove(key)
+        if key not in self._calls:
+            return # the call timed out
+        future = self._calls.pop(key)[0]
+        if 'exception' in response:
+            future.set_exception(exception_factory(response['exception']))
+        else:
+            future.set_result(response['result'])
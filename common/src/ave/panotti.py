@@ -6,7 +6,7 @@ import traceback
 
 from datetime import datetime
 
-from ave.network.process import Process
+from ave.network.process import Process, get_forkserver
 from ave.network.control import Control, RemoteControl
 
 import ave.config
@@ -132,5 +132,12 @@ class Shouter(Process):
 def shout(guid, json_data, home=None, print_errors=False):
     if not guid:
         return
+    server = get_forkserver()
+    if server:
+        try:
+            server.spawn(Shouter, [guid, json_data, home, print_errors])
+            return
+        except Exception, e:
+            pass # fall back to forking the caller
     shouter = Shouter(guid, json_data, home, logging=print_errors)
     shouter.start(daemonize=True, synchronize=False)
@@ -1,6 +1,8 @@
 # Copyright (C) 2013 Sony Mobile Communications AB.
 # All rights, including trade secret rights, reserved.
 
+import bisect
+import weakref
 import traceback
 
 class Profile(dict):
@@ -59,3 +61,168 @@ class Profile(dict):
         '''
         raise Exception('Profile subclasses must implement minimize()')
 
+
+def intern_value(value):
+    # unicode strings cannot be interned. ASCII ones compare and hash equal to
+    # their str counterparts, which can
+    if type(value) == unicode:
+        try:
+            value = str(value)
+        except UnicodeEncodeError:
+            return value
+    if type(value) == str:
+        return intern(value)
+    return value
+
+class FrozenList(tuple):
+    pass # marks tuples that were lists before freezing
+
+def freeze_value(value):
+    if isinstance(value, FrozenProfile):
+        return value
+    if isinstance(value, dict):
+        return FrozenProfile(value)
+    if isinstance(value, list):
+        return FrozenList([freeze_value(v) for v in value])
+    return intern_value(value)
+
+def type_value(value):
+    # values that compare equal may still differ in type, e.g. 1, 1.0 and True.
+    # tag every value with its type to keep such profiles apart when interning
+    if isinstance(value, FrozenList):
+        return (FrozenList, tuple([type_value(v) for v in value]))
+    return (type(value), value)
+
+def thaw_value(value):
+    if isinstance(value, FrozenProfile):
+        return value.thaw()
+    if isinstance(value, FrozenList):
+        return [thaw_value(v) for v in value]
+    return value
+
+class FrozenProfile(object):
+    '''
+    An immutable, compact counterpart of ``Profile``. Equal profiles are only
+    stored once: creating a ``FrozenProfile`` with the same keys and values, of
+    the same types, as an existing one returns the existing object. Keys and
+    string values are interned, so many profiles with similar contents share
+    most of their memory. Equality is structural and is decided by identity
+    for two frozen profiles, which makes it cheap to compare large numbers of
+    them.
+
+    The read only parts of the ``dict`` interface are supported. Lists and
+    dictionaries in the values are frozen too, but are returned as fresh
+    ``list`` and ``dict`` objects. Use ``thaw()`` to get a modifiable copy
+    that can be passed to a ``Profile`` constructor or serialized to JSON.
+
+    :arg values: A *dict* or *Profile* instance.
+    '''
+    __slots__ = ('_items', '_hash', '__weakref__')
+    _interned = weakref.WeakValueDictionary() # typed items -> FrozenProfile
+
+    def __new__(cls, values):
+        if isinstance(values, FrozenProfile):
+            return values
+        items = tuple(sorted([
+            (intern_value(k), freeze_value(v)) for k, v in values.items()
+        ]))
+        typed = tuple([(type_value(k), type_value(v)) for k, v in items])
+        try:
+            return cls._interned[typed]
+        except KeyError:
+            pass
+        self = object.__new__(cls)
+        self._items = items # sorted by key
+        self._hash  = hash(items)
+        cls._interned[typed] = self
+        return self
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if isinstance(other, FrozenProfile):
+            return False # equal contents would have given the same object
+        if not isinstance(other, dict):
+            return NotImplemented
+        if len(other) != len(self._items):
+            return False
+        for key, value in self._items:
+            if key not in other or thaw_value(value) != other[key]:
+                return False
+        return True
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def _find(self, key):
+        i = bisect.bisect_left(self._items, (key,))
+        if i < len(self._items) and self._items[i][0] == key:
+            return i
+        return -1
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        return thaw_value(self._items[i][1])
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return 'FrozenProfile(%r)' % self.thaw()
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def has_key(self, key):
+        return key in self
+
+    def keys(self):
+        return [k for k, v in self._items]
+
+    def values(self):
+        return [thaw_value(v) for k, v in self._items]
+
+    def items(self):
+        return [(k, thaw_value(v)) for k, v in self._items]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def thaw(self):
+        '''
+        :returns: A ``dict`` with the same contents.
+        '''
+        return dict(self.items())
+
+    def match(self, profile):
+        '''
+        Like ``Profile.match()``.
+        '''
+        for p in profile:
+            if p not in self:
+                return False
+            if profile[p] != self[p]:
+                return False
+        return True
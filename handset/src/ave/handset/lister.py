@@ -6,7 +6,6 @@ import traceback
 import signal
 import select
 import time
-import copy
 import errno
 import socket
 import json
@@ -14,6 +13,7 @@ import json
 from ctypes           import *
 from datetime         import datetime, timedelta
 
+from ave.profile            import FrozenProfile
 from ave.handset.profile    import HandsetProfile
 from ave.network.control    import RemoteControl
 from ave.network.process    import Process
@@ -365,7 +365,7 @@ class HandsetLister(Process):
                 time.sleep(10) # status unlikely to change soon
                 continue
 
-            old = copy.deepcopy(profile) # only report if any change is seen
+            old = FrozenProfile(profile) # only report if any change is seen
 
             profile['power_state'] = cls.get_online_power_state(h)
             if profile['power_state'] == 'enumeration':
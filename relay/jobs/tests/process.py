@@ -1,7 +1,9 @@
 import time
+import psutil
 import traceback
 
 from ave.network.connection import find_free_port
+from ave.network.process    import get_proc_name
 from ave.relay.lister       import RelayLister
 from ave.relay.reporter     import Reporter
 from ave.relay.server       import RelayServer
@@ -95,3 +97,40 @@ def t5(pretty, factory):
         return False
 
     return True
+
+# check that the relay server forks its reporters from a fork server and that
+# relays still reach the broker that way
+@setup.factory()
+def t6(pretty, factory):
+    factory.write_config('authkeys.json', setup.AUTHKEYS)
+    b = factory.make_broker()
+    s = factory.make_server()
+    server = factory.processes[-1]
+
+    # the server was not started synchronously. give it time to initialize
+    proc  = psutil.Process(server.pid)
+    names = []
+    for i in range(10):
+        if 'children' in dir(proc):
+            children = proc.children()
+        else:
+            children = proc.get_children()
+        names = [get_proc_name(c.pid) for c in children]
+        if 'ave-forkserver' in names:
+            break
+        time.sleep(0.5)
+    if 'ave-forkserver' not in names:
+        print('FAIL %s: no fork server: %s' % (pretty, names))
+        return False
+
+    s.set_boards([setup.BOARD_1])
+    for i in range(6):
+        relays = b.list_equipment({'type':'relay'})
+        if relays:
+            break
+        time.sleep(0.5)
+    if not relays:
+        print('FAIL %s: no relays reported to broker' % pretty)
+        return False
+
+    return True
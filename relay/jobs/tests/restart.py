@@ -2,11 +2,13 @@
 # All rights, including trade secret rights, reserved.
 
 import time
+import threading
 
 from ave.broker._broker     import RemoteBroker
 from ave.network.exceptions import *
 from ave.network.connection import find_free_port
 from ave.relay.profile      import BoardProfile, RelayProfile
+from ave.relay.server       import RemoteRelayServer
 
 import setup
 
@@ -146,3 +148,53 @@ def t3(pretty, factory):
 
     return True
 
+
+# check that a handover waits for an ongoing circuit change to finish before
+# the state of the board is serialized
+@setup.factory()
+def t4(pretty, factory):
+    factory.write_config('authkeys.json', setup.AUTHKEYS)
+
+    profile  = {'type':'relay','uid':'abc4.a'}
+    handover = factory.make_server()
+    handover.set_boards([setup.SLOW_BOARD])
+
+    # change a circuit from another client. the mock board takes a second to
+    # switch, so the handover is started while the change is in flight
+    errors = []
+    def change():
+        try:
+            other = RemoteRelayServer(None, 'admin', home=factory.HOME.path)
+            other.set_board_circuit(profile, 'usb.pc.vcc', False)
+        except Exception, e:
+            errors.append(e)
+    thread = threading.Thread(target=change)
+    thread.start()
+    time.sleep(0.3)
+
+    try:
+        state = handover.begin_handover()
+    except Exception, e:
+        print('FAIL %s: could not begin handover: %s' % (pretty, e))
+        return False
+    thread.join()
+
+    if errors:
+        print('FAIL %s: circuit change failed: %s' % (pretty, errors[0]))
+        return False
+    if state['boards'][0]['state'][0] != 0:
+        print('FAIL %s: wrong board state: %s' % (pretty, state['boards']))
+        return False
+
+    # later changes must be refused
+    try:
+        handover.set_board_circuit(profile, 'usb.pc.vcc', True)
+        print('FAIL %s: circuit change after handover did not fail' % pretty)
+        return False
+    except Restarting:
+        pass
+    except Exception, e:
+        print('FAIL %s: wrong exception: %s' % (pretty, e))
+        return False
+
+    return True
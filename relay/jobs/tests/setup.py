@@ -3,6 +3,7 @@
 
 import os
 import json
+import time
 import struct
 
 from ave.relay.board        import RelayBoard
@@ -42,6 +43,15 @@ BOARD_3 = {
     'power_state': 'online'
 }
 
+SLOW_BOARD = {
+    'vendor'     : 'mock',
+    'product'    : 'slow',
+    'serial'     : 'abc4',
+    'sysfs_path' : None,
+    'device_node': None,
+    'power_state': 'online'
+}
+
 RELAY_1 = {
     'type': 'relay',
     'uid' : 'abc1.a',
@@ -114,6 +124,8 @@ class MockBoard(object):
         if circuit not in self.config['groups'][group]:
             raise Exception('no such circuit: %s' % circuit)
         port = self.config['groups'][group][circuit]
+        if self.profile['product'] == 'slow': # takes a while to switch
+            time.sleep(1)
         self.state[port-1] = int(value)
 
     def reset_group(self, group):
@@ -133,7 +145,10 @@ class MockServer(RelayServer):
 
     def initialize(self):
         self.config['logging'] = False
-        Control.initialize(self)
+        RelayServer.initialize(self)
+
+    def start_lister(self):
+        pass # boards are set by the tests
 
     def make_board(self, profile, home):
         return MockBoard(profile)
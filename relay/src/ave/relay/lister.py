@@ -190,6 +190,7 @@ class RelayLister(Process):
             'report equipment to server:\n%s' % json.dumps(profiles, indent=4)
         )
         remote_control = RemoteControl(('', self.port), self.authkey, timeout=5)
+        remote_control.pooled = True # the lister reports often
         try:
             remote_control.set_boards(profiles)
         except ConnectionClosed:
@@ -6,12 +6,14 @@ import sys
 import time
 import json
 import signal
+import threading
 
 from datetime import datetime
 
 import ave.config
 
 from ave.network.control  import Control, RemoteControl
+from ave.network.process  import start_forkserver, get_forkserver
 from ave.relay.profile    import BoardProfile, RelayProfile
 from ave.relay.board      import RelayBoard
 from ave.relay.lister     import RelayLister
@@ -27,6 +29,7 @@ class RelayServer(Control):
     lister     = None
     inherited  = None # [BoardProfile, ...]
     virtual    = None # {RelayProfile: Board}
+    locks      = None # {board uid: threading.Lock}
     restarting = False
 
     def __init__(self, home=None, config=None, inherited=None, socket=None,
@@ -38,6 +41,7 @@ class RelayServer(Control):
         self.home      = home
         self.config    = RelayServer.validate_config(config)
         self.virtual   = {}
+        self.locks     = {}
         if inherited:
             self.inherited = [BoardProfile(i) for i in inherited]
         else:
@@ -84,12 +88,27 @@ class RelayServer(Control):
         self.report_virtual(self.virtual.keys())
 
     def initialize(self):
+        # a reporter is started on every idle call. fork them from a small
+        # helper that is started before the server has grown
+        start_forkserver(['ave.relay.reporter'])
         Control.initialize(self)
+        self.start_lister()
+
+    def start_lister(self):
         self.lister = RelayLister(self.port, self.keys['admin'], self.logging)
         self.lister.start()
         self.join_later(self.lister)
 
     def report_virtual(self, profiles, timeout=5):
+        server = get_forkserver()
+        if server:
+            try:
+                server.spawn(
+                    Reporter, [self.home, self.logging, profiles, timeout]
+                )
+                return
+            except Exception, e:
+                self.log('WARNING: could not use fork server: %s' % e)
         r = Reporter(self.home, self.logging, profiles, timeout)
         r.start(daemonize=True)
 
@@ -123,11 +142,13 @@ class RelayServer(Control):
     def serialize(self):
         state = []
         for b in self.get_boards():
-            p = b.get_profile()
-            try:
-                p['state'] = b.get_state()
-            except DeviceOffline:
-                continue
+            # wait for offloaded circuit changes on the board to finish
+            with self.get_board_lock(b):
+                p = b.get_profile()
+                try:
+                    p['state'] = b.get_state()
+                except DeviceOffline:
+                    continue
             state.append(p)
         return { 'boards': state }
 
@@ -135,10 +156,14 @@ class RelayServer(Control):
     @Control.preauth('admin')
     def begin_handover(self):
         self.stop_listening()
+        # offloaded calls check the flag while holding the board lock. those
+        # that already passed the check finish before serialize() gets the
+        # lock. all others are refused, so no board changes after this point
         self.restarting = True
         serialized = self.serialize()
         for b in self.get_boards():
-            b.close()
+            with self.get_board_lock(b):
+                b.close()
         return serialized
 
     @Control.rpc
@@ -157,35 +182,56 @@ class RelayServer(Control):
     def set_boards(self, profiles): # must only be used by the lister
         boards  = [BoardProfile(p) for p in profiles] # may raise exception
         for profile in boards:
-            try:
-                b = self.make_board(profile, self.home)
-            except Exception, e:
-                self.log('ERROR: could not open board: %s' % e)
-                continue
-            if profile in self.inherited:
-                index = self.inherited.index(profile)
-                b.set_state(self.inherited[index]['state'])
-                self.inherited.remove(profile)
-            elif profile['power_state'] == 'online':
-                b.reset_board()
-
-            groups = b.list_groups()
-            for name in groups:
-                v = RelayProfile({
-                    'type'       :'relay',
-                    'uid'        : '%s.%s' % (b.uid, name),
-                    'circuits'   : groups[name],
-                    'power_state': profile['power_state']
-                })
-                if v in self.virtual:
-                    del self.virtual[v] # fully replace old index with new.
-                self.virtual[v] = b # serial is same. other fields may not be.
+            # offloaded calls may be using a board that is already open for the
+            # same device. replace it while holding its lock
+            with self.locks.setdefault(profile['serial'], threading.Lock()):
+                self.replace_board(profile)
         self.report_virtual(self.virtual.keys()) # add the profiles to a broker
 
+    def replace_board(self, profile):
+        # close the old board before the device is opened again. worker threads
+        # look up boards without holding a lock, so build the new mapping on
+        # the side and swap it in with a single assignment
+        virtual = {}
+        closed  = []
+        for v, old in self.virtual.items():
+            if old.uid != profile['serial']:
+                virtual[v] = old
+            elif old not in closed: # mapped once per circuit group
+                old.close()
+                closed.append(old)
+        try:
+            b = self.make_board(profile, self.home)
+        except Exception, e:
+            self.log('ERROR: could not open board: %s' % e)
+            self.virtual = virtual
+            return
+        if profile in self.inherited:
+            index = self.inherited.index(profile)
+            b.set_state(self.inherited[index]['state'])
+            self.inherited.remove(profile)
+        elif profile['power_state'] == 'online':
+            b.reset_board()
+
+        groups = b.list_groups()
+        for name in groups:
+            v = RelayProfile({
+                'type'       :'relay',
+                'uid'        : '%s.%s' % (b.uid, name),
+                'circuits'   : groups[name],
+                'power_state': profile['power_state']
+            })
+            virtual[v] = b
+        self.virtual = virtual
+
     @Control.rpc
     @Control.preauth('admin')
     def list_equipment(self):
-        return [b.get_profile() for b in self.get_boards()]
+        result = []
+        for b in self.get_boards():
+            with self.get_board_lock(b):
+                result.append(b.get_profile())
+        return result
 
     @Control.rpc
     @Control.preauth('admin')
@@ -203,13 +249,38 @@ class RelayServer(Control):
             raise Exception('invalid profile does not match board uid')
         return board, profile['uid'][len(board.uid+'.'):]
 
+    def get_board_lock(self, board):
+        # circuit changes are offloaded to worker threads. serialize the I/O
+        # on each board but let different boards be handled in parallel. the
+        # main loop takes the same lock to read, close or replace the board
+        return self.locks.setdefault(board.uid, threading.Lock())
+
+    def lock_board_group(self, profile):
+        # called by worker threads. the main loop may close or replace the
+        # board while the worker waits for its lock, so check the state of the
+        # server again once the lock is held
+        while True:
+            if self.restarting:
+                raise Restarting('relay server is restarting')
+            board, group = self.profile_to_board_group(profile)
+            lock = self.get_board_lock(board)
+            lock.acquire()
+            if self.restarting:
+                lock.release()
+                raise Restarting('relay server is restarting')
+            if self.virtual.get(RelayProfile(profile)) is board:
+                return board, group, lock
+            lock.release() # replaced by set_boards(). look up the new one
+
     @Control.rpc
     @Control.preauth('admin')
+    @Control.offload
     def set_board_circuit(self, profile, circuit, high):
-        if self.restarting:
-            raise Restarting('relay server is restarting')
-        board, group = self.profile_to_board_group(profile)
-        board.set_group_circuit(group, circuit, high)
+        board, group, lock = self.lock_board_group(profile)
+        try:
+            board.set_group_circuit(group, circuit, high)
+        finally:
+            lock.release()
         now   = datetime.utcnow()
         return [
             now.year, now.month, now.day,
@@ -219,11 +290,13 @@ class RelayServer(Control):
 
     @Control.rpc
     @Control.preauth('admin')
+    @Control.offload
     def reset_board_group(self, profile):
-        if self.restarting:
-            raise Restarting('relay server is restarting')
-        board, group = self.profile_to_board_group(profile)
-        board.reset_group(group)
+        board, group, lock = self.lock_board_group(profile)
+        try:
+            board.reset_group(group)
+        finally:
+            lock.release()
         now   = datetime.utcnow()
         return [
             now.year, now.month, now.day,
@@ -232,6 +305,7 @@ class RelayServer(Control):
         ]
 
 class RemoteRelayServer(RemoteControl):
+    pooled = True
 
     def __init__(self, address=None, authkey=None, timeout=5, home=None):
         if not home:
@@ -213,6 +213,7 @@ setup(
     install_requires=['psutil', 'coverage', 'pyserial'],
 
     data_files=[('/usr/bin', ['common/bin/ave-config', 'broker/bin/ave-broker',
+                              'broker/bin/ave-broker-replay',
                               'handset/bin/ave-adb-server', 'relay/bin/ave-relay',
                               'vcsjob/bin/vcsjob']),
                 ('/usr/lib', [libfdtx]),